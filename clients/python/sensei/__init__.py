@@ -6,7 +6,10 @@ __license__ = "APL"
 from sensei_client import BQLRequest, SenseiClientError, SenseiFacet, SenseiSelection,\
                           SenseiSort, SenseiFacetInitParams, SenseiFacetInfo,\
                           SenseiNodeInfo, SenseiSystemInfo, SenseiRequest, SenseiHit,\
-                          SenseiResultFacet, SenseiClient
+                          SenseiResultFacet, SenseiClient, SenseiPreparedStatement
+from sensei_balancer import SenseiMultiBrokerClient
+from sensei_federated import FederatedSenseiClient
+from sensei_cache import ResultCache
 
 from sensei_components import *
 
@@ -23,5 +26,9 @@ __all__ = [
   SenseiRequest,
   SenseiHit,
   SenseiResultFacet,
-  SenseiClient
+  SenseiClient,
+  SenseiPreparedStatement,
+  SenseiMultiBrokerClient,
+  FederatedSenseiClient,
+  ResultCache
 ]
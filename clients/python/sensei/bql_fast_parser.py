@@ -0,0 +1,541 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+#
+# Hand-written recursive-descent BQL parser
+#
+# This parser accepts the same grammar as the pyparsing grammar built by
+# BQLParser._build_parser (see the BNF at the top of bql_parser.py), and
+# calls the same BQLParser parse actions with equivalent tokens, so both
+# engines produce identical results.  It scans the statement directly
+# with a handful of regular expressions and never backtracks more than
+# one token, which makes it much cheaper than the pyparsing grammar.
+#
+
+import re
+
+from pyparsing import ParseException
+
+from bql_parser import BQLVariable, DATE_TIME_REGEX
+
+# Words that cannot be used as column names (same list as the grammar)
+RESERVED_WORDS = set(["all", "and", "asc", "between", "boolean", "browse", "by",
+                      "bytearray", "contains", "desc", "describe", "double",
+                      "except", "facet", "false", "fetching", "from", "group",
+                      "given", "hits", "in", "int", "is", "limit", "long", "not",
+                      "or", "order", "param", "query", "select", "stored",
+                      "string", "top", "true", "value", "where", "with"])
+
+# Characters that may not surround a keyword
+KEYWORD_CHARS = set("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_$")
+
+PARAM_TYPES = ["boolean", "int", "long", "string", "bytearray", "double"]
+
+WHITESPACE_REGEX = re.compile(r'''[ \n\t\r]*''')
+WORD_REGEX = re.compile(r'''[A-Za-z_$][A-Za-z0-9_$]*''')
+COLUMN_NAME_REGEX = re.compile(r'''[A-Za-z_][A-Za-z0-9_\-.]*''')
+IDENT_REGEX = re.compile(r'''[A-Za-z_][A-Za-z0-9_\-.$]*''')
+INTEGER_REGEX = re.compile(r'''\d+''')
+REAL_REGEX = re.compile(r'''\d+\.\d+''')
+QUOTED_STRING_REGEX = re.compile(r'''(?:"(?:[^"\n\r\\]|(?:"")|(?:\\x[0-9a-fA-F]+)|(?:\\.))*")|(?:'(?:[^'\n\r\\]|(?:'')|(?:\\x[0-9a-fA-F]+)|(?:\\.))*')''')
+VARIABLE_REGEX = re.compile(r'''\$[A-Za-z_][A-Za-z0-9_]*''')
+RANGE_OP_REGEX = re.compile(r'''<=|>=|<|>''')
+
+# Parts of a time span, in the order they must appear
+TIME_SPAN_PARTS = [
+  ("week_part", re.compile(r'''weeks?''', re.IGNORECASE)),
+  ("day_part", re.compile(r'''days?''', re.IGNORECASE)),
+  ("hour_part", re.compile(r'''hours?''', re.IGNORECASE)),
+  ("minute_part", re.compile(r'''(?:minute|min)s?''', re.IGNORECASE)),
+  ("second_part", re.compile(r'''(?:second|sec)s?''', re.IGNORECASE)),
+  ("millisecond_part", re.compile(r'''(?:millisecond|msec)s?''', re.IGNORECASE)),
+  ]
+
+
+class BQLTokens:
+  """Parsed tokens, accessed the same way as pyparsing's ParseResults.
+
+  Tokens can be indexed and sliced like a list, and named results are
+  attributes; a missing named result is an empty string.
+
+  """
+
+  def __init__(self, items, **named):
+    self.items = items
+    self.named = named
+
+  def __getattr__(self, name):
+    if name.startswith("__") or name in ("items", "named"):
+      raise AttributeError(name)
+    return self.named.get(name, "")
+
+  def __getitem__(self, index):
+    return self.items[index]
+
+  def __len__(self):
+    return len(self.items)
+
+  def __iter__(self):
+    return iter(self.items)
+
+  def __repr__(self):
+    return repr((self.items, self.named))
+
+
+class BQLFastParser:
+  """Recursive-descent BQL parser driving the actions of a BQLParser."""
+
+  def __init__(self, actions):
+    self.actions = actions
+
+  def parseString(self, bql_stmt, parseAll=True):
+    """Parse a statement, with the same interface as pyparsing."""
+
+    return _ParseRun(self.actions, bql_stmt.expandtabs()).statement()
+
+
+class _ParseRun:
+  """The state of parsing one statement."""
+
+  def __init__(self, actions, s):
+    self.actions = actions
+    self.s = s
+    self.pos = 0
+
+  #
+  # Scanning
+  #
+
+  def error(self, expected):
+    raise ParseException(self.s, self.pos, "Expected " + expected)
+
+  def skip(self):
+    """Skip whitespace and comments."""
+
+    s = self.s
+    pos = WHITESPACE_REGEX.match(s, self.pos).end()
+    while s.startswith("--", pos):
+      end = s.find("\n", pos)
+      if end < 0:
+        end = len(s)
+      pos = WHITESPACE_REGEX.match(s, end).end()
+    self.pos = pos
+    return pos
+
+  def peek_keyword(self, *words):
+    """Return the keyword at the current position if it is one of words."""
+
+    s = self.s
+    pos = self.skip()
+    m = WORD_REGEX.match(s, pos)
+    if not m or (pos > 0 and s[pos - 1] in KEYWORD_CHARS):
+      return None
+    word = m.group().lower()
+    if word in words:
+      return word
+    return None
+
+  def keyword(self, *words):
+    word = self.peek_keyword(*words)
+    if word:
+      self.pos += len(word)
+    return word
+
+  def expect_keyword(self, word):
+    if not self.keyword(word):
+      self.error('"%s"' % word)
+    return word
+
+  def literal(self, text):
+    if self.s.startswith(text, self.skip()):
+      self.pos += len(text)
+      return text
+    return None
+
+  def expect_literal(self, text):
+    if not self.literal(text):
+      self.error('"%s"' % text)
+    return text
+
+  def regex(self, regex):
+    m = regex.match(self.s, self.skip())
+    if m:
+      self.pos = m.end()
+      return m.group()
+    return None
+
+  def column_name(self):
+    pos = self.skip()
+    name = self.regex(COLUMN_NAME_REGEX)
+    if name is None or self.is_reserved(pos):
+      self.pos = pos
+      self.error("column name")
+    return name
+
+  def is_reserved(self, pos):
+    # Keywords cannot be followed by a keyword character, so a word is
+    # only a keyword if the whole word is one.
+    m = WORD_REGEX.match(self.s, pos)
+    return bool(m) and m.group().lower() in RESERVED_WORDS
+
+  def ident(self):
+    name = self.regex(IDENT_REGEX)
+    if name is None:
+      self.error("identifier")
+    return name
+
+  def integer(self):
+    text = self.regex(INTEGER_REGEX)
+    if text is None:
+      self.error("integer")
+    return int(text)
+
+  def quoted_string(self):
+    text = self.regex(QUOTED_STRING_REGEX)
+    if text is None:
+      self.error("quoted string")
+    return text[1:-1]
+
+  def delimited(self, parse_item):
+    items = [parse_item()]
+    while self.literal(","):
+      items.append(parse_item())
+    return items
+
+  #
+  # Values
+  #
+
+  def time_span(self):
+    """Parse a (possibly empty) time span into an epoch time."""
+
+    loc = self.skip()
+    parts = {}
+    for name, unit_regex in TIME_SPAN_PARTS:
+      start = self.pos
+      number = self.regex(INTEGER_REGEX)
+      if number is not None:
+        m = unit_regex.match(self.s, self.skip())
+        if m:
+          self.pos = m.end()
+          parts[name] = [int(number), m.group()]
+          continue
+      self.pos = start
+    return self.actions.convert_time_span(self.s, loc, BQLTokens([], **parts))
+
+  def time_expr(self):
+    """Parse a time expression, or return None if there is none."""
+
+    loc = start = self.skip()
+    value = self.time_span()
+    if self.keyword("ago"):
+      return value
+    self.pos = start
+
+    m = DATE_TIME_REGEX.match(self.s, loc)
+    if m:
+      self.pos = m.end()
+      return self.actions.convert_time(self.s, loc, BQLTokens([m.group()], date_time_regex=m.group()))
+    if self.keyword("now"):
+      return self.actions.convert_time(self.s, loc, BQLTokens(["now"]))
+    return None
+
+  def value(self):
+    value = self.time_expr()
+    if value is not None:
+      return value
+    text = self.regex(REAL_REGEX)
+    if text is not None:
+      return float(text)
+    text = self.regex(INTEGER_REGEX)
+    if text is not None:
+      return int(text)
+    text = self.regex(QUOTED_STRING_REGEX)
+    if text is not None:
+      return text[1:-1]
+    flag = self.keyword("true", "false")
+    if flag:
+      return flag == "true"
+    text = self.regex(VARIABLE_REGEX)
+    if text is not None:
+      return BQLVariable(text[1:])
+    self.error("value")
+
+  def value_list(self):
+    self.expect_literal("(")
+    values = self.delimited(self.value)
+    self.expect_literal(")")
+    return values
+
+  def predicate_props(self, items):
+    """Parse an optional WITH clause, returning the property dict."""
+
+    if not self.keyword("with"):
+      return ""
+    loc = self.skip()
+    self.expect_literal("(")
+    pairs = []
+    for key, value in self.delimited(self.prop_pair):
+      pairs.extend([key, value])
+    self.expect_literal(")")
+    props = self.actions.prop_list_action(self.s, loc, pairs)
+    items.extend(["with", props])
+    return props
+
+  def prop_pair(self):
+    key = self.quoted_string()
+    self.expect_literal(":")
+    return key, self.value()
+
+  #
+  # Predicates
+  #
+
+  def search_expr(self):
+    return self.operator_expr("or", self.and_expr, self.actions.or_predicate_action)
+
+  def and_expr(self):
+    return self.operator_expr("and", self.primary_expr, self.actions.and_predicate_action)
+
+  def operator_expr(self, op, parse_operand, action):
+    loc = self.skip()
+    operands = [parse_operand()]
+    while self.keyword(op):
+      operands.extend([op, parse_operand()])
+    if len(operands) == 1:
+      return operands[0]
+    return action(self.s, loc, BQLTokens([operands]))
+
+  def primary_expr(self):
+    if self.literal("("):
+      expr = self.search_expr()
+      self.expect_literal(")")
+      return expr
+    return self.predicate()
+
+  def predicate(self):
+    s = self.s
+    actions = self.actions
+    loc = self.skip()
+
+    if self.keyword("query"):
+      self.expect_keyword("is")
+      return actions.query_predicate_action(s, loc, BQLTokens(["query", "is", self.quoted_string()]))
+
+    if self.peek_keyword("match"):
+      start = self.pos
+      self.keyword("match")
+      if self.literal("("):
+        columns = self.delimited(self.column_name)
+        self.expect_literal(")")
+        self.expect_keyword("against")
+        self.expect_literal("(")
+        text = self.quoted_string()
+        self.expect_literal(")")
+        return actions.match_predicate_action(s, loc, BQLTokens(["match", columns, "against", text]))
+      self.pos = start
+
+    field = self.column_name()
+    negated = self.keyword("not")
+    if negated:
+      op = self.keyword("in", "between")
+      if not op:
+        self.error('"in" or "between"')
+    else:
+      op = self.keyword("in", "contains", "between", "since", "after", "before", "like")
+
+    if op == "in":
+      if not negated and self.keyword("last"):
+        return actions.time_in_last_action(s, loc, BQLTokens([field, "in", "last", self.time_span()]))
+      return self.in_predicate(field, negated, loc)
+    elif op == "contains":
+      self.expect_keyword("all")
+      return self.in_predicate(field, None, loc, contains_all=True)
+    elif op == "between":
+      items = [field] + (negated and ["not"] or []) + ["between", self.value()]
+      items.append(self.expect_keyword("and"))
+      items.append(self.value())
+      return actions.between_predicate_action(s, loc, BQLTokens(items))
+    elif op in ("since", "after", "before"):
+      value = self.time_expr()
+      if value is None:
+        self.error("time expression")
+      return actions.time_since_action(s, loc, BQLTokens([field, op, value]))
+    elif op == "like":
+      return actions.like_predicate_action(s, loc, BQLTokens([field, "like", self.quoted_string()]))
+
+    if self.literal("<>"):
+      items = [field, "<>", self.value()]
+      self.predicate_props(items)
+      return actions.not_equal_predicate_action(s, loc, BQLTokens(items))
+    if self.literal("="):
+      items = [field, "=", self.value()]
+      props = self.predicate_props(items)
+      return actions.equal_predicate_action(s, loc, BQLTokens(items, prop_list=props))
+    range_op = self.regex(RANGE_OP_REGEX)
+    if range_op:
+      return actions.range_predicate_action(s, loc, BQLTokens([field, range_op, self.value()]))
+    self.error("predicate operator")
+
+  def in_predicate(self, field, negated, loc, contains_all=False):
+    if contains_all:
+      items = [field, "contains", "all"]
+    else:
+      items = [field] + (negated and ["not"] or []) + ["in"]
+    value_list = self.value_list()
+    items.extend(value_list)
+    except_values = ""
+    if self.keyword("except"):
+      except_values = self.value_list()
+      items.append("except")
+      items.extend(except_values)
+    props = self.predicate_props(items)
+    tok = BQLTokens(items, value_list=value_list, except_values=except_values, prop_list=props)
+    if contains_all:
+      return self.actions.contains_all_predicate_action(self.s, loc, tok)
+    return self.actions.in_predicate_action(self.s, loc, tok)
+
+  #
+  # Statements
+  #
+
+  def statement(self):
+    word = self.keyword("select", "desc", "describe", "set")
+    if word == "select":
+      tokens = self.select_stmt()
+    elif word in ("desc", "describe"):
+      tokens = BQLTokens([word], describe=word)
+      if IDENT_REGEX.match(self.s, self.skip()):
+        tokens.named["index"] = self.ident()
+        tokens.items.append(tokens.index)
+    elif word == "set":
+      tokens = self.set_stmt()
+    else:
+      self.error('"select", "describe" or "set"')
+
+    self.literal(";")
+    if self.skip() < len(self.s):
+      self.error("end of statement")
+    return tokens
+
+  def set_stmt(self):
+    variable = self.ident()
+    if self.s.startswith("(", self.skip()):
+      value_list = self.value_list()
+      return BQLTokens(["set", variable] + value_list, variable=variable, value_list=value_list)
+    value = self.value()
+    return BQLTokens(["set", variable, value], variable=variable, value=value)
+
+  def select_stmt(self):
+    items = ["select"]
+    named = {}
+    if self.literal("*"):
+      named["columns"] = "*"
+    else:
+      named["columns"] = self.delimited(self.column_name)
+    items.append(named["columns"])
+
+    if self.keyword("from"):
+      named["index"] = self.ident()
+      items.extend(["from", named["index"]])
+    if self.keyword("where"):
+      named["where"] = self.search_expr()
+      items.extend(["where", named["where"]])
+    if self.keyword("given"):
+      self.expect_keyword("facet")
+      self.expect_keyword("param")
+      params = self.delimited(self.facet_param)
+      named["given"] = BQLTokens(["given", "facet", "param"] + params, facet_param=params)
+      items.extend(named["given"].items)
+
+    while True:
+      loc = self.skip()
+      word = self.peek_keyword("order", "limit", "group", "browse", "fetching")
+      if not word:
+        break
+      name = {"order": "orderby", "group": "groupby", "browse": "facet_specs",
+              "fetching": "fetching_stored"}.get(word, word)
+      if name in named:
+        raise ParseException(self.s, loc, '%s clause can only be used once' % word.upper())
+      self.keyword(word)
+      if word == "order":
+        self.expect_keyword("by")
+        specs = self.delimited(self.order_by_spec)
+        named[name] = BQLTokens(["order", "by"] + specs, orderby_spec=specs)
+        self.actions.order_by_action(self.s, loc, named[name])
+        items.extend(named[name].items)
+      elif word == "limit":
+        limit = [self.integer()]
+        if self.literal(","):
+          limit.append(self.integer())
+        named[name] = ["limit", limit]
+        items.extend(named[name])
+      elif word == "group":
+        self.expect_keyword("by")
+        named[name] = [self.column_name()]
+        items.extend(["group", "by"] + named[name])
+        if self.keyword("top"):
+          named["max_per_group"] = self.integer()
+          items.extend(["top", named["max_per_group"]])
+      elif word == "browse":
+        self.expect_keyword("by")
+        named[name] = self.delimited(self.facet_spec)
+        items.extend(["browse", "by"] + named[name])
+      elif word == "fetching":
+        self.expect_keyword("stored")
+        named[name] = ["fetching", "stored"]
+        flag = self.keyword("true", "false")
+        if flag:
+          named[name].append(flag)
+        items.extend(named[name])
+    return BQLTokens(items, **named)
+
+  def facet_param(self):
+    self.expect_literal("(")
+    facet = self.column_name()
+    self.expect_literal(",")
+    name = self.quoted_string()
+    self.expect_literal(",")
+    param_type = self.keyword(*PARAM_TYPES)
+    if not param_type:
+      self.error("parameter type")
+    self.expect_literal(",")
+    value = self.value()
+    self.expect_literal(")")
+    return [facet, name, param_type, value]
+
+  def order_by_spec(self):
+    spec = [self.column_name()]
+    order = self.keyword("asc", "desc")
+    if order:
+      spec.append(order)
+    return spec
+
+  def facet_spec(self):
+    spec = [self.column_name()]
+    if self.literal("("):
+      expand = self.keyword("true", "false")
+      if not expand:
+        self.error('"true" or "false"')
+      spec.append(expand)
+      self.expect_literal(",")
+      spec.append(self.integer())
+      self.expect_literal(",")
+      spec.append(self.integer())
+      self.expect_literal(",")
+      order = self.keyword("hits", "value")
+      if not order:
+        self.error('"hits" or "value"')
+      spec.append(order)
+      self.expect_literal(")")
+    return spec
@@ -21,8 +21,12 @@ import datetime
 from datetime import datetime
 import time
 import re
+import threading
 
 from sensei_components import *
+# BQLRequest and the helpers that do not need the grammar live in
+# bql_request, so that they can be used without loading pyparsing.
+from bql_request import *
 
 logger = logging.getLogger("bql_parser")
 
@@ -36,6 +40,11 @@ DATE_TIME_REGEX = re.compile(DATE_TIME)
 # The lowest resolution that can make a difference in range predicate
 EPSILON = 0.01
 
+# Statement parsed when the grammar is built, covering the common clauses
+WARM_UP_STMT = """SELECT a, b FROM index
+WHERE (_a IN ("x", "y") AND _b > 1 AND _b <= 2.5) OR _c <> "z" OR _d CONTAINS ALL (1)
+ORDER BY _a DESC LIMIT 0, 10"""
+
 # TODO:
 #
 # 1. Term vector
@@ -48,8 +57,16 @@ EPSILON = 0.01
 from pyparsing import Literal, CaselessLiteral, Word, Upcase, delimitedList, Optional, \
     Combine, Group, alphas, nums, alphanums, ParseException, ParseFatalException, ParseSyntaxException, \
     Forward, oneOf, quotedString, \
-    ZeroOrMore, restOfLine, Keyword, OnlyOnce, Suppress, removeQuotes, NotAny, OneOrMore, \
-    MatchFirst, Regex, stringEnd, operatorPrecedence, opAssoc
+    ZeroOrMore, restOfLine, Keyword, Suppress, removeQuotes, NotAny, OneOrMore, \
+    MatchFirst, Regex, stringEnd, operatorPrecedence, opAssoc, ParserElement
+
+# Whether to memoize intermediate parse results (packrat parsing) when the
+# grammar is built, on the first parse with the pyparsing engine.  Without
+# it, the operatorPrecedence-based search expression backtracks
+# exponentially on nested AND/OR predicates.  Packrat parsing is a
+# pyparsing-wide setting, so applications whose other pyparsing grammars
+# cannot run with it may set this to False before parsing any BQL.
+PACKRAT_PARSING = True
 
 """
 
@@ -112,7 +129,7 @@ BNF Grammar for BQL
 
 <value_list> ::= '(' <value> ( ',' <value> )* ')'
 
-<value> ::= <quoted_string> | <numeric>
+<value> ::= <quoted_string> | <numeric> | <variable>
 
 <range_op> ::= '<' | '<=' | '>=' | '>'
 
@@ -187,6 +204,8 @@ BNF Grammar for BQL
 
 <identifier_part> ::= <identifier_start> | <digit>
 
+<variable> ::= '$' <identifier_start> ( <identifier_part> )*
+
 <column_name> ::= <identifier>
 
 <facet_name> ::= <identifier>
@@ -240,32 +259,47 @@ class BQLParser:
   This BQL parser takes a BQL statement string as input, and return parsed
   tokens.
 
+  Two engines are available: "fast" (the default) runs the hand-written
+  parser in bql_fast_parser, and "pyparsing" runs the grammar built by
+  _build_parser, which accepts the same statements and returns the same
+  results at many times the cost.
+
+  A parser may be shared by many threads.  The fast engine parses without
+  any lock, but parses with the pyparsing engine run one at a time across
+  the whole process, because pyparsing keeps global state while parsing
+  (see _parse_shared_grammar).
+
   """
 
-  def __init__(self, facet_map):
-    self.limit_once = OnlyOnce(lambda s, loc, tok: tok)
-    self.order_by_once = OnlyOnce(self.order_by_action)
-    self.group_by_once = OnlyOnce(lambda s, loc, tok: tok)
-    self.browse_by_once = OnlyOnce(lambda s, loc, tok: tok)
-    self.fetching_stored_once = OnlyOnce(lambda s, loc, tok: tok)
-    self.time_now = None
+  def __init__(self, facet_map, engine=DEFAULT_PARSER_ENGINE):
     self.facet_map = facet_map or {}
-    self._parser = self._build_parser()
+    if engine == "fast":
+      from bql_fast_parser import BQLFastParser
+      self._parser = BQLFastParser(self)
+    elif engine == "pyparsing":
+      self._parser = get_bql_grammar()
+    else:
+      raise ValueError("Unknown BQL parser engine: %s" % engine)
+    self.engine = engine
 
   def parse(self, bql_stmt):
-    tokens = None
+    """Parse a BQL statement and return its tokens.
+
+    All state of a parse lives in a BQLParseContext of its own, which
+    the parse actions find through a thread-local variable, so one parser
+    may be used by many threads at once.  With the pyparsing engine, the
+    parses of all threads take turns.
+
+    """
+
+    previous = getattr(_local, "context", None)
+    _local.context = BQLParseContext(self)
     try:
-      self.time_now = int(time.time() * 1000)
-      tokens = self._parser.parseString(bql_stmt, parseAll=True)
-    except ParseException as err:
-      raise err
-    except ParseSyntaxException as err:
-      raise err
-    except ParseFatalException as err:
-      raise err
+      if self.engine == "fast":
+        return self._parser.parseString(bql_stmt, parseAll=True)
+      return _parse_shared_grammar(self._parser, bql_stmt)
     finally:
-      self.reset_all()
-    return tokens
+      _local.context = previous
 
   def accumulate_range_pred(self, field_map, pred):
     """Try to merge ANDed range predicates.
@@ -274,68 +308,16 @@ class BQLParser:
     "1999 < year <= 2003".
     """
   
-    def _max(n1, include1, n2, include2):
-      """Find the larger of the two lower bounds."""
-  
-      if n1 == None:
-        return n2, include2
-      elif n2 == None:
-        return n1, include1
-      else:
-        if n1 > n2:
-          return n1, include1
-        elif n1 == n2:
-          return n1, (include1 and include2)
-        else:
-          return n2, include2
-  
-    def _min(n1, include1, n2, include2):
-      """Find the smaller of the two upper bounds."""
-  
-      if n1 == None:
-        return n2, include2
-      elif n2 == None:
-        return n1, include1
-      else:
-        if n1 > n2:
-          return n2, include2
-        elif n1 == n2:
-          return n1, (include1 and include2)
-        else:
-          return n1, include1
-  
     field = pred_field(pred)
     old_range = field_map.get(field)
     if not old_range:
       field_map[field] = pred
       return
-    old_spec = old_range.values()[0].values()[0]
-    old_from = old_spec.get("from")
-    old_include_lower = old_spec.get("include_lower") or False
-    old_to = old_spec.get("to")
-    old_include_upper = old_spec.get("include_upper") or False
-  
-    cur_spec = pred.values()[0].values()[0]
-    cur_from = cur_spec.get("from")
-    cur_include_lower = cur_spec.get("include_lower") or False
-    cur_to = cur_spec.get("to")
-    cur_include_upper = cur_spec.get("include_upper") or False
-  
-    new_spec = {}
-    lower, include_lower = _max(old_from, old_include_lower, cur_from, cur_include_lower)
-    upper, include_upper = _min(old_to, old_include_upper, cur_to, cur_include_upper)
-  
-    if lower and upper:
-      if (lower > upper or
-          (lower == upper and (not include_lower or not include_upper))):
-        raise ParseSyntaxException(ParseException("", 0, "Conflict range predicates for column '%s'"
-                                                  % field))
-    if lower:
-      new_spec["from"] = lower
-      new_spec["include_lower"] = include_lower
-    if upper:
-      new_spec["to"] = upper
-      new_spec["include_upper"] = include_upper
+    new_spec = and_range_specs(old_range.values()[0].values()[0],
+                               pred.values()[0].values()[0])
+    if new_spec is None:
+      raise ParseSyntaxException(ParseException("", 0, "Conflict range predicates for column '%s'"
+                                                % field))
     field_map[field] = {"range": {field: new_spec} }
 
   def order_by_action(self, s, loc, tok):
@@ -350,7 +332,8 @@ class BQLParser:
     field_map = {}
     for i in xrange(0, len(tok[0]), 2):
       pred = tok[0][i]
-      if pred_type(pred) != "range":
+      if pred_type(pred) != "range" or range_has_variable(pred):
+        # Ranges bounded by a variable cannot be merged before binding
         preds.append(pred)
       else:
         self.accumulate_range_pred(field_map, pred)
@@ -394,6 +377,8 @@ class BQLParser:
     ok, msg = self._verify_field_data_type(field, tok.except_values)
     if not ok:
       raise ParseSyntaxException(ParseException(s, loc, msg))
+    self._mark_list_variable(tok.value_list)
+    self._mark_list_variable(tok.except_values)
 
     if tok[1] != "not":
       return {"terms":
@@ -424,6 +409,8 @@ class BQLParser:
     ok, msg = self._verify_field_data_type(field, tok.except_values)
     if not ok:
       raise ParseSyntaxException(ParseException(s, loc, msg))
+    self._mark_list_variable(tok.value_list)
+    self._mark_list_variable(tok.except_values)
 
     return {"terms":
               {field:
@@ -635,18 +622,11 @@ class BQLParser:
                }
             }
   
-  def reset_all(self):
-    self.limit_once.reset()
-    self.order_by_once.reset()
-    self.group_by_once.reset()
-    self.browse_by_once.reset()
-    self.fetching_stored_once.reset()
-  
   def convert_time(self, s, loc, toks):
     """Convert a time expression into an epoch time."""
   
     if toks[0] == "now":
-      return self.time_now
+      return _local.context.time_now
     elif toks.date_time_regex:
       mm = DATE_TIME_REGEX.match(toks[0])
       (_, year, _, month, day, hour, minute, second) = mm.groups()
@@ -674,7 +654,7 @@ class BQLParser:
     if toks.millisecond_part:
       total += toks.millisecond_part[0]
     
-    return self.time_now - total
+    return _local.context.time_now - total
 
   def _verify_value_type(self, value, column_type):
     """Verify value type."""
@@ -716,11 +696,21 @@ class BQLParser:
       facet_info = self.facet_map[field]
       column_type = facet_info.get_props()["column_type"]
       for value in values:
+        if isinstance(value, BQLVariable):
+          # The value is checked when it gets bound
+          value.column_type = column_type
+          continue
         ok, msg = self._verify_value_type(value, column_type)
         if not ok:
           return ok, msg + ' (for facet "%s")' % field
     return True, None
 
+  def _mark_list_variable(self, values):
+    """A variable that is the only item of a value list binds a list."""
+
+    if len(values) == 1 and isinstance(values[0], BQLVariable):
+      values[0].is_list = True
+
   def _verify_facet_type(self, field, expected_type):
     """Validate facet type given a field."""
 
@@ -730,8 +720,14 @@ class BQLParser:
     else:
       return True, None
     
-  def _build_parser(self):
-    """Build a BQL parser.
+  @staticmethod
+  def _build_parser():
+    """Build the BQL grammar.
+
+    The grammar is shared by all BQLParser instances (see get_bql_grammar),
+    so it must not refer to any parser: parse actions call the parser of
+    the parse in progress through _action.
+
     """
     #
     # BQL tokens
@@ -833,69 +829,71 @@ class BQLParser:
                  Optional(time_hour_part) +
                  Optional(time_minute_part) +
                  Optional(time_second_part) +
-                 Optional(time_millisecond_part)).setParseAction(self.convert_time_span)
+                 Optional(time_millisecond_part)).setParseAction(_action("convert_time_span"))
     
-    date_time_string = Regex(DATE_TIME).setResultsName("date_time_regex").setParseAction(self.convert_time)
+    date_time_string = Regex(DATE_TIME).setResultsName("date_time_regex").setParseAction(_action("convert_time"))
     
     time_expr = ((time_span + AGO)
                  | date_time_string
-                 | NOW.setParseAction(self.convert_time))
+                 | NOW.setParseAction(_action("convert_time")))
     
     number = (real | integer)       # Put real before integer to avoid ambiguity
     numeric = (time_expr | number)
     
     boolean_constant = (TRUE | FALSE).setParseAction(lambda t: t[0] == "true")
+
+    variable = Combine("$" + Word(alphas + "_", alphanums + "_")).setParseAction(lambda t: BQLVariable(t[0][1:]))
     
-    value = (numeric | quotedString | boolean_constant)
+    value = (numeric | quotedString | boolean_constant | variable)
     value_list = LPAR + delimitedList(value) + RPAR
     
     prop_pair = (quotedString + COLON + value)
     predicate_props = (WITH + LPAR + delimitedList(prop_pair).
-                       setResultsName("prop_list").setParseAction(self.prop_list_action) + RPAR)
+                       setResultsName("prop_list").setParseAction(_action("prop_list_action")) + RPAR)
     
     in_predicate = (column_name + Optional(NOT) +
                     IN + value_list.setResultsName("value_list") +
                     Optional(EXCEPT + value_list.setResultsName("except_values")) +
                     Optional(predicate_props)
-                    ).setResultsName("in_pred").setParseAction(self.in_predicate_action)
+                    ).setResultsName("in_pred").setParseAction(_action("in_predicate_action"))
     
     contains_all_predicate = (column_name +
                               CONTAINS + ALL + value_list.setResultsName("value_list") +
                               Optional(EXCEPT + value_list.setResultsName("except_values")) +
                               Optional(predicate_props)
-                              ).setResultsName("contains_all_pred").setParseAction(self.contains_all_predicate_action)
+                              ).setResultsName("contains_all_pred").setParseAction(_action("contains_all_predicate_action"))
     
     equal_predicate = (column_name +
                        EQUAL + value +
                        Optional(predicate_props)
-                       ).setResultsName("equal_pred").setParseAction(self.equal_predicate_action)
+                       ).setResultsName("equal_pred").setParseAction(_action("equal_predicate_action"))
     
     not_equal_predicate = (column_name +
                            NOT_EQUAL + value +
                            Optional(predicate_props)
-                           ).setResultsName("not_equal_pred").setParseAction(self.not_equal_predicate_action)
+                           ).setResultsName("not_equal_pred").setParseAction(_action("not_equal_predicate_action"))
     
     query_predicate = (QUERY + IS + quotedString
-                       ).setResultsName("query_pred").setParseAction(self.query_predicate_action)
+                       ).setResultsName("query_pred").setParseAction(_action("query_predicate_action"))
     
     between_predicate = (column_name + Optional(NOT) +
                          BETWEEN + value + AND + value
-                         ).setResultsName("between_pred").setParseAction(self.between_predicate_action)
+                         ).setResultsName("between_pred").setParseAction(_action("between_predicate_action"))
     
     range_op = oneOf("< <= >= >")
     range_predicate = (column_name + range_op + value
-                       ).setResultsName("range_pred").setParseAction(self.range_predicate_action)
+                       ).setResultsName("range_pred").setParseAction(_action("range_predicate_action"))
     
-    time_predicate = ((column_name + IN + LAST + time_span).setParseAction(self.time_in_last_action)
-                      | (column_name + (SINCE | AFTER | BEFORE) + time_expr).setParseAction(self.time_since_action)
+    time_predicate = ((column_name + IN + LAST + time_span).setParseAction(_action("time_in_last_action"))
+                      | (column_name + (SINCE | AFTER | BEFORE) + time_expr).setParseAction(_action("time_since_action"))
                       ).setResultsName("time_pred")
     
     match_predicate = (MATCH + LPAR + column_name_list + RPAR +
                        AGAINST + LPAR + quotedString + RPAR
-                       ).setResultsName("match_pred").setParseAction(self.match_predicate_action)
+                       ).setResultsName("match_pred").setParseAction(_action("match_predicate_action"))
 
     like_predicate = (column_name + LIKE + quotedString
-                      ).setResultsName("like_pred").setParseAction(self.like_predicate_action)
+                      ).setResultsName("like_pred").setParseAction(_action("like_predicate_action"))
 
     predicate = (in_predicate
                  | contains_all_predicate
@@ -912,8 +910,8 @@ class BQLParser:
     predicates = predicate + NotAny(OR) + ZeroOrMore(AND + predicate)
     
     search_expr = operatorPrecedence(predicate,
-                                     [(AND, 2, opAssoc.LEFT, self.and_predicate_action),
-                                      (OR,  2, opAssoc.LEFT, self.or_predicate_action)
+                                     [(AND, 2, opAssoc.LEFT, _action("and_predicate_action")),
+                                      (OR,  2, opAssoc.LEFT, _action("or_predicate_action"))
                                       ])
     
     param_type = BOOLEAN | INT | LONG | STRING | BYTEARRAY | DOUBLE
@@ -926,9 +924,9 @@ class BQLParser:
     order_by_expression = Forward()
     order_by_spec = Group(column_name + Optional(orderseq)).setResultsName("orderby_spec", listAllMatches=True)
     order_by_expression << (order_by_spec + ZeroOrMore(COMMA + order_by_expression))
-    order_by_clause = (ORDER + BY + order_by_expression).setResultsName("orderby").setParseAction(self.order_by_once)
+    order_by_clause = (ORDER + BY + order_by_expression).setResultsName("orderby").setParseAction(_only_once("orderby", "order_by_action"))
     
-    limit_clause = (LIMIT + Group(Optional(integer + COMMA) + integer)).setResultsName("limit").setParseAction(self.limit_once)
+    limit_clause = (LIMIT + Group(Optional(integer + COMMA) + integer)).setResultsName("limit").setParseAction(_only_once("limit"))
     
     expand_flag = TRUE | FALSE
     facet_order_by = HITS | VALUE
@@ -937,14 +935,14 @@ class BQLParser:
     
     group_by_clause = (GROUP + BY +
                        column_name.setResultsName("groupby") +
-                       Optional(TOP + integer.setResultsName("max_per_group"))).setParseAction(self.group_by_once)
+                       Optional(TOP + integer.setResultsName("max_per_group"))).setParseAction(_only_once("groupby"))
     
     browse_by_clause = (BROWSE + BY +
-                        delimitedList(facet_spec).setResultsName("facet_specs")).setParseAction(self.browse_by_once)
+                        delimitedList(facet_spec).setResultsName("facet_specs")).setParseAction(_only_once("facet_specs"))
     
     fetching_flag = TRUE | FALSE
     fetching_stored_clause = (FETCHING + STORED +
-                              Optional(fetching_flag)).setResultsName("fetching_stored").setParseAction(self.fetching_stored_once)
+                              Optional(fetching_flag)).setResultsName("fetching_stored").setParseAction(_only_once("fetching_stored"))
     
     additional_clause = (order_by_clause
                          | limit_clause
@@ -985,385 +983,97 @@ class BQLParser:
 # End of class BQLParser
 
 
-#
-# Some functions that will be shared by BQL Parser and BQLRequest, etc.
-#
-
-def pred_type(pred):
-  return pred.keys()[0]
-
-def pred_field(pred):
-  return pred.values()[0].keys()[0]
-
-def merge_values(list1, list2):
-  """Merge two selection value lists and dedup.
+class BQLParseContext:
+  """The state of parsing one statement.
 
-  All selection values should be simple value types.
+  A parse gets the current time once, so that all time expressions in a
+  statement agree, and records which clauses it has seen, since ORDER
+  BY, LIMIT, etc. may only appear once.
 
   """
 
-  tmp = list1[:]
-  if not tmp:
-    return list2
-  else:
-    tmp.extend(list2)
-    return list(set(tmp))
+  def __init__(self, parser):
+    self.parser = parser
+    self.time_now = int(time.time() * 1000)
+    self.clauses = set()
 
-def and_ranges(range1, range2):
-  """Try to AND two ranges.
 
-  Return the intersection of two ranges if there is overlap; None otherwise.
+# The context of the parse in progress in each thread
+_local = threading.local()
 
-  """
-  def _max(n1, n2):
-    if n1 == '*':
-      return n2
-    elif n2 == '*':
-      return n1
-    else:
-      val1 = val2 = None
-      try:
-        val1 = int(n1)
-      except:
-        val1 = float(n1)
-      try:
-        val2 = int(n2)
-      except:
-        val2 = float(n2)
-      return str(max(val1, val2))
-
-  def _min(n1, n2):
-    if n1 == '*':
-      return n2
-    elif n2 == '*':
-      return n1
-    else:
-      val1 = val2 = None
-      try:
-        val1 = int(n1)
-      except:
-        val1 = float(n1)
-      try:
-        val2 = int(n2)
-      except:
-        val2 = float(n2)
-      return str(min(val1, val2))
-
-  m1 = RANGE_REGEX.match(range1)
-  (low1, _, high1, _) = m1.groups()
-  m2 = RANGE_REGEX.match(range2)
-  (low2, _, high2, _) = m2.groups()
-
-  low = _max(low1, low2)
-  high = _min(high1, high2)
-
-  if (low != '*' and high != '*'
-      and float(low) > float(high)):
-    return None
-  else:
-    return "[%s TO %s]" % (low, high)
-
-def and_range_list(range_list, range0):
-  new_list = []
-  if not range_list:
-    return new_list
-  for r in range_list:
-    new_r = and_ranges(r, range0)
-    if new_r:
-      new_list.append(new_r)
-    else:
-      return []
-  return new_list
+def _action(name):
+  """Return a parse action calling the named method of the current parser."""
 
+  def _call(s, loc, tok):
+    return getattr(_local.context.parser, name)(s, loc, tok)
+  return _call
 
-class BQLRequest:
-  """A Sensei request with a BQL statement.
+def _only_once(clause, name=None):
+  """Return a parse action that fails if a clause appears more than once."""
 
-  The BQL statement can be one of the following statements:
+  def _call(s, loc, tok):
+    context = _local.context
+    if clause in context.clauses:
+      raise ParseException(s, loc, "")
+    if name:
+      getattr(context.parser, name)(s, loc, tok)
+    context.clauses.add(clause)
+    return tok
+  return _call
 
-  1. SELECT
-  2. DESCRIBE
+_grammar = None
+_grammar_lock = threading.Lock()
 
-  """
-
-  def __init__(self, tokens, facet_map):
-    self.tokens = tokens
-    self.facet_map = facet_map
-    self.query = ""
-    self.selections = None
-    self.selection_list = []
-    self.filter = None
-    self.query_pred = None
-    self.sorts = None
-    self.columns = [safe_str(col) for col in self.tokens.columns]
-    self.facet_init_param_map = None
-
-    if self.tokens.describe:
-      self.stmt_type = "desc"
-    else:
-      self.stmt_type = "select"
+# pyparsing keeps state of its own while parsing: the packrat cache is
+# global, and each grammar element raises the same exception object every
+# time it fails to match.  Parses through the shared grammar therefore take
+# turns.  Under the GIL this costs no throughput; the "fast" engine has no
+# such state and needs no lock.
+_grammar_parse_lock = threading.RLock()
 
-    where = self.tokens.where
-    if where:
-      assert type(where) == dict
-      self._extract_query_filter_selections(where)
+def _parse_shared_grammar(grammar, bql_stmt):
+  """Parse bql_stmt with the shared grammar, one thread at a time."""
 
-      # if where[0].get(JSON_PARAM_QUERY):
-      #   self.query_pred = where[0].get(JSON_PARAM_QUERY)
-      #   where[0].pop(JSON_PARAM_QUERY)
-    
-      # if where.predicates:
-      #   for predicate in where.predicates:
-      #     if predicate.query_pred:
-      #       self.query = predicate[2]
-      #     else:
-      #       selection = build_selection(predicate)
-      #       if selection:
-      #         self.selection_list.append(selection)
-      # elif where.cumulative_preds:
-      #   selection = collapse_cumulative_preds(where.cumulative_preds)
-      #   self.selection_list.append(selection)
-
-  def _extract_query_filter_selections(self, where):
-    """Extract the query and filter information from the where clause."""
-
-    filter_list = []
-    if where.get(JSON_PARAM_QUERY):
-      self.query_pred = where
-      self.filter = None
-    elif where.get("and"):
-      preds = where.get("and")
-      for pred in preds:
-        if pred.get(JSON_PARAM_QUERY):
-          # If there is no query yet, use predicate as a query; otherwise,
-          # treat this predicate as a regular filter.
-          if not self.query_pred:
-            self.query_pred = pred
-          else:
-            filter_list.append(pred)
-        elif pred.get("or") or pred.get("and") or pred.get("bool"):
-          # XXX Need to clear this part
-          filter_list.append(pred)
-        elif self._is_facet(pred_field(pred)):
-          self.selection_list.append(pred)
-        else:
-          filter_list.append(pred)
-      if len(filter_list) == 1:
-        self.filter = filter_list[0]
-      elif filter_list:
-        self.filter = {"and": filter_list}
-    elif where.get("or"):
-      self.filter = where
-    elif self._is_facet(pred_field(where)):
-      self.selection_list.append(where)
-    elif where:
-      self.filter = where
-
-    # XXX Do merging, etc. on self.selection_list
-    self.selections = self.selection_list
-
-  def _is_facet(self, pred_field):
-    """Check if a field is a facet."""
-
-    return self.facet_map.has_key(pred_field)
-
-  def get_stmt_type(self):
-    """Get the statement type."""
-
-    return self.stmt_type
-
-  def get_offset(self):
-    """Get the offset."""
-
-    limit = self.tokens.limit
-    if limit:
-      if len(limit[1]) == 2:
-        return limit[1][0]
-      else:
-        return None
-    else:
-      return None
-
-  def get_count(self):
-    """Get the count (default 10)."""
-
-    limit = self.tokens.limit
-    if limit:
-      if len(limit[1]) == 2:
-        return limit[1][1]
-      else:
-        return limit[1][0]
-    else:
-      return None
-
-  def get_index(self):
-    """Get the index (i.e. table) name."""
-
-    return self.tokens.index
-
-  def get_columns(self):
-    """Get the list of selected columns."""
-
-    return self.columns
-
-  def get_query(self):
-    """Get the query string."""
-
-    return self.query
-
-  def get_sorts(self):
-    """Get the SenseiSort array base on ORDER BY."""
-
-    if self.sorts:
-      return self.sorts
-
-    self.sorts = []
-    orderby = self.tokens.orderby
-    if orderby:
-      orderby_spec = orderby.orderby_spec
-      for spec in orderby_spec:
-        if len(spec) == 1:
-          self.sorts.append(SenseiSort(spec[0]))
-        else:
-          self.sorts.append(SenseiSort(spec[0], spec[1] == "desc"))
-    return self.sorts
-
-  def merge_selections(self):
-    """Merge all selections and detect conflicts."""
-
-    # TODO finish the implementation
-    self.selections = self.selection_list
-
-  # def merge_selections_old(self):
-  #   """Merge all selections and detect conflicts."""
-  # 
-  #   self.selections = {}
-  #   for selection in self.selection_list:
-  #     existing = self.selections.get(selection.field)
-  #     if existing:
-  #       # Try to merge simple range predicates
-  #       if (len(selection.getValues()) == 1 and
-  #           selection.getType() == SELECTION_TYPE_RANGE and
-  #           existing.getType() == SELECTION_TYPE_RANGE):
-  #         new_values = and_range_list(existing.getValues(), selection.getValues()[0])
-  #         if not new_values:
-  #           raise SenseiClientError("There is conflict in selection(s) for column '%s'" % selection.field)
-  #         existing.setValues(new_values)
-  #       else:
-  #         # Don't bother trying to merge predicates
-  #         if existing.getValues() and selection.getValues():
-  #           return False, "There is conflict in selection(s) for column '%s'" % selection.field
-  #         if selection.getValues():
-  #           existing.setValues(selection.getValues())
-  #         if selection.getExcludes():
-  #           existing.setExcludes(merge_values(existing.getExcludes(),
-  #                                           selection.getExcludes()))
-  #       # XXX How about props?
-  #     else:
-  #       self.selections[selection.field] = selection
-  #   return True, None
-
-  def get_selections(self):
-    """Get all the selections from in statement."""
-
-    # if self.selections == None:
-    #   self.merge_selections()
-    return self.selections
-
-  def get_filter(self):
-    """Get the filter from the statement."""
-
-    return self.filter
-
-  def get_query_pred(self):
-    """Get the QUERY predicate."""
-    return self.query_pred
-
-  def get_facets(self):
-    """Get facet specs."""
-
-    facet_specs = self.tokens.facet_specs
-    if not facet_specs:
-      return {}
-    facets = {}
-    for spec in facet_specs:
-      facet = None
-      if len(spec) == 1:
-        facet = SenseiFacet(False,
-                            DEFAULT_FACET_MINHIT,
-                            DEFAULT_FACET_MAXHIT,
-                            DEFAULT_FACET_ORDER)
-      else:
-        facet = SenseiFacet(spec[1] == "true",
-                            spec[2],
-                            spec[3],
-                            spec[4] == "hits" and PARAM_FACET_ORDER_HITS or PARAM_FACET_ORDER_VAL)
-      facets[spec[0]] = facet
-    return facets
-
-  def get_groupby(self):
-    """Get group by facet name."""
-
-    if self.tokens.groupby:
-      return self.tokens.groupby[0]
-    else:
-      return None
-
-  def get_max_per_group(self):
-    """Get max_per_group value."""
-
-    if self.tokens.max_per_group:
-      return self.tokens.max_per_group
-    else:
-      return None
+  _grammar_parse_lock.acquire()
+  try:
+    try:
+      return grammar.parseString(bql_stmt, parseAll=True)
+    except ParseException, err:
+      # Hand out a copy: err may be reused by the next parse
+      raise ParseException(err.pstr, err.loc, err.msg, err.parserElement)
+  finally:
+    _grammar_parse_lock.release()
+
+def get_bql_grammar():
+  """Return the BQL grammar, building it the first time it is needed.
+
+  Building the grammar is expensive, so it is done once per process and
+  the result is shared by all parsers.  A sample statement is parsed right
+  away: pyparsing does some one-time work (such as streamlining the
+  grammar) on the first parse, which should not slow down a real query.
+  The sample only uses columns that are not facets.  Packrat parsing is
+  turned on for the whole process here, unless PACKRAT_PARSING is False.
 
-  def get_fetching_stored(self):
-    """Get the fetching-stored flag."""
+  """
 
-    fetching_stored = self.tokens.fetching_stored
-    if (not fetching_stored or
-        len(fetching_stored) == 2 or
-        fetching_stored[2] == "true"):
-      return True
-    else:
-      return False
-
-  def get_facet_init_param_map(self):
-    """Get run-time facet handler initialization parameters."""
-
-    if self.facet_init_param_map:
-      return self.facet_init_param_map
-
-    self.facet_init_param_map = {}
-    given = self.tokens.given
-    if given:
-      for param in given.facet_param:
-        facet = param[0]
-        name = param[1]
-        param_type = param[2]
-        value = param[3]
-        init_params = None
-
-        if self.facet_init_param_map.has_key(facet):
-          init_params = self.facet_init_param_map[facet]
-        else:
-          init_params = SenseiFacetInitParams()
-          self.facet_init_param_map[facet] = init_params
-
-        if param_type == "boolean":
-          init_params.put_bool_param(name, value)
-        elif param_type == "int":
-          init_params.put_int_param(name, value)
-        elif param_type == "long":
-          init_params.put_long_param(name, value)
-        elif param_type == "string":
-          init_params.put_string_param(name, value)
-        elif param_type == "bytearray":
-          init_params.put_byte_param(name, value)
-        elif param_type == "double":
-          init_params.put_double_param(name, value)
-
-    return self.facet_init_param_map
+  global _grammar
+  if _grammar is None:
+    _grammar_lock.acquire()
+    try:
+      if _grammar is None:
+        if PACKRAT_PARSING:
+          ParserElement.enablePackrat()
+        grammar = BQLParser._build_parser()
+        # Any parser can run the actions; the fast one needs no grammar
+        _local.context = BQLParseContext(BQLParser({}, engine="fast"))
+        try:
+          grammar.parseString(WARM_UP_STMT, parseAll=True)
+        finally:
+          _local.context = None
+        _grammar = grammar
+    finally:
+      _grammar_lock.release()
+  return _grammar
 
 
 def test(str):
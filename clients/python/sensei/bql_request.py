@@ -0,0 +1,691 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""BQL requests, and the helpers that work on statement text.
+
+Nothing here needs the BQL grammar, so clients that send statements or
+requests they already have do not load pyparsing.  BQLRequest builds
+Sensei requests from the tokens a BQLParser (see bql_parser) returns.
+
+"""
+
+import json
+import re
+
+from sensei_components import *
+
+# Parser engine used by BQLParser unless another one is requested
+DEFAULT_PARSER_ENGINE = "fast"
+
+# Lexical pieces of a BQL statement, used to normalize statement text
+# without running the full grammar: quoted strings, comments, whitespace
+# and everything else.
+BQL_LEXEME_REGEX = re.compile(r'''("(?:[^"\\]|\\.|"")*"|'(?:[^'\\]|\\.|'')*')|(--[^\n]*)|(\s+)|([^\s"'-]+|-)''')
+
+# Keywords whose meaning depends on the time a statement is parsed
+TIME_RELATIVE_REGEX = re.compile(r'''\b(now|ago|last)\b''', re.IGNORECASE)
+
+# Bind variables, such as $color (a "$" inside an identifier does not count)
+VARIABLE_REGEX = re.compile(r'''(?<![\w.$-])\$([A-Za-z_]\w*)''')
+
+
+class BQLVariable:
+  """A bind variable, such as $color, in a BQL statement.
+
+  The value of a variable is supplied when a prepared statement is
+  executed.  While parsing, the parser records the column type the value
+  must have, and whether the variable stands for a whole value list, as
+  in "color IN ($colors)".
+
+  """
+
+  def __init__(self, name):
+    self.name = name
+    self.column_type = None
+    self.is_list = False
+
+  def __repr__(self):
+    return "$" + self.name
+
+
+#
+# Some functions that will be shared by BQL Parser and BQLRequest, etc.
+#
+
+def normalize_bql(bql_stmt):
+  """Normalize the text of a BQL statement.
+
+  Comments are dropped, runs of whitespace outside of quoted strings are
+  collapsed into a single space, and leading/trailing whitespace and a
+  trailing semicolon are removed.  Statements that only differ in these
+  respects parse into the same request.
+
+  """
+
+  pieces = []
+  for quoted, comment, space, other in BQL_LEXEME_REGEX.findall(bql_stmt):
+    if quoted or other:
+      pieces.append(quoted or other)
+    elif pieces and pieces[-1] != ' ':
+      pieces.append(' ')
+  stmt = ''.join(pieces).strip()
+  if stmt.endswith(';'):
+    stmt = stmt[:-1].rstrip()
+  return stmt
+
+def is_time_relative(bql_stmt):
+  """Check whether a statement refers to the time it is parsed at.
+
+  NOW, AGO and IN LAST are converted into absolute times during parsing,
+  so the result of parsing such a statement must not be reused later.
+
+  """
+
+  for quoted, comment, space, other in BQL_LEXEME_REGEX.findall(bql_stmt):
+    if other and TIME_RELATIVE_REGEX.search(other):
+      return True
+  return False
+
+def get_bql_variables(bql_stmt):
+  """Get the names of the bind variables used in a statement."""
+
+  names = set()
+  for quoted, comment, space, other in BQL_LEXEME_REGEX.findall(bql_stmt):
+    if other:
+      names.update(VARIABLE_REGEX.findall(other))
+  return names
+
+def pred_type(pred):
+  return pred.keys()[0]
+
+def pred_field(pred):
+  return pred.values()[0].keys()[0]
+
+def range_has_variable(pred):
+  spec = pred.values()[0].values()[0]
+  return (isinstance(spec.get("from"), BQLVariable) or
+          isinstance(spec.get("to"), BQLVariable))
+
+def merge_values(list1, list2):
+  """Merge two selection value lists and dedup.
+
+  All selection values should be simple value types.
+
+  """
+
+  tmp = list1[:]
+  if not tmp:
+    return list2
+  else:
+    tmp.extend(list2)
+    return list(set(tmp))
+
+def and_ranges(range1, range2):
+  """Try to AND two ranges.
+
+  Return the intersection of two ranges if there is overlap; None otherwise.
+
+  """
+  def _max(n1, n2):
+    if n1 == '*':
+      return n2
+    elif n2 == '*':
+      return n1
+    else:
+      val1 = val2 = None
+      try:
+        val1 = int(n1)
+      except:
+        val1 = float(n1)
+      try:
+        val2 = int(n2)
+      except:
+        val2 = float(n2)
+      return str(max(val1, val2))
+
+  def _min(n1, n2):
+    if n1 == '*':
+      return n2
+    elif n2 == '*':
+      return n1
+    else:
+      val1 = val2 = None
+      try:
+        val1 = int(n1)
+      except:
+        val1 = float(n1)
+      try:
+        val2 = int(n2)
+      except:
+        val2 = float(n2)
+      return str(min(val1, val2))
+
+  m1 = RANGE_REGEX.match(range1)
+  (low1, _, high1, _) = m1.groups()
+  m2 = RANGE_REGEX.match(range2)
+  (low2, _, high2, _) = m2.groups()
+
+  low = _max(low1, low2)
+  high = _min(high1, high2)
+
+  if (low != '*' and high != '*'
+      and float(low) > float(high)):
+    return None
+  else:
+    return "[%s TO %s]" % (low, high)
+
+def and_range_list(range_list, range0):
+  new_list = []
+  if not range_list:
+    return new_list
+  for r in range_list:
+    new_r = and_ranges(r, range0)
+    if new_r:
+      new_list.append(new_r)
+    else:
+      return []
+  return new_list
+
+def and_range_specs(spec1, spec2):
+  """Intersect two range specs, such as {"from": 1, "include_lower": True}.
+
+  Return the spec of the values in both ranges, or None if no value is.
+
+  """
+
+  lower, include_lower = spec1.get("from"), spec1.get("include_lower") or False
+  from2, include2 = spec2.get("from"), spec2.get("include_lower") or False
+  if lower is None or (from2 is not None and from2 > lower):
+    lower, include_lower = from2, include2
+  elif from2 == lower:
+    include_lower = include_lower and include2
+
+  upper, include_upper = spec1.get("to"), spec1.get("include_upper") or False
+  to2, include2 = spec2.get("to"), spec2.get("include_upper") or False
+  if upper is None or (to2 is not None and to2 < upper):
+    upper, include_upper = to2, include2
+  elif to2 == upper:
+    include_upper = include_upper and include2
+
+  if lower is not None and upper is not None:
+    if lower > upper or (lower == upper and not (include_lower and include_upper)):
+      return None
+  return _range_spec(lower, include_lower, upper, include_upper)
+
+def or_range_specs(spec1, spec2):
+  """Unite two range specs.
+
+  Return the spec of the values in either range, or None if the union
+  is not a single range (the ranges neither overlap nor touch).
+
+  """
+
+  if spec1.get("from") is not None and (spec2.get("from") is None or
+                                        spec2["from"] < spec1["from"]):
+    spec1, spec2 = spec2, spec1
+  # spec1 now starts first
+  to1, from2 = spec1.get("to"), spec2.get("from")
+  if to1 is not None and from2 is not None:
+    if to1 < from2 or (to1 == from2 and not (spec1.get("include_upper") or
+                                              spec2.get("include_lower"))):
+      return None
+
+  lower, include_lower = spec1.get("from"), spec1.get("include_lower") or False
+  if lower is not None and lower == from2:
+    include_lower = include_lower or spec2.get("include_lower") or False
+
+  upper, include_upper = to1, spec1.get("include_upper") or False
+  to2, include2 = spec2.get("to"), spec2.get("include_upper") or False
+  if upper is not None:
+    if to2 is None or to2 > upper:
+      upper, include_upper = to2, include2
+    elif to2 == upper:
+      include_upper = include_upper or include2
+  return _range_spec(lower, include_lower, upper, include_upper)
+
+def _range_spec(lower, include_lower, upper, include_upper):
+  spec = {}
+  if lower is not None:
+    spec["from"] = lower
+    spec["include_lower"] = include_lower
+  if upper is not None:
+    spec["to"] = upper
+    spec["include_upper"] = include_upper
+  return spec
+
+# Column types whose values are integers, so that "x > 1" is "x >= 2"
+INTEGER_COLUMN_TYPES = set(["int", "long", "short"])
+
+def _pred_key(value):
+  """Sort key that orders predicates and values the same way every time."""
+
+  return json.dumps(value, sort_keys=True, default=lambda var: "$" + var.name)
+
+def _sorted_unique(values):
+  keyed = dict((_pred_key(value), value) for value in values)
+  return [keyed[key] for key in sorted(keyed)]
+
+def _normalize_range(pred, facet_map):
+  field = pred_field(pred)
+  spec = pred.values()[0].values()[0]
+  if range_has_variable(pred):
+    return pred
+  lower, include_lower = spec.get("from"), spec.get("include_lower") or False
+  upper, include_upper = spec.get("to"), spec.get("include_upper") or False
+  facet_info = facet_map and facet_map.get(field)
+  if facet_info and facet_info.get_props().get("column_type") in INTEGER_COLUMN_TYPES:
+    # Exclusive integer bounds become inclusive ones
+    if isinstance(lower, (int, long)) and not include_lower:
+      lower, include_lower = lower + 1, True
+    if isinstance(upper, (int, long)) and not include_upper:
+      upper, include_upper = upper - 1, True
+  return {"range": {field: _range_spec(lower, include_lower, upper, include_upper)}}
+
+def _fold_preds(op, preds):
+  """Fold the ranges, and the terms that can be, on the same field into one predicate."""
+
+  folded = []
+  by_field = {}
+  for pred in preds:
+    kind = pred_type(pred)
+    if kind not in ("range", "terms") or (kind == "range" and range_has_variable(pred)):
+      folded.append(pred)
+      continue
+    key = (kind, pred_field(pred))
+    i = by_field.get(key)
+    merged = None
+    if i is not None:
+      if kind == "range":
+        merged = _fold_ranges(op, folded[i], pred)
+      else:
+        merged = _fold_terms(op, folded[i], pred)
+    if merged is None:
+      by_field[key] = len(folded)
+      folded.append(pred)
+    else:
+      folded[i] = merged
+  return folded
+
+def _fold_ranges(op, pred1, pred2):
+  field = pred_field(pred1)
+  spec1 = pred1.values()[0].values()[0]
+  spec2 = pred2.values()[0].values()[0]
+  if op == "and":
+    spec = and_range_specs(spec1, spec2)
+  else:
+    spec = or_range_specs(spec1, spec2)
+  if spec is None:
+    return None
+  return {"range": {field: spec}}
+
+def _fold_terms(op, pred1, pred2):
+  field = pred_field(pred1)
+  spec1 = pred1.values()[0].values()[0]
+  spec2 = pred2.values()[0].values()[0]
+  for spec in (spec1, spec2):
+    if (spec.get(JSON_PARAM_OPERATOR) != PARAM_SELECT_OP_OR or
+        spec.get(JSON_PARAM_NO_OPTIMIZE) != spec1.get(JSON_PARAM_NO_OPTIMIZE)):
+      return None
+  values1, values2 = spec1.get(JSON_PARAM_VALUES), spec2.get(JSON_PARAM_VALUES)
+  excludes1, excludes2 = spec1.get(JSON_PARAM_EXCLUDES), spec2.get(JSON_PARAM_EXCLUDES)
+  spec = dict(spec1)
+  if op == "and":
+    # "x IN (a, b) AND x <> c" is "x IN (a, b) EXCEPT (c)", but two value
+    # lists cannot be intersected for multi-valued columns.
+    if values1 and values2:
+      return None
+    spec[JSON_PARAM_VALUES] = _sorted_unique((values1 or []) + (values2 or []))
+    spec[JSON_PARAM_EXCLUDES] = _sorted_unique((excludes1 or []) + (excludes2 or []))
+  else:
+    if excludes1 or excludes2 or not values1 or not values2:
+      return None
+    spec[JSON_PARAM_VALUES] = _sorted_unique(values1 + values2)
+  return {"terms": {field: spec}}
+
+def normalize_pred(pred, facet_map=None):
+  """Return the canonical form of a predicate tree built by the BQL parser.
+
+  Predicates that only differ in ways that do not change their meaning
+  get the same canonical form: the children of AND and OR are flattened,
+  folded, deduplicated and sorted, value lists are deduplicated and
+  sorted, ranges on the same column are folded (intersected under AND,
+  united under OR, as "NOT BETWEEN" gives), and exclusive bounds on
+  integer columns are made inclusive.  The predicate is not modified.
+
+  facet_map maps column names to SenseiFacetInfo, and gives column types.
+
+  """
+
+  kind = pred_type(pred)
+  if kind in ("and", "or"):
+    children = []
+    for child in pred[kind]:
+      child = normalize_pred(child, facet_map)
+      if pred_type(child) == kind:
+        children.extend(child[kind])
+      else:
+        children.append(child)
+    children = _sorted_unique(_fold_preds(kind, children))
+    if len(children) == 1:
+      return children[0]
+    return {kind: children}
+  elif kind == "range":
+    return _normalize_range(pred, facet_map)
+  elif kind == "terms":
+    field = pred_field(pred)
+    spec = dict(pred[kind][field])
+    for name in (JSON_PARAM_VALUES, JSON_PARAM_EXCLUDES):
+      if spec.get(name):
+        spec[name] = _sorted_unique(spec[name])
+    return {kind: {field: spec}}
+  return pred
+
+def normalize_preds(preds, facet_map=None):
+  """Return the canonical form of a list of ANDed predicates, such as selections."""
+
+  if not preds:
+    return preds
+  pred = normalize_pred({"and": preds}, facet_map)
+  if pred_type(pred) == "and":
+    return pred["and"]
+  return [pred]
+
+
+class BQLRequest:
+  """A Sensei request with a BQL statement.
+
+  The BQL statement can be one of the following statements:
+
+  1. SELECT
+  2. DESCRIBE
+
+  """
+
+  def __init__(self, tokens, facet_map):
+    self.tokens = tokens
+    self.facet_map = facet_map
+    self.query = ""
+    self.selections = None
+    self.selection_list = []
+    self.filter = None
+    self.query_pred = None
+    self.sorts = None
+    self.columns = [safe_str(col) for col in self.tokens.columns]
+    self.facet_init_param_map = None
+
+    if self.tokens.describe:
+      self.stmt_type = "desc"
+    else:
+      self.stmt_type = "select"
+
+    where = self.tokens.where
+    if where:
+      assert type(where) == dict
+      self._extract_query_filter_selections(where)
+
+      # if where[0].get(JSON_PARAM_QUERY):
+      #   self.query_pred = where[0].get(JSON_PARAM_QUERY)
+      #   where[0].pop(JSON_PARAM_QUERY)
+    
+      # if where.predicates:
+      #   for predicate in where.predicates:
+      #     if predicate.query_pred:
+      #       self.query = predicate[2]
+      #     else:
+      #       selection = build_selection(predicate)
+      #       if selection:
+      #         self.selection_list.append(selection)
+      # elif where.cumulative_preds:
+      #   selection = collapse_cumulative_preds(where.cumulative_preds)
+      #   self.selection_list.append(selection)
+
+  def _extract_query_filter_selections(self, where):
+    """Extract the query and filter information from the where clause."""
+
+    filter_list = []
+    if where.get(JSON_PARAM_QUERY):
+      self.query_pred = where
+      self.filter = None
+    elif where.get("and"):
+      preds = where.get("and")
+      for pred in preds:
+        if pred.get(JSON_PARAM_QUERY):
+          # If there is no query yet, use predicate as a query; otherwise,
+          # treat this predicate as a regular filter.
+          if not self.query_pred:
+            self.query_pred = pred
+          else:
+            filter_list.append(pred)
+        elif pred.get("or") or pred.get("and") or pred.get("bool"):
+          # XXX Need to clear this part
+          filter_list.append(pred)
+        elif self._is_facet(pred_field(pred)):
+          self.selection_list.append(pred)
+        else:
+          filter_list.append(pred)
+      if len(filter_list) == 1:
+        self.filter = filter_list[0]
+      elif filter_list:
+        self.filter = {"and": filter_list}
+    elif where.get("or"):
+      self.filter = where
+    elif self._is_facet(pred_field(where)):
+      self.selection_list.append(where)
+    elif where:
+      self.filter = where
+
+    # XXX Do merging, etc. on self.selection_list
+    self.selections = self.selection_list
+
+  def _is_facet(self, pred_field):
+    """Check if a field is a facet."""
+
+    return self.facet_map.has_key(pred_field)
+
+  def get_stmt_type(self):
+    """Get the statement type."""
+
+    return self.stmt_type
+
+  def get_offset(self):
+    """Get the offset."""
+
+    limit = self.tokens.limit
+    if limit:
+      if len(limit[1]) == 2:
+        return limit[1][0]
+      else:
+        return None
+    else:
+      return None
+
+  def get_count(self):
+    """Get the count (default 10)."""
+
+    limit = self.tokens.limit
+    if limit:
+      if len(limit[1]) == 2:
+        return limit[1][1]
+      else:
+        return limit[1][0]
+    else:
+      return None
+
+  def get_index(self):
+    """Get the index (i.e. table) name."""
+
+    return self.tokens.index
+
+  def get_columns(self):
+    """Get the list of selected columns."""
+
+    return self.columns
+
+  def get_query(self):
+    """Get the query string."""
+
+    return self.query
+
+  def get_sorts(self):
+    """Get the SenseiSort array base on ORDER BY."""
+
+    if self.sorts:
+      return self.sorts
+
+    self.sorts = []
+    orderby = self.tokens.orderby
+    if orderby:
+      orderby_spec = orderby.orderby_spec
+      for spec in orderby_spec:
+        if len(spec) == 1:
+          self.sorts.append(SenseiSort(spec[0]))
+        else:
+          self.sorts.append(SenseiSort(spec[0], spec[1] == "desc"))
+    return self.sorts
+
+  def merge_selections(self):
+    """Merge all selections and detect conflicts."""
+
+    # TODO finish the implementation
+    self.selections = self.selection_list
+
+  # def merge_selections_old(self):
+  #   """Merge all selections and detect conflicts."""
+  # 
+  #   self.selections = {}
+  #   for selection in self.selection_list:
+  #     existing = self.selections.get(selection.field)
+  #     if existing:
+  #       # Try to merge simple range predicates
+  #       if (len(selection.getValues()) == 1 and
+  #           selection.getType() == SELECTION_TYPE_RANGE and
+  #           existing.getType() == SELECTION_TYPE_RANGE):
+  #         new_values = and_range_list(existing.getValues(), selection.getValues()[0])
+  #         if not new_values:
+  #           raise SenseiClientError("There is conflict in selection(s) for column '%s'" % selection.field)
+  #         existing.setValues(new_values)
+  #       else:
+  #         # Don't bother trying to merge predicates
+  #         if existing.getValues() and selection.getValues():
+  #           return False, "There is conflict in selection(s) for column '%s'" % selection.field
+  #         if selection.getValues():
+  #           existing.setValues(selection.getValues())
+  #         if selection.getExcludes():
+  #           existing.setExcludes(merge_values(existing.getExcludes(),
+  #                                           selection.getExcludes()))
+  #       # XXX How about props?
+  #     else:
+  #       self.selections[selection.field] = selection
+  #   return True, None
+
+  def get_selections(self):
+    """Get all the selections from in statement."""
+
+    # if self.selections == None:
+    #   self.merge_selections()
+    return self.selections
+
+  def get_filter(self):
+    """Get the filter from the statement."""
+
+    return self.filter
+
+  def get_query_pred(self):
+    """Get the QUERY predicate."""
+    return self.query_pred
+
+  def get_facets(self):
+    """Get facet specs."""
+
+    facet_specs = self.tokens.facet_specs
+    if not facet_specs:
+      return {}
+    facets = {}
+    for spec in facet_specs:
+      facet = None
+      if len(spec) == 1:
+        facet = SenseiFacet(False,
+                            DEFAULT_FACET_MINHIT,
+                            DEFAULT_FACET_MAXHIT,
+                            DEFAULT_FACET_ORDER)
+      else:
+        facet = SenseiFacet(spec[1] == "true",
+                            spec[2],
+                            spec[3],
+                            spec[4] == "hits" and PARAM_FACET_ORDER_HITS or PARAM_FACET_ORDER_VAL)
+      facets[spec[0]] = facet
+    return facets
+
+  def get_groupby(self):
+    """Get group by facet name."""
+
+    if self.tokens.groupby:
+      return self.tokens.groupby[0]
+    else:
+      return None
+
+  def get_max_per_group(self):
+    """Get max_per_group value."""
+
+    if self.tokens.max_per_group:
+      return self.tokens.max_per_group
+    else:
+      return None
+
+  def get_fetching_stored(self):
+    """Get the fetching-stored flag."""
+
+    fetching_stored = self.tokens.fetching_stored
+    if (not fetching_stored or
+        len(fetching_stored) == 2 or
+        fetching_stored[2] == "true"):
+      return True
+    else:
+      return False
+
+  def get_facet_init_param_map(self):
+    """Get run-time facet handler initialization parameters."""
+
+    if self.facet_init_param_map:
+      return self.facet_init_param_map
+
+    self.facet_init_param_map = {}
+    given = self.tokens.given
+    if given:
+      for param in given.facet_param:
+        facet = param[0]
+        name = param[1]
+        param_type = param[2]
+        value = param[3]
+        init_params = None
+
+        if self.facet_init_param_map.has_key(facet):
+          init_params = self.facet_init_param_map[facet]
+        else:
+          init_params = SenseiFacetInitParams()
+          self.facet_init_param_map[facet] = init_params
+
+        if param_type == "boolean":
+          init_params.put_bool_param(name, value)
+        elif param_type == "int":
+          init_params.put_int_param(name, value)
+        elif param_type == "long":
+          init_params.put_long_param(name, value)
+        elif param_type == "string":
+          init_params.put_string_param(name, value)
+        elif param_type == "bytearray":
+          init_params.put_byte_param(name, value)
+        elif param_type == "double":
+          init_params.put_double_param(name, value)
+
+    return self.facet_init_param_map
@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Asynchronous Python client library for Sensei, built on Twisted.
+
+AsyncSenseiClient has the same methods as SenseiClient, but never blocks:
+every call returns a Deferred, and requests share a pool of persistent
+connections managed by the reactor.
+"""
+
+import json
+import logging
+from datetime import datetime
+from StringIO import StringIO
+
+from twisted.internet import defer
+from twisted.python import failure
+from twisted.web import error
+from twisted.web.client import Agent, HTTPConnectionPool, FileBodyProducer, readBody, \
+    ContentDecoderAgent, GzipDecoder
+from twisted.web.http_headers import Headers
+
+from bql_request import BQLRequest, DEFAULT_PARSER_ENGINE
+from sensei_codec import get_codec
+from sensei_components import *
+from sensei_client import SenseiClient
+from sensei_transport import USER_AGENT, DEFAULT_POOL_MAX_SIZE, DEFAULT_POOL_IDLE_TIMEOUT
+
+logger = logging.getLogger("sensei_async_client")
+
+# Default number of queries execute_many() keeps in flight
+DEFAULT_CONCURRENCY = 8
+
+
+class _Flight:
+  """A search request in flight, and the Deferreds of the queries waiting for it.
+
+  The request is cancelled once all the queries waiting for it are.
+
+  """
+
+  def __init__(self, flights, key, request):
+    self.flights = flights
+    self.key = key
+    self.waiters = []
+    self.request = request
+    request.addBoth(self._fire)
+
+  def wait(self):
+    d = defer.Deferred(self._cancel)
+    self.waiters.append(d)
+    return d
+
+  def _done(self):
+    if self.flights.get(self.key) is self:
+      del self.flights[self.key]
+
+  def _cancel(self, d):
+    self.waiters.remove(d)
+    if not self.waiters:
+      self._done()
+      self.request.cancel()
+
+  def _fire(self, result):
+    self._done()
+    waiters, self.waiters = self.waiters, []
+    for waiter in waiters:
+      waiter.callback(result)
+
+
+class AsyncSenseiClient:
+  """Asynchronous Sensei client class.
+
+  The schema is fetched lazily on the first compile() unless sysinfo is
+  given.  A timeout (in seconds) can be set for all requests or passed to
+  each call; a request that times out fails with defer.TimeoutError, and
+  cancelling the Deferred of a request aborts it.
+
+  With coalesce=True, queries made while the same query is in flight
+  wait for its response instead of sending their own request.  The
+  response is decoded once, so their results share their hits.
+
+  """
+
+  def __init__(self, host='localhost', port=8080, path='sensei', sysinfo=None,
+               reactor=None, max_connections=DEFAULT_POOL_MAX_SIZE, timeout=None,
+               parser_engine=DEFAULT_PARSER_ENGINE, codec=None, compression=False,
+               coalesce=False):
+    if reactor is None:
+      from twisted.internet import reactor
+    self.reactor = reactor
+    self.host = host
+    self.port = port
+    self.path = path
+    self.url = 'http://%s:%d/%s' % (self.host, self.port, self.path)
+    self.timeout = timeout
+    self.parser_engine = parser_engine
+    self.codec = get_codec(codec)
+    self.pool = HTTPConnectionPool(reactor, persistent=True)
+    self.pool.maxPersistentPerHost = max_connections
+    self.pool.cachedConnectionTimeout = DEFAULT_POOL_IDLE_TIMEOUT
+    self.agent = Agent(reactor, pool=self.pool)
+    if compression:
+      # Twisted only decodes gzip
+      self.agent = ContentDecoderAgent(self.agent, [("gzip", GzipDecoder)])
+    self.sysinfo = None
+    self.facet_map = None
+    self.parser = None
+    if sysinfo:
+      self._set_sysinfo(SenseiSystemInfo(sysinfo))
+    # Searches in flight, by request body, if coalescing
+    self.flights = None
+    if coalesce:
+      self.flights = {}
+    self.searches = 0                   # Search requests sent
+    self.shared = 0                     # Queries answered by another query's request
+
+  def _set_sysinfo(self, sysinfo):
+    self.sysinfo = sysinfo
+    self.facet_map = {}
+    for facet_info in sysinfo.get_facet_infos():
+      self.facet_map[facet_info.get_name()] = facet_info
+    from bql_parser import BQLParser
+    self.parser = BQLParser(self.facet_map, engine=self.parser_engine)
+    return sysinfo
+
+  def _get_timeout(self, timeout):
+    """Return the timeout of a call: the one given, or the client's."""
+
+    if timeout is None:
+      return self.timeout
+    return timeout
+
+  def _request(self, path, body=None, timeout=None):
+    """Send a request to the broker and fire with the response body.
+
+    The request times out after timeout seconds, unless timeout is None.
+
+    """
+
+    headers = Headers({"User-Agent": [USER_AGENT]})
+    producer = None
+    method = "GET"
+    if body is not None:
+      method = "POST"
+      headers.addRawHeader("Content-Type", "application/x-www-form-urlencoded")
+      producer = FileBodyProducer(StringIO(body))
+    d = self.agent.request(method, self.url + path, headers, producer)
+    d.addCallback(self._read_body)
+
+    # Depending on how far the request got, the agent reports cancellation
+    # as one of several connection errors; always fail with CancelledError.
+    cancelled = []
+    def _cancel(_):
+      cancelled.append(True)
+      d.cancel()
+    def _fire(value):
+      if cancelled:
+        value = failure.Failure(defer.CancelledError())
+      result.callback(value)
+    result = defer.Deferred(_cancel)
+    d.addBoth(_fire)
+    if timeout is not None:
+      result.addTimeout(timeout, self.reactor)
+    return result
+
+  @staticmethod
+  def _read_body(response):
+    d = readBody(response)
+    if response.code >= 400:
+      def _fail(body):
+        raise error.Error(response.code, response.phrase, body)
+      d.addCallback(_fail)
+    return d
+
+  def compile(self, bql_stmt):
+    """Compile a BQL statement into a SenseiRequest."""
+
+    if self.parser:
+      d = defer.succeed(None)
+    else:
+      d = self.get_sysinfo()
+
+    def _compile(_):
+      tokens = self.parser.parse(bql_stmt)
+      if tokens:
+        logger.debug("tokens: %s", tokens)
+        bql_req = BQLRequest(tokens, self.facet_map)
+        return SenseiRequest(bql_req, facet_map=self.facet_map)
+      return None
+    return d.addCallback(_compile)
+
+  def doQuery(self, req, using_json=True, var_map={}, timeout=None):
+    """Execute a search query, firing with a SenseiResult."""
+
+    time1 = datetime.now()
+    if self.flights is not None:
+      key = SenseiClient.buildRequestKey(req, using_json, var_map, self.facet_map)
+    query_string = SenseiClient.buildQueryString(req, using_json, var_map)
+    logger.debug(query_string)
+
+    def _build_result(json_data):
+      res = SenseiResult(json_data, self.codec)
+      delta = datetime.now() - time1
+      res.total_time = delta.seconds * 1000 + delta.microseconds / 1000
+      return res
+    if self.flights is None:
+      self.searches += 1
+      d = self._request("", query_string, self._get_timeout(timeout))
+      d.addCallback(self.codec.decode)
+      return d.addCallback(_build_result)
+
+    flight = self.flights.get(key)
+    if flight is None:
+      self.searches += 1
+      # Each query has its own timeout; the request has none
+      request = self._request("", query_string, None).addCallback(self.codec.decode)
+      flight = self.flights[key] = _Flight(self.flights, key, request)
+    else:
+      self.shared += 1
+    d = flight.wait()
+    timeout = self._get_timeout(timeout)
+    if timeout is not None:
+      d.addTimeout(timeout, self.reactor)
+    return d.addCallback(_build_result)
+
+  def execute_many(self, stmts, concurrency=DEFAULT_CONCURRENCY, timeout=None,
+                   using_json=True, var_map={}):
+    """Execute many queries concurrently.
+
+    At most concurrency queries are in flight at any time.  The returned
+    Deferred fires with the list of SenseiResult objects in the order of
+    stmts; if any query fails, the remaining ones are cancelled and the
+    Deferred fails with that query's error.  Cancelling the returned
+    Deferred cancels all queries.
+
+    """
+
+    sem = defer.DeferredSemaphore(concurrency)
+    queries = [sem.run(self.doQuery, stmt, using_json, var_map, timeout)
+               for stmt in stmts]
+
+    def _cancel_pending(failure):
+      failure.trap(defer.FirstError)
+      for query in queries:
+        if not query.called:
+          query.cancel()
+      return failure.value.subFailure
+
+    d = defer.gatherResults(queries, consumeErrors=True)
+    return d.addErrback(_cancel_pending)
+
+  def get(self, ids, timeout=None):
+    """Get the source data of documents, firing with a {uid: data} dict."""
+
+    body = json.dumps([safe_str(id) for id in ids])
+    return self._request("/get", body, self._get_timeout(timeout)).addCallback(self.codec.decode)
+
+  def get_sysinfo(self, timeout=None):
+    """Get Sensei system info, firing with a SenseiSystemInfo."""
+
+    d = self._request("/sysinfo", None, self._get_timeout(timeout))
+    d.addCallback(self.codec.decode)
+    d.addCallback(SenseiSystemInfo)
+
+    def _update(sysinfo):
+      if self.parser is None:
+        return self._set_sysinfo(sysinfo)
+      self.sysinfo = sysinfo
+      return sysinfo
+    return d.addCallback(_update)
+
+  def get_facet_map(self):
+    return self.facet_map
+
+  def close(self):
+    """Close all persistent connections."""
+
+    return self.pool.closeCachedConnections()
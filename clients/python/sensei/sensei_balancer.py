@@ -0,0 +1,607 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Client-side load balancing over several Sensei brokers.
+
+A BrokerBalancer sends each request to one of a list of brokers, chosen
+by the number of requests in flight or by response time.  Brokers that
+keep failing are ejected for a while, then probed with a sysinfo request
+before they get traffic again.  Failed requests are retried on another
+broker, and a RequestHedger sends a second copy of slow requests to
+another broker: everything the client sends to a broker is a read, so it
+is safe to send twice.
+
+"""
+
+import httplib
+import logging
+import random
+import socket
+import sys
+import threading
+import time
+import urllib2
+import Queue
+from collections import deque
+from datetime import datetime
+
+from sensei_client import SenseiClient
+from sensei_transport import get_connection_pool
+
+logger = logging.getLogger("sensei_balancer")
+
+# Ways of choosing a broker
+POLICY_LEAST_OUTSTANDING = "least_outstanding"
+POLICY_EWMA = "ewma"
+
+DEFAULT_MAX_FAILURES = 3        # Consecutive failures before a broker is ejected
+DEFAULT_EJECT_TIME = 10         # Seconds before an ejected broker is probed
+DEFAULT_RETRY_DEADLINE = 10     # Seconds a request may take, retries included
+DEFAULT_EWMA_WEIGHT = 0.3       # Weight of the latest response time in the average
+MIN_TRY_TIMEOUT = 0.01          # Seconds a try is given, even when the deadline is near
+
+DEFAULT_MAX_HEDGE_RATE = 0.1    # Largest fraction of requests that are hedged
+DEFAULT_LATENCY_WINDOW = 1000   # Response times the hedging percentile is taken over
+HEDGE_MIN_SAMPLES = 20          # Response times needed before hedging by percentile
+HEDGE_DELAY_UPDATE = 16         # Response times between updates of the hedging delay
+
+# Errors after which a request is tried on another broker
+RETRY_ERRORS = (urllib2.URLError, httplib.HTTPException, socket.error)
+
+
+class _Cancelled(Exception):
+  """Raised instead of trying a request that is no longer needed."""
+
+
+class BrokerEndpoint:
+  """A broker and what the balancer knows about it."""
+
+  def __init__(self, host, port, pool=None):
+    self.host = host
+    self.port = port
+    self.pool = pool or get_connection_pool(host, port)
+    self.outstanding = 0                # Requests in flight
+    self.ewma = 0.0                     # Average response time, in seconds
+    self.requests = 0
+    self.failures = 0
+    self.consecutive_failures = 0
+    self.ejections = 0
+    self.ejected_until = None           # Time the broker may be probed, if ejected
+    self.probing = False
+
+  def get_name(self):
+    return "%s:%d" % (self.host, self.port)
+
+  def is_ejected(self):
+    return self.ejected_until is not None
+
+  def __repr__(self):
+    return "<BrokerEndpoint %s>" % self.get_name()
+
+
+def parse_broker(broker):
+  """Turn "host:port" or a (host, port) tuple into a (host, port) tuple."""
+
+  if isinstance(broker, basestring):
+    host, _, port = broker.rpartition(":")
+    return host, int(port)
+  host, port = broker
+  return host, int(port)
+
+
+class BrokerBalancer:
+  """Spread requests over brokers, ejecting and probing failing ones.
+
+  With POLICY_LEAST_OUTSTANDING, the broker with the fewest requests in
+  flight is used; with POLICY_EWMA, the one with the lowest average
+  response time, weighted by its requests in flight.  Ties are broken at
+  random.  A broker is ejected after max_failures consecutive failures;
+  eject_time seconds later, a sysinfo request is sent to it in the
+  background, and it is used again once that succeeds.  If every broker
+  is ejected, they are all used anyway.  A broker that does not answer
+  within timeout seconds (if given) has failed.
+
+  """
+
+  def __init__(self, brokers, path='sensei', policy=POLICY_LEAST_OUTSTANDING,
+               max_failures=DEFAULT_MAX_FAILURES, eject_time=DEFAULT_EJECT_TIME,
+               ewma_weight=DEFAULT_EWMA_WEIGHT, timeout=None):
+    if policy not in (POLICY_LEAST_OUTSTANDING, POLICY_EWMA):
+      raise ValueError("Unknown balancing policy: %s" % policy)
+    self.endpoints = []
+    for broker in brokers:
+      if not isinstance(broker, BrokerEndpoint):
+        broker = BrokerEndpoint(*parse_broker(broker))
+      self.endpoints.append(broker)
+    if not self.endpoints:
+      raise ValueError("No brokers given")
+    self.path = path
+    self.policy = policy
+    self.max_failures = max_failures
+    self.eject_time = eject_time
+    self.ewma_weight = ewma_weight
+    self.timeout = timeout
+    self._lock = threading.Lock()
+
+  def _score(self, endpoint):
+    if self.policy == POLICY_EWMA:
+      return endpoint.ewma * (endpoint.outstanding + 1)
+    return endpoint.outstanding
+
+  def choose(self, exclude=()):
+    """Pick a broker, preferring those not in exclude, and count a request to it."""
+
+    now = time.time()
+    self._lock.acquire()
+    try:
+      candidates = []
+      for endpoint in self.endpoints:
+        if endpoint.is_ejected():
+          if endpoint.ejected_until <= now and not endpoint.probing:
+            self._start_probe(endpoint)
+          continue
+        if endpoint not in exclude:
+          candidates.append(endpoint)
+      if not candidates:
+        # Better to try a broker that may be down than to fail outright
+        candidates = [endpoint for endpoint in self.endpoints
+                      if endpoint not in exclude] or self.endpoints
+      endpoint = min(candidates, key=lambda endpoint: (self._score(endpoint), random.random()))
+      endpoint.outstanding += 1
+      endpoint.requests += 1
+      return endpoint
+    finally:
+      self._lock.release()
+
+  def report_success(self, endpoint, elapsed):
+    """Record that a request chosen by choose() succeeded in elapsed seconds."""
+
+    self._lock.acquire()
+    try:
+      endpoint.outstanding -= 1
+      endpoint.consecutive_failures = 0
+      if endpoint.ewma == 0.0:
+        endpoint.ewma = elapsed
+      else:
+        endpoint.ewma += self.ewma_weight * (elapsed - endpoint.ewma)
+    finally:
+      self._lock.release()
+
+  def report_failure(self, endpoint):
+    """Record that a request chosen by choose() failed."""
+
+    self._lock.acquire()
+    try:
+      endpoint.outstanding -= 1
+      endpoint.failures += 1
+      endpoint.consecutive_failures += 1
+      if endpoint.consecutive_failures >= self.max_failures and not endpoint.is_ejected():
+        logger.warning("Ejecting broker %s after %d failures"
+                       % (endpoint.get_name(), endpoint.consecutive_failures))
+        endpoint.ejections += 1
+        endpoint.ejected_until = time.time() + self.eject_time
+    finally:
+      self._lock.release()
+
+  def report_cancelled(self, endpoint):
+    """Record that a request chosen by choose() was given up on."""
+
+    self._lock.acquire()
+    try:
+      endpoint.outstanding -= 1
+    finally:
+      self._lock.release()
+
+  def _start_probe(self, endpoint):
+    endpoint.probing = True
+    thread = threading.Thread(target=self.probe, args=(endpoint,))
+    thread.daemon = True
+    thread.start()
+
+  def probe(self, endpoint):
+    """Send a sysinfo request to an ejected broker, and restore it if it answers.
+
+    Return whether the broker answered.
+
+    """
+
+    try:
+      endpoint.pool.request("/%s/sysinfo" % self.path, timeout=self.timeout)
+      ok = True
+    except RETRY_ERRORS, err:
+      logger.debug("Probe of broker %s failed: %s" % (endpoint.get_name(), err))
+      ok = False
+    self._lock.acquire()
+    try:
+      endpoint.probing = False
+      if ok:
+        logger.info("Broker %s is back" % endpoint.get_name())
+        endpoint.ejected_until = None
+        endpoint.consecutive_failures = 0
+      else:
+        endpoint.ejected_until = time.time() + self.eject_time
+    finally:
+      self._lock.release()
+    return ok
+
+  def call(self, func, deadline=DEFAULT_RETRY_DEADLINE, exclude=(), is_cancelled=None):
+    """Return func(endpoint, timeout) for a chosen broker, retrying on other brokers.
+
+    A request is retried after network errors and HTTP 5xx errors, on a
+    broker not tried yet, as long as deadline seconds have not passed
+    since the first try.  The last error is raised if no broker answers.
+    Brokers in exclude are only used if all others have been tried.  No
+    more tries are made once is_cancelled() returns true, and an error
+    after that does not count as a failure of the broker.
+
+    func should use timeout as the socket timeout of its request: it is
+    what is left of the deadline, or the timeout of the balancer if less,
+    so that a broker that never answers is given up on in time.
+
+    """
+
+    start = time.time()
+    tried = []
+    while True:
+      if is_cancelled is not None and is_cancelled():
+        raise _Cancelled()
+      endpoint = self.choose(tried + list(exclude))
+      begin = time.time()
+      timeout = start + deadline - begin
+      if self.timeout is not None:
+        timeout = min(timeout, self.timeout)
+      try:
+        result = func(endpoint, max(timeout, MIN_TRY_TIMEOUT))
+      except RETRY_ERRORS, err:
+        if is_cancelled is not None and is_cancelled():
+          # Most likely aborted on purpose
+          self.report_cancelled(endpoint)
+          raise _Cancelled()
+        if isinstance(err, urllib2.HTTPError) and err.code < 500:
+          # The broker is fine; the request is not
+          self.report_success(endpoint, time.time() - begin)
+          raise
+        self.report_failure(endpoint)
+        tried.append(endpoint)
+        if len(tried) >= len(self.endpoints) or time.time() - start >= deadline:
+          raise
+        logger.warning("Request to broker %s failed, retrying: %s" % (endpoint.get_name(), err))
+        continue
+      except:
+        self.report_failure(endpoint)
+        raise
+      self.report_success(endpoint, time.time() - begin)
+      return result
+
+  def get_stats(self):
+    """Return the counters of each broker, keyed by "host:port"."""
+
+    self._lock.acquire()
+    try:
+      stats = {}
+      for endpoint in self.endpoints:
+        stats[endpoint.get_name()] = {"requests": endpoint.requests,
+                                      "outstanding": endpoint.outstanding,
+                                      "failures": endpoint.failures,
+                                      "ejections": endpoint.ejections,
+                                      "ejected": endpoint.is_ejected(),
+                                      "ewma_ms": endpoint.ewma * 1000}
+      return stats
+    finally:
+      self._lock.release()
+
+
+class _HedgeAttempt:
+  """One copy of a hedged request."""
+
+  def __init__(self):
+    self.endpoint = None
+    self.timeout = None                 # Socket timeout of the current try
+    self.conn = None                    # Connection of the request in flight
+    self.done = False
+    self.cancelled = False
+    self._lock = threading.Lock()
+
+  def set_connection(self, conn):
+    """Record the connection the request has, or None once it has given it back."""
+
+    self._lock.acquire()
+    try:
+      self.conn = conn
+    finally:
+      self._lock.release()
+
+  def cancel(self):
+    """Give up on this copy, aborting its request if it is in flight.
+
+    Shutting down the socket makes the request fail at once, instead of
+    holding a thread and a connection until the broker answers or the
+    try times out.  A request that has no socket yet cannot be aborted:
+    it is only bounded by the timeout of its try, and its response is
+    dropped unread.
+
+    """
+
+    self._lock.acquire()
+    try:
+      self.cancelled = True
+      if self.conn is not None and self.conn.sock is not None:
+        try:
+          self.conn.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+          pass
+    finally:
+      self._lock.release()
+
+
+class RequestHedger:
+  """Send a second copy of slow requests to another broker.
+
+  If a request has not been answered after a delay, the same request is
+  sent to another broker, and whichever answer comes first is used.  The
+  delay is given with each request, or is the given percentile of recent
+  response times.  At most max_rate of all requests are hedged.
+
+  """
+
+  def __init__(self, balancer, percentile=None, max_rate=DEFAULT_MAX_HEDGE_RATE,
+               window=DEFAULT_LATENCY_WINDOW):
+    self.balancer = balancer
+    self.percentile = percentile
+    self.max_rate = max_rate
+    self._latencies = deque(maxlen=window)
+    self._new_latencies = 0
+    self._delay = None
+    self._lock = threading.Lock()
+    self.requests = 0
+    self.hedges = 0
+    self.wins = 0                       # Requests answered first by the hedge
+
+  def record(self, elapsed):
+    """Record the response time of a request, in seconds."""
+
+    self._lock.acquire()
+    try:
+      self._latencies.append(elapsed)
+      self._new_latencies += 1
+    finally:
+      self._lock.release()
+
+  def get_delay(self, hedge_after_ms=None):
+    """Return the seconds to wait before hedging, or None not to hedge."""
+
+    if hedge_after_ms is not None:
+      return hedge_after_ms / 1000.0
+    if self.percentile is None:
+      return None
+    self._lock.acquire()
+    try:
+      if len(self._latencies) < HEDGE_MIN_SAMPLES:
+        return None
+      if self._delay is None or self._new_latencies >= HEDGE_DELAY_UPDATE:
+        latencies = sorted(self._latencies)
+        index = min(len(latencies) - 1, int(len(latencies) * self.percentile / 100.0))
+        self._delay = latencies[index]
+        self._new_latencies = 0
+      return self._delay
+    finally:
+      self._lock.release()
+
+  def _take_hedge(self):
+    self._lock.acquire()
+    try:
+      if self.hedges >= self.max_rate * self.requests:
+        return False
+      self.hedges += 1
+      return True
+    finally:
+      self._lock.release()
+
+  def _start(self, func, results, exclude, deadline):
+    attempt = _HedgeAttempt()
+    def _func(endpoint, timeout):
+      attempt.endpoint = endpoint
+      attempt.timeout = timeout
+      return func(endpoint, attempt)
+    def _run():
+      begin = time.time()
+      try:
+        # Once the other copy is answered, this one is not sent again
+        # after a failure
+        value = self.balancer.call(_func, deadline, exclude,
+                                   lambda: attempt.cancelled)
+      except:
+        results.put((attempt, None, sys.exc_info()))
+        return
+      if not attempt.cancelled:
+        self.record(time.time() - begin)
+      results.put((attempt, value, None))
+    thread = threading.Thread(target=_run)
+    thread.daemon = True
+    thread.start()
+    return attempt
+
+  def call(self, func, delay, deadline=DEFAULT_RETRY_DEADLINE):
+    """Return func(endpoint, attempt) for a chosen broker, hedging after delay seconds.
+
+    func should use attempt.timeout as the socket timeout of its request
+    (see BrokerBalancer.call), pass attempt.set_connection as the
+    on_connection of SenseiConnectionPool.urlopen, so that the request
+    can be aborted, and give up early, returning anything, once
+    attempt.cancelled is set: the other copy of the request has been
+    answered.  With a delay of None, the request is not hedged.
+
+    """
+
+    self._lock.acquire()
+    self.requests += 1
+    self._lock.release()
+    if delay is None:
+      attempt = _HedgeAttempt()
+      begin = time.time()
+      def _func(endpoint, timeout):
+        attempt.timeout = timeout
+        return func(endpoint, attempt)
+      value = self.balancer.call(_func, deadline)
+      self.record(time.time() - begin)
+      return value
+
+    results = Queue.Queue()
+    lock = threading.Lock()
+    attempts = [self._start(func, results, (), deadline)]
+    finished = []
+
+    def _hedge():
+      lock.acquire()
+      try:
+        primary = attempts[0]
+        if finished or primary.done or not self._take_hedge():
+          return
+        exclude = primary.endpoint and [primary.endpoint] or []
+        attempts.append(self._start(func, results, exclude, deadline))
+      finally:
+        lock.release()
+
+    # Waiting on the queue with a timeout would poll; a timer does not
+    # slow down requests that are answered in time.
+    timer = threading.Timer(delay, _hedge)
+    timer.daemon = True
+    timer.start()
+    try:
+      while True:
+        attempt, value, exc_info = results.get()
+        lock.acquire()
+        try:
+          attempt.done = True
+          if exc_info is None or not [other for other in attempts if not other.done]:
+            finished.append(attempt)
+            break
+        finally:
+          lock.release()
+    finally:
+      timer.cancel()
+    for other in attempts:
+      if other is not attempt:
+        other.cancel()
+    if exc_info is not None:
+      raise exc_info[0], exc_info[1], exc_info[2]
+    if attempt is not attempts[0]:
+      self._lock.acquire()
+      self.wins += 1
+      self._lock.release()
+    return value
+
+  def get_stats(self):
+    """Return the hedging counters as a dict."""
+
+    self._lock.acquire()
+    try:
+      return {"requests": self.requests,
+              "hedges": self.hedges,
+              "wins": self.wins,
+              "delay_ms": self._delay is not None and self._delay * 1000 or None}
+    finally:
+      self._lock.release()
+
+
+class SenseiMultiBrokerClient(SenseiClient):
+  """A Sensei client that spreads its requests over several brokers.
+
+  brokers is a list of "host:port" strings or (host, port) tuples.  The
+  brokers must serve the same index.  Other keyword arguments are those
+  of SenseiClient.
+
+  Queries can be hedged: sent to a second broker when the first has not
+  answered after hedge_after_ms, or by default after the response time
+  at hedge_percentile of recent queries (if given).  The request to the
+  broker that loses is aborted.
+
+  Each try of a request is given at most timeout seconds (if given) and
+  what is left of retry_deadline, after which the broker has failed and
+  the request is retried on another one.
+
+  """
+
+  def __init__(self, brokers, path='sensei', policy=POLICY_LEAST_OUTSTANDING,
+               max_failures=DEFAULT_MAX_FAILURES, eject_time=DEFAULT_EJECT_TIME,
+               retry_deadline=DEFAULT_RETRY_DEADLINE, hedge_percentile=None,
+               max_hedge_rate=DEFAULT_MAX_HEDGE_RATE, timeout=None, **kwargs):
+    self.balancer = BrokerBalancer(brokers, path, policy, max_failures, eject_time,
+                                   timeout=timeout)
+    self.hedger = RequestHedger(self.balancer, hedge_percentile, max_hedge_rate)
+    self.retry_deadline = retry_deadline
+    first = self.balancer.endpoints[0]
+    SenseiClient.__init__(self, first.host, first.port, path, **kwargs)
+
+  def _urlopen(self, path, data=None):
+    def _open(endpoint, timeout):
+      return endpoint.pool.urlopen(path, data, compression=self.compression,
+                                   compress_request=self.compress_requests, timeout=timeout)
+    return self.balancer.call(_open, self.retry_deadline)
+
+  def _request(self, path, data=None):
+    def _send(endpoint, timeout):
+      return endpoint.pool.request(path, data, compression=self.compression,
+                                   compress_request=self.compress_requests, timeout=timeout)
+    return self.balancer.call(_send, self.retry_deadline)
+
+  def doQuery(self, req, using_json=True, var_map={}, hedge_after_ms=None):
+    """Execute a search query, hedging it if it is slow."""
+
+    key = self._request_key(req, using_json, var_map)
+    query_string = SenseiClient.buildQueryString(req, using_json, var_map)
+    return self._query(req, query_string,
+                       lambda query_string: self._search(query_string, hedge_after_ms), key)
+
+  def doQueryString(self, query_string, hedge_after_ms=None):
+    """Send the body of a search request to a broker, hedging it if it is slow."""
+
+    time1 = datetime.now()
+    return self._make_result(self._search(query_string, hedge_after_ms), time1)
+
+  def _search(self, query_string, hedge_after_ms=None):
+    """Send the body of a search request to a broker and return the response body."""
+
+    def _send(endpoint, attempt):
+      response = endpoint.pool.urlopen("/" + self.path, query_string,
+                                       compression=self.compression,
+                                       compress_request=self.compress_requests,
+                                       timeout=attempt.timeout,
+                                       on_connection=attempt.set_connection)
+      if attempt.cancelled:
+        # Another broker answered first; drop the connection unread
+        response.close()
+        return None
+      return response.read()
+    logger.debug(query_string)
+    delay = self.hedger.get_delay(hedge_after_ms)
+    return self.hedger.call(_send, delay, self.retry_deadline)
+
+  def get_pool_stats(self):
+    """Get the counters of the connection pools, summed over all brokers."""
+
+    totals = {}
+    for endpoint in self.balancer.endpoints:
+      for name, value in endpoint.pool.get_stats().iteritems():
+        totals[name] = totals.get(name, 0) + value
+    return totals
+
+  def get_broker_stats(self):
+    """Get the balancing counters of each broker, keyed by "host:port"."""
+
+    return self.balancer.get_stats()
+
+  def get_hedge_stats(self):
+    """Get the number of queries, of hedged queries and of hedges that won."""
+
+    return self.hedger.get_stats()
@@ -0,0 +1,569 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Caches used by the Sensei client."""
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+
+from sensei_components import SenseiSystemInfo, PARAM_SYSINFO_FACETS, \
+    PARAM_SYSINFO_VERSION, PARAM_SYSINFO_LASTMODIFIED
+
+logger = logging.getLogger("sensei_cache")
+
+# Seconds a broker's schema is used before it is fetched again
+DEFAULT_SCHEMA_TTL = 300
+
+# Bytes of search results kept in memory by a result cache
+DEFAULT_RESULT_CACHE_BYTES = 32 * 1024 * 1024
+
+# Seconds between checks of the lastmodified time of an index
+DEFAULT_VERSION_CHECK_INTERVAL = 1.0
+
+
+class LRUCache:
+  """A bounded, thread-safe least-recently-used cache.
+
+  Once max_size entries are stored, adding a new entry evicts the entry
+  that was used least recently.  Hit, miss and eviction counts are kept
+  for monitoring.
+
+  """
+
+  def __init__(self, max_size):
+    self.max_size = max_size
+    self._entries = OrderedDict()
+    self._lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def get(self, key, default=None):
+    """Return the value for key and mark it as recently used."""
+
+    self._lock.acquire()
+    try:
+      try:
+        value = self._entries.pop(key)
+      except KeyError:
+        self.misses += 1
+        return default
+      self._entries[key] = value
+      self.hits += 1
+      return value
+    finally:
+      self._lock.release()
+
+  def put(self, key, value):
+    """Add or replace the value for key."""
+
+    self._lock.acquire()
+    try:
+      self._entries.pop(key, None)
+      self._entries[key] = value
+      while len(self._entries) > self.max_size:
+        self._entries.popitem(last=False)
+        self.evictions += 1
+    finally:
+      self._lock.release()
+
+  def remove(self, key):
+    """Remove key from the cache if it is there."""
+
+    self._lock.acquire()
+    try:
+      self._entries.pop(key, None)
+    finally:
+      self._lock.release()
+
+  def clear(self):
+    self._lock.acquire()
+    try:
+      self._entries.clear()
+    finally:
+      self._lock.release()
+
+  def __len__(self):
+    return len(self._entries)
+
+  def get_stats(self):
+    """Return the cache counters as a dict."""
+
+    self._lock.acquire()
+    try:
+      return {"hits": self.hits,
+              "misses": self.misses,
+              "evictions": self.evictions,
+              "size": len(self._entries),
+              "max_size": self.max_size}
+    finally:
+      self._lock.release()
+
+
+class SchemaEntry:
+  """The system info of a broker, as fetched at some time."""
+
+  def __init__(self, url, json_data, fetched):
+    self.url = url
+    self.json_data = json_data
+    self.fetched = fetched
+    self.version = json_data.get(PARAM_SYSINFO_VERSION)
+    self.last_modified = json_data.get(PARAM_SYSINFO_LASTMODIFIED)
+    # lastmodified changes with every index update, while what clients
+    # build from the system info only depends on the facets.
+    self.signature = json.dumps(json_data.get(PARAM_SYSINFO_FACETS), sort_keys=True)
+    self._sysinfo = None
+
+  def get_sysinfo(self):
+    if self._sysinfo is None:
+      self._sysinfo = SenseiSystemInfo(self.json_data)
+    return self._sysinfo
+
+
+class SchemaCache:
+  """A cache of broker system infos, keyed by broker URL.
+
+  An entry is used for ttl seconds after it was fetched.  If cache_dir is
+  given, entries are also stored there, so that processes on the same
+  host share them.  With a refresh_interval, a background thread fetches
+  entries again before they expire.  It is started on first use, and
+  again in each process forked after that.
+
+  """
+
+  def __init__(self, ttl=DEFAULT_SCHEMA_TTL, cache_dir=None, refresh_interval=None):
+    self.ttl = ttl
+    self.cache_dir = cache_dir
+    self.refresh_interval = refresh_interval
+    self._entries = {}
+    self._fetchers = {}
+    self._fetch_locks = {}
+    self._lock = threading.Lock()
+    self._refresh_pid = None
+    self._closed = threading.Event()
+    self.hits = 0
+    self.misses = 0
+    self.refreshes = 0
+    self.errors = 0
+
+  def _is_fresh(self, entry, now):
+    return entry is not None and now - entry.fetched < self.ttl
+
+  def peek(self, url):
+    """Return the entry for url, however old, or None."""
+
+    return self._entries.get(url)
+
+  def get(self, url, fetch):
+    """Return a fresh entry for url, calling fetch() to get it if needed.
+
+    fetch returns the system info of the broker as a JSON object.  Only
+    one thread at a time fetches the system info of a broker.
+
+    """
+
+    self._start_refresh()
+    entry = self._entries.get(url)
+    if self._is_fresh(entry, time.time()):
+      self.hits += 1
+      return entry
+
+    self._lock.acquire()
+    try:
+      self._fetchers[url] = fetch
+      fetch_lock = self._fetch_locks.setdefault(url, threading.Lock())
+    finally:
+      self._lock.release()
+    fetch_lock.acquire()
+    try:
+      # Another thread may have fetched it meanwhile
+      entry = self._entries.get(url)
+      if self._is_fresh(entry, time.time()):
+        self.hits += 1
+        return entry
+      self.misses += 1
+      entry = self._load(url)
+      if not self._is_fresh(entry, time.time()):
+        entry = SchemaEntry(url, fetch(), time.time())
+        self._save(entry)
+      self._entries[url] = entry
+      return entry
+    finally:
+      fetch_lock.release()
+
+  def refresh(self, url):
+    """Fetch the entry for url again, with the last fetch function given."""
+
+    fetch = self._fetchers.get(url)
+    if fetch is None:
+      return None
+    entry = SchemaEntry(url, fetch(), time.time())
+    self._entries[url] = entry
+    self._save(entry)
+    self.refreshes += 1
+    return entry
+
+  def invalidate(self, url=None):
+    """Drop the entry for url, or all entries, from memory and disk."""
+
+    self._lock.acquire()
+    try:
+      if url is None:
+        urls = self._entries.keys()
+      else:
+        urls = [url]
+      for url in urls:
+        self._entries.pop(url, None)
+        path = self._path(url)
+        if path and os.path.exists(path):
+          try:
+            os.remove(path)
+          except OSError:
+            pass
+    finally:
+      self._lock.release()
+
+  def _path(self, url):
+    if not self.cache_dir:
+      return None
+    return os.path.join(self.cache_dir, "sysinfo-%s.json" % hashlib.md5(url).hexdigest())
+
+  def _load(self, url):
+    path = self._path(url)
+    if not path or not os.path.exists(path):
+      return None
+    try:
+      f = open(path)
+      try:
+        data = json.load(f)
+      finally:
+        f.close()
+      if data["url"] != url:
+        return None
+      return SchemaEntry(url, data["sysinfo"], data["fetched"])
+    except (IOError, ValueError, KeyError), err:
+      logger.warning("Ignoring bad schema cache file %s: %s" % (path, err))
+      return None
+
+  def _save(self, entry):
+    path = self._path(entry.url)
+    if not path:
+      return
+    try:
+      if not os.path.isdir(self.cache_dir):
+        os.makedirs(self.cache_dir)
+      # Write to a temporary file first, so readers never see half a file
+      fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, prefix=".sysinfo-")
+      f = os.fdopen(fd, "w")
+      try:
+        json.dump({"url": entry.url, "fetched": entry.fetched, "sysinfo": entry.json_data}, f)
+      finally:
+        f.close()
+      os.rename(tmp_path, path)
+    except (IOError, OSError), err:
+      logger.warning("Could not write schema cache file %s: %s" % (path, err))
+
+  def _start_refresh(self):
+    # Threads do not survive a fork, so each process starts its own
+    pid = os.getpid()
+    if self.refresh_interval is None or self._refresh_pid == pid or self._closed.isSet():
+      return
+    self._lock.acquire()
+    try:
+      if self._refresh_pid != pid:
+        thread = threading.Thread(target=self._refresh_loop)
+        thread.daemon = True
+        thread.start()
+        self._refresh_pid = pid
+    finally:
+      self._lock.release()
+
+  def _refresh_loop(self):
+    while not self._closed.wait(self.refresh_interval):
+      for url in self._entries.keys():
+        try:
+          self.refresh(url)
+        except Exception, err:
+          # Keep using the old entry
+          self.errors += 1
+          logger.warning("Could not refresh the system info of %s: %s" % (url, err))
+
+  def close(self):
+    """Stop refreshing entries in the background."""
+
+    self._closed.set()
+
+  def get_stats(self):
+    """Return the cache counters as a dict."""
+
+    return {"hits": self.hits,
+            "misses": self.misses,
+            "refreshes": self.refreshes,
+            "errors": self.errors,
+            "size": len(self._entries)}
+
+
+
+class ResultCache:
+  """A cache of search results, keyed by broker URL and request text.
+
+  Results are kept as the response text of the broker, so every hit is
+  decoded into a new result.  Each entry is tagged with the lastmodified
+  time of its index when it was stored, and entries of an index are
+  dropped once a later lastmodified is seen.  Clients check lastmodified
+  at most every check_interval seconds, so a result may be used for that
+  long after the index changed.
+
+  At most max_bytes of results are kept in memory, least recently used
+  results being evicted first; larger results are not cached.  If
+  cache_dir is given, results are also stored there, one file each, so
+  that processes on the same host share them.  Files are removed when
+  their index changes.
+
+  """
+
+  def __init__(self, max_bytes=DEFAULT_RESULT_CACHE_BYTES, cache_dir=None,
+               check_interval=DEFAULT_VERSION_CHECK_INTERVAL):
+    self.max_bytes = max_bytes
+    self.cache_dir = cache_dir
+    self.check_interval = check_interval
+    self._entries = OrderedDict()       # (url, request) -> (version, text)
+    self._versions = {}                 # url -> (version, time checked)
+    self._lock = threading.Lock()
+    self.bytes = 0
+    self.hits = 0
+    self.disk_hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.invalidations = 0
+
+  def get_version(self, url):
+    """Return the last known index version of url, or None if it is due for a check.
+
+    Only one caller at a time is told to check; the others keep using the
+    last version until it is set again.
+
+    """
+
+    self._lock.acquire()
+    try:
+      version, checked = self._versions.get(url, (None, 0))
+      now = time.time()
+      if version is not None and now - checked >= self.check_interval:
+        self._versions[url] = (version, now)
+        return None
+      return version
+    finally:
+      self._lock.release()
+
+  def set_version(self, url, version):
+    """Record the index version of url, dropping results of older versions.
+
+    Returns the version in use, which never goes back.
+
+    """
+
+    self._lock.acquire()
+    try:
+      old = self._versions.get(url, (None, 0))[0]
+      if old is not None and version <= old:
+        self._versions[url] = (old, time.time())
+        return old
+      self._versions[url] = (version, time.time())
+      if old is not None:
+        for key, (entry_version, text) in self._entries.items():
+          if key[0] == url and entry_version < version:
+            del self._entries[key]
+            self.bytes -= len(text)
+            self.invalidations += 1
+    finally:
+      self._lock.release()
+    self._remove_old_files(url, version)
+    return version
+
+  def get(self, url, request, version):
+    """Return the cached response text for a request to url, or None."""
+
+    key = (url, request)
+    self._lock.acquire()
+    try:
+      entry = self._entries.pop(key, None)
+      if entry is not None and entry[0] == version:
+        self._entries[key] = entry
+        self.hits += 1
+        return entry[1]
+      if entry is not None:
+        self.bytes -= len(entry[1])
+    finally:
+      self._lock.release()
+    text = self._load(url, request, version)
+    self._lock.acquire()
+    try:
+      if text is None:
+        self.misses += 1
+        return None
+      self.disk_hits += 1
+      self._add(key, version, text)
+      return text
+    finally:
+      self._lock.release()
+
+  def put(self, url, request, version, text):
+    """Store the response text of a request to url, made at an index version."""
+
+    if len(text) > self.max_bytes:
+      return
+    self._lock.acquire()
+    try:
+      if version < self._versions.get(url, (version, 0))[0]:
+        # The index has changed since the request was made
+        return
+      self._add((url, request), version, text)
+    finally:
+      self._lock.release()
+    self._save(url, request, version, text)
+
+  def _add(self, key, version, text):
+    old = self._entries.pop(key, None)
+    if old is not None:
+      self.bytes -= len(old[1])
+    self._entries[key] = (version, text)
+    self.bytes += len(text)
+    while self.bytes > self.max_bytes:
+      _, (_, evicted) = self._entries.popitem(last=False)
+      self.bytes -= len(evicted)
+      self.evictions += 1
+
+  def clear(self):
+    """Drop all results from memory, and from disk.
+
+    Only the results-* directories of this class are removed from
+    cache_dir, which may hold other files, such as those of a SchemaCache.
+
+    """
+
+    self._lock.acquire()
+    try:
+      self._entries.clear()
+      self.bytes = 0
+    finally:
+      self._lock.release()
+    if not self.cache_dir:
+      return
+    try:
+      names = os.listdir(self.cache_dir)
+    except OSError:
+      return
+    for name in names:
+      path = os.path.join(self.cache_dir, name)
+      if name.startswith("results-") and os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+
+  def _dir(self, url, version=None):
+    path = os.path.join(self.cache_dir, "results-%s" % hashlib.md5(url).hexdigest())
+    if version is not None:
+      path = os.path.join(path, str(version))
+    return path
+
+  def _path(self, url, request, version):
+    return os.path.join(self._dir(url, version), hashlib.md5(request).hexdigest())
+
+  def _load(self, url, request, version):
+    if not self.cache_dir:
+      return None
+    path = self._path(url, request, version)
+    try:
+      f = open(path, "rb")
+      try:
+        stored_request, text = f.read().split("\n", 1)
+      finally:
+        f.close()
+    except (IOError, ValueError):
+      return None
+    if stored_request != request.encode("string_escape"):
+      return None
+    return text
+
+  def _save(self, url, request, version, text):
+    if not self.cache_dir:
+      return
+    dir = self._dir(url, version)
+    try:
+      if not os.path.isdir(dir):
+        os.makedirs(dir)
+      # Write to a temporary file first, so readers never see half a file
+      fd, tmp_path = tempfile.mkstemp(dir=dir, prefix=".result-")
+      f = os.fdopen(fd, "wb")
+      try:
+        f.write(request.encode("string_escape") + "\n" + text)
+      finally:
+        f.close()
+      os.rename(tmp_path, self._path(url, request, version))
+    except (IOError, OSError), err:
+      logger.warning("Could not write result cache file in %s: %s" % (dir, err))
+
+  def _remove_old_files(self, url, version):
+    if not self.cache_dir:
+      return
+    dir = self._dir(url)
+    try:
+      names = os.listdir(dir)
+    except OSError:
+      return
+    for name in names:
+      try:
+        old = long(name)
+      except ValueError:
+        continue
+      if old < version:
+        shutil.rmtree(os.path.join(dir, name), ignore_errors=True)
+
+  def __len__(self):
+    return len(self._entries)
+
+  def get_stats(self):
+    """Return the cache counters as a dict."""
+
+    self._lock.acquire()
+    try:
+      return {"hits": self.hits,
+              "disk_hits": self.disk_hits,
+              "misses": self.misses,
+              "evictions": self.evictions,
+              "invalidations": self.invalidations,
+              "size": len(self._entries),
+              "bytes": self.bytes,
+              "max_bytes": self.max_bytes}
+    finally:
+      self._lock.release()
+
+
+_schema_cache = SchemaCache()
+
+def get_schema_cache():
+  """Return the schema cache shared by all clients of this process."""
+
+  return _schema_cache
+
+def set_schema_cache(cache):
+  """Replace the shared schema cache, e.g. to use a cache directory."""
+
+  global _schema_cache
+  _schema_cache = cache
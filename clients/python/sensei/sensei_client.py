@@ -15,60 +15,193 @@
 """
 
 import urllib
-import urllib2
 import json
+import copy
+import hashlib
 import sys
 import logging
 import datetime
 from datetime import datetime
 import time
 import re
+import threading
+import Queue
 
-from bql_parser import BQLParser, BQLRequest
+from bql_request import BQLRequest, normalize_bql, is_time_relative, get_bql_variables, \
+    normalize_pred, normalize_preds, DEFAULT_PARSER_ENGINE
 from sensei_components import *
-from pyparsing import ParseException, ParseFatalException, ParseSyntaxException
+from sensei_cache import LRUCache, get_schema_cache
+from sensei_transport import get_connection_pool
+from sensei_codec import get_codec, LazyJson
+from sensei_stream import SenseiResultStream, DEFAULT_CHUNK_SIZE
+from sensei_router import ClusterRouter, NODE_ERRORS
+from sensei_coalesce import SingleFlight
+from sensei_get import iter_docs, DEFAULT_GET_CHUNK_SIZE, DEFAULT_GET_CHUNK_BYTES, \
+    DEFAULT_GET_PARALLELISM
 
 BQL_PARSING_ERROR_CODE = 150
 
+# Default number of compiled statements kept by each client
+DEFAULT_STMT_CACHE_SIZE = 512
+
+# Default number of hits fetched per request by iter_hits
+DEFAULT_PAGE_SIZE = 100
+
 logger = logging.getLogger("sensei_client")
 
 class SenseiClient:
-  """Sensei client class."""
+  """Sensei client class.
+
+  With lazy=True, the constructor does no I/O: the system info is fetched
+  and the parser built on the first compile(), get_facet_map(),
+  get_sysinfo() or get_parser().  Clients that only send raw BQL or JSON
+  to doQuery() never need them.
+
+  A client may be shared by many threads.  Compiles with the default
+  "fast" parser engine run concurrently, but with parser_engine="pyparsing"
+  they run one at a time.
+
+  """
 
-  def __init__(self, host='localhost', port=8080, path='sensei', sysinfo=None):
+  def __init__(self, host='localhost', port=8080, path='sensei', sysinfo=None,
+               stmt_cache_size=DEFAULT_STMT_CACHE_SIZE, parser_engine=DEFAULT_PARSER_ENGINE,
+               codec=None, compression=False, compress_requests=False, schema_cache=None,
+               lazy=False, direct_routing=False, result_cache=None, coalesce=False):
     self.host = host
     self.port = port
     self.path = path
     self.url = 'http://%s:%d/%s' % (self.host, self.port, self.path)
-    self.opener = urllib2.build_opener()
-    self.opener.addheaders = [('User-agent', 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_6_7) AppleWebKit/534.30 (KHTML, like Gecko) Chrome/12.0.742.91 Safari/534.30')]
+    # Connections to the broker are kept alive and shared by all clients
+    self.pool = get_connection_pool(self.host, self.port)
+    # JSON codec for broker responses (see sensei_codec)
+    self.codec = get_codec(codec)
+    # Whether responses and large requests may be compressed
+    self.compression = compression
+    self.compress_requests = compress_requests
 
+    self.parser_engine = parser_engine
+    # Compiled statements, keyed by normalized statement text
+    self.stmt_cache = None
+    if stmt_cache_size:
+      self.stmt_cache = LRUCache(stmt_cache_size)
+
+    # System infos of brokers are shared by all clients (see SchemaCache)
+    self.schema_cache = schema_cache or get_schema_cache()
+    self._schema_signature = None
+    self._schema_lock = threading.Lock()
+    self.sysinfo = None
+    self.facet_map = None
+    self.parser = None
+    self.test_sysinfo = None
+    # Sends requests limited to some partitions straight to a node owning them
+    self.router = None
+    if direct_routing:
+      self.router = ClusterRouter()
+    # Search results, kept until the index changes (see ResultCache)
+    self.result_cache = result_cache
+    # Identical searches in flight at the same time share one request
+    self.single_flight = None
+    if coalesce:
+      self.single_flight = SingleFlight()
     if sysinfo:
       self.test_sysinfo = SenseiSystemInfo(sysinfo)
-      self.sysinfo = self.test_sysinfo
-    else:
+    if not lazy:
       # Here we assume that the index has been started
-      self.test_sysinfo = None
-      urlReq = urllib2.Request(self.url + "/sysinfo")
-      res = self.opener.open(urlReq)
-      line = res.read()
-      jsonObj = json.loads(line)
-      self.sysinfo = SenseiSystemInfo(jsonObj)
-    self.facet_map = {}
-    for facet_info in self.sysinfo.get_facet_infos():
-      self.facet_map[facet_info.get_name()] = facet_info
-
-    self.parser = BQLParser(self.facet_map)
+      self._load_schema()
+
+  def _load_schema(self):
+    """Fetch the system info and build the parser, unless done already."""
+
+    self._schema_lock.acquire()
+    try:
+      if self.parser is not None:
+        return
+      if self.test_sysinfo:
+        self._set_sysinfo(self.test_sysinfo)
+      else:
+        self._set_schema(self.schema_cache.get(self.url, self._fetch_sysinfo))
+    finally:
+      self._schema_lock.release()
+
+  def _fetch_sysinfo(self):
+    return self.codec.decode(self._request("/%s/sysinfo" % self.path))
+
+  def _set_sysinfo(self, sysinfo):
+    """Build the facet map and the parser for a schema."""
+
+    self.sysinfo = sysinfo
+    facet_map = {}
+    for facet_info in sysinfo.get_facet_infos():
+      facet_map[facet_info.get_name()] = facet_info
+    self.facet_map = facet_map
+    # The parser, and pyparsing, are only loaded by clients that compile
+    from bql_parser import BQLParser
+    self.parser = BQLParser(facet_map, engine=self.parser_engine)
+    if self.stmt_cache is not None:
+      # Statements compiled with the old facets may no longer be valid
+      self.stmt_cache.clear()
+
+  def _set_schema(self, entry):
+    """Use a schema cache entry, rebuilding things only if the facets changed."""
+
+    if entry.signature != self._schema_signature:
+      self._schema_signature = entry.signature
+      self._set_sysinfo(entry.get_sysinfo())
+    else:
+      self.sysinfo = entry.get_sysinfo()
+
+  def _urlopen(self, path, data=None):
+    """Send a request to the broker and return the response."""
+
+    return self.pool.urlopen(path, data, compression=self.compression,
+                             compress_request=self.compress_requests)
+
+  def _request(self, path, data=None):
+    """Send a request to the broker and return the whole response body."""
+
+    return self.pool.request(path, data, compression=self.compression,
+                             compress_request=self.compress_requests)
 
   def compile(self, bql_stmt):
-    tokens = self.parser.parse(bql_stmt)
+    """Compile a BQL statement into a SenseiRequest.
+
+    Compiled requests are cached, so compiling the same statement again
+    only costs a copy of the cached request.  Statements using NOW, AGO
+    or IN LAST are always parsed again, because their meaning depends on
+    the current time.
+
+    """
+
+    if self.parser is None:
+      self._load_schema()
+    elif self.test_sysinfo is None:
+      # Pick up a schema refreshed in the background, without a request
+      entry = self.schema_cache.peek(self.url)
+      if entry is not None and entry.signature != self._schema_signature:
+        self._set_schema(entry)
+
+    key = None
+    if self.stmt_cache is not None:
+      key = normalize_bql(bql_stmt)
+      req = self.stmt_cache.get(key)
+      if req is not None:
+        return copy.deepcopy(req)
+
+    parser = self.parser
+    tokens = parser.parse(bql_stmt)
     if tokens:
-      logger.debug("tokens: %s" % tokens)
-      bql_req = BQLRequest(tokens, self.facet_map)
-      return SenseiRequest(bql_req, facet_map=self.facet_map)
+      logger.debug("tokens: %s", tokens)
+      bql_req = BQLRequest(tokens, parser.facet_map)
+      req = SenseiRequest(bql_req, facet_map=parser.facet_map)
+      if key is not None and not is_time_relative(key):
+        # Callers may modify the returned request, so keep our own copy
+        self.stmt_cache.put(key, req)
+        return copy.deepcopy(req)
+      return req
     return None
 
-  def buildJsonString(self, req, sort_keys=True, indent=None):
+  @staticmethod
+  def buildJsonString(req, sort_keys=True, indent=None):
     """Build a Sensei request in JSON format.
 
     Once built, a Sensei request in JSON format can be sent to a Sensei
@@ -80,8 +213,18 @@ class SenseiClient:
       "size": 10
     }'
 
+    Bind variables are written as "$name", which the broker replaces
+    with the values given in the templateMapping of the request.
+
     """
 
+    return json.dumps(SenseiClient.buildJsonMap(req), sort_keys=sort_keys, indent=indent,
+                      default=lambda var: "$" + var.name)
+
+  @staticmethod
+  def buildJsonMap(req):
+    """Build the JSON object of a Sensei request."""
+
     output_json = {}
 
     output_json[JSON_PARAM_FROM] = req.offset
@@ -100,6 +243,8 @@ class SenseiClient:
       output_json[JSON_PARAM_FETCH_STORED] = True
     if req.route_param:
       output_json[JSON_PARAM_ROUTEPARAM] = req.route_param
+    if req.partitions:
+      output_json[JSON_PARAM_PARTITIONS] = req.partitions
     if req.sorts:
       output_json[JSON_PARAM_SORT] = [sort.build_sort_spec() for sort in req.sorts]
 
@@ -156,7 +301,7 @@ class SenseiClient:
         }
 
     # print ">>> output_json = ", output_json
-    return json.dumps(output_json, sort_keys=sort_keys, indent=indent)
+    return output_json
 
   @staticmethod
   def buildUrlString(req):
@@ -171,6 +316,8 @@ class SenseiClient:
       paramMap[PARAM_FETCH_STORED] = "true"
     if req.route_param:
       paramMap[PARAM_ROUTE_PARAM] = req.route_param
+    if req.partitions:
+      paramMap[PARAM_PARTITIONS] = ",".join(str(partition) for partition in req.partitions)
 
     if req.sorts:
       paramMap[PARAM_SORT] = ",".join(sort.build_sort_field() for sort in req.sorts)
@@ -241,43 +388,333 @@ class SenseiClient:
 
     return urllib.urlencode(paramMap)
     
-  def doQuery(self, req, using_json=True, var_map={}):
-    """Execute a search query."""
+  @staticmethod
+  def buildQueryString(req, using_json=True, var_map={}):
+    """Build the body of a search request sent to the broker.
+
+    req is either a BQL statement, which the broker compiles, or a
+    SenseiRequest, which is sent in the JSON format.
+
+    """
 
-    time1 = datetime.now()
-    query_string = None
     if using_json: # Use JSON format
-      bql = {"bql": req}
+      if isinstance(req, SenseiRequest):
+        bql = SenseiClient.buildJsonMap(req)
+      else:
+        bql = {"bql": req}
       if var_map:
         bql["templateMapping"] = var_map;
-      query_string = json.dumps(bql)
+      return json.dumps(bql, default=lambda var: "$" + var.name)
     else:
-      query_string = SenseiClient.buildUrlString(req)
+      return SenseiClient.buildUrlString(req)
+
+  @staticmethod
+  def buildRequestKey(req, using_json=True, var_map={}, facet_map=None):
+    """Build a stable hash of a search request, for use as a cache key.
+
+    Requests that only differ in ways that do not change their results,
+    such as the order of ANDed predicates, duplicate IN values or "x > 1"
+    against "x >= 2" on an int column, get the same key (see
+    normalize_pred).  facet_map gives the column types of the index.
+    The request is not modified.
+
+    """
+
+    if not using_json:
+      # buildUrlString takes the query out of qParam
+      req = copy.copy(req)
+      req.qParam = dict(req.qParam)
+      body = SenseiClient.buildUrlString(req)
+    else:
+      if isinstance(req, SenseiRequest):
+        bql = SenseiClient.buildJsonMap(req)
+        if bql.get(JSON_PARAM_FILTER):
+          bql[JSON_PARAM_FILTER] = normalize_pred(bql[JSON_PARAM_FILTER], facet_map)
+        if bql.get(JSON_PARAM_SELECTIONS):
+          bql[JSON_PARAM_SELECTIONS] = normalize_preds(bql[JSON_PARAM_SELECTIONS], facet_map)
+      else:
+        bql = {"bql": normalize_bql(req)}
+      if var_map:
+        bql["templateMapping"] = var_map
+      body = json.dumps(bql, sort_keys=True, separators=(",", ":"),
+                        default=lambda var: "$" + var.name)
+    if isinstance(body, unicode):
+      body = body.encode("utf-8")
+    return hashlib.sha1(body).hexdigest()
+
+  def prepare(self, bql_stmt):
+    """Prepare a BQL statement with bind variables for repeated execution."""
+
+    return SenseiPreparedStatement(self, bql_stmt)
+
+  def doQuery(self, req, using_json=True, var_map={}):
+    """Execute a search query."""
+
+    key = self._request_key(req, using_json, var_map)
+    query_string = SenseiClient.buildQueryString(req, using_json, var_map)
+    return self._query(req, query_string, self._search, key)
+
+  def doQueryString(self, query_string):
+    """Send the body of a search request to the broker."""
+
+    time1 = datetime.now()
+    return self._make_result(self._search(query_string), time1)
+
+  def _search(self, query_string):
+    """Send the body of a search request to the broker and return the response body."""
+
     logger.debug(query_string)
-    urlReq = urllib2.Request(self.url, query_string)
-    res = self.opener.open(urlReq)
-    line = res.read()
-    jsonObj = json.loads(line)
-    logger.debug("Result jsonObj = " + json.dumps(jsonObj))
-    res = SenseiResult(jsonObj)
+    return self._request("/" + self.path, query_string)
+
+  def _query(self, req, query_string, search, key=None):
+    """Answer a search request from the result cache, a node or the broker.
+
+    search(query_string) sends the request to the broker and returns the
+    response body.  Results with errors are not cached.  When coalescing,
+    threads making the same request at the same time get the same
+    SenseiResult object, which they should not modify.  Requests are told
+    apart by key, or by query_string if no key is given.
+
+    The result cache is bypassed for BQL statements with NOW, AGO or IN
+    LAST, which the broker resolves at query time, and for requests made
+    while the index version cannot be checked.
+
+    """
+
+    time1 = datetime.now()
+    if key is None:
+      key = query_string
+    cache = self.result_cache
+    if isinstance(req, basestring) and is_time_relative(req):
+      cache = None
+    version = None
+    if cache is not None:
+      version = self._get_index_version()
+      if version is None:
+        cache = None
+    if cache is not None:
+      line = cache.get(self.url, key, version)
+      if line is not None:
+        return self._make_result(line, time1)
+
+    def _fetch():
+      line = self._route_query(req, query_string)
+      if line is None:
+        line = search(query_string)
+      res = self._make_result(line, time1)
+      if cache is not None and not res.errors:
+        cache.put(self.url, key, version, line)
+      return res
+    if self.single_flight is None:
+      return _fetch()
+    return self.single_flight.do(key, _fetch)
+
+  def _request_key(self, req, using_json, var_map):
+    """Return the key of a request for the result cache and coalescing, if either is on."""
+
+    if self.result_cache is None and self.single_flight is None:
+      return None
+    return SenseiClient.buildRequestKey(req, using_json, var_map, self.facet_map)
+
+  def _get_index_version(self):
+    """Return the lastmodified time of the index, as seen by the result cache.
+
+    The system info is fetched again when the result cache is due to
+    check it, unless the schema cache got it since.  Returns None if the
+    system info cannot be fetched.
+
+    """
+
+    cache = self.result_cache
+    version = cache.get_version(self.url)
+    if version is None:
+      if self.test_sysinfo:
+        version = self.test_sysinfo.get_last_modified()
+      else:
+        try:
+          entry = self.schema_cache.get(self.url, self._fetch_sysinfo)
+          if time.time() - entry.fetched >= cache.check_interval:
+            entry = self.schema_cache.refresh(self.url) or entry
+        except Exception, err:
+          logger.warning("Cannot check the index version of %s, not using the result cache: %s",
+                         self.url, err)
+          return None
+        version = long(entry.last_modified or 0)
+      version = cache.set_version(self.url, version)
+    return version
+
+  def get_coalesce_stats(self):
+    """Get the number of searches sent and of searches that shared one, or None."""
+
+    if self.single_flight is None:
+      return None
+    return self.single_flight.get_stats()
+
+  def get_result_cache_stats(self):
+    """Get the counters of the result cache, or None if there is none."""
+
+    if self.result_cache is None:
+      return None
+    return self.result_cache.get_stats()
+
+  def _route_query(self, req, query_string):
+    """Send a search request straight to a node owning its partitions.
+
+    Returns the response body, or None if the request is to go through
+    the broker instead: no direct routing, a BQL statement rather than a
+    SenseiRequest, no partitions or route parameter in the request, no
+    node found for them, or the node failed.  The cluster map comes from
+    the schema cache, so it follows the cluster as the cache refreshes.
+
+    """
+
+    if self.router is None or not isinstance(req, SenseiRequest):
+      return None
+    if not req.partitions and not req.route_param:
+      return None
+    if self.test_sysinfo:
+      sysinfo = self.test_sysinfo
+    else:
+      sysinfo = self.schema_cache.get(self.url, self._fetch_sysinfo).get_sysinfo()
+    node = self.router.route(sysinfo.get_cluster_info(), req.partitions, req.route_param)
+    if node is None:
+      return None
+    try:
+      line = self.router.get_pool(node).request("/" + self.path, query_string,
+                                                compression=self.compression,
+                                                compress_request=self.compress_requests)
+    except NODE_ERRORS, e:
+      logger.warning("Node %s failed, using the broker: %s", node.get_admin_link(), e)
+      self.router.count(fallbacks=1)
+      # The node may have left the cluster
+      self.schema_cache.invalidate(self.url)
+      return None
+    self.router.count(routed=1)
+    return line
+
+  def get_routing_stats(self):
+    """Get the counters of direct routing, or None if it is off."""
+
+    if self.router is None:
+      return None
+    return self.router.get_stats()
+
+  def _make_result(self, line, time1):
+    jsonObj = self.codec.decode(line)
+    logger.debug("Result jsonObj = %s", LazyJson(jsonObj))
+    res = SenseiResult(jsonObj, self.codec)
     delta = datetime.now() - time1
     res.total_time = delta.seconds * 1000 + delta.microseconds / 1000
     return res
 
-  def get_sysinfo(self):
-    """Get Sensei system info."""
+  def doQueryStream(self, req, using_json=True, var_map={}, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Execute a search query, parsing the result as it is received.
+
+    Returns a SenseiResultStream: iterating over it yields the hits one
+    at a time, and its get() method returns the other fields of the
+    result.  Memory use does not grow with the number of hits.
+
+    """
+
+    query_string = SenseiClient.buildQueryString(req, using_json, var_map)
+    logger.debug(query_string)
+    response = self._urlopen("/" + self.path, query_string)
+    return SenseiResultStream(response, self.codec, chunk_size)
+
+  def iter_hits(self, bql_stmt, page_size=DEFAULT_PAGE_SIZE, prefetch=1, var_map={}):
+    """Generate the hits of a SELECT statement one at a time.
+
+    The hits are fetched page_size at a time by moving the offset of the
+    request.  While the caller works through one page, a background thread
+    fetches up to prefetch pages ahead (none if prefetch is 0), so memory
+    use stays bounded however many hits there are.  Iteration stops after
+    the hits selected by the statement's LIMIT clause, if any, or after
+    all numhits hits.
+
+    """
+
+    if isinstance(bql_stmt, SenseiRequest):
+      req = copy.deepcopy(bql_stmt)
+    else:
+      req = self.compile(bql_stmt)
+    if req is None or req.stmt_type != "select":
+      raise SenseiClientError("Only SELECT statements can be iterated: %s" % bql_stmt)
+
+    pages = _PageFetcher(self, req, page_size, var_map)
+    if prefetch > 0:
+      pages = _Prefetcher(pages, prefetch)
+    try:
+      for page in pages:
+        for json_hit in page:
+          yield SenseiHit(json_hit, self.codec)
+    finally:
+      pages.close()
+
+  def iter_get(self, uids, chunk_size=DEFAULT_GET_CHUNK_SIZE,
+               max_chunk_bytes=DEFAULT_GET_CHUNK_BYTES, parallelism=DEFAULT_GET_PARALLELISM):
+    """Generate (uid, source data) pairs for the documents found among uids.
+
+    The uids are sent chunk_size at a time, in up to parallelism
+    requests at once (see sensei_get.iter_docs).  Uids are strings in
+    the pairs, and documents that are not found are left out.
+
+    """
+
+    path = "/%s/get" % self.path
+    return iter_docs(lambda body: self._request(path, body), self.codec.decode, uids,
+                     chunk_size, max_chunk_bytes, parallelism)
+
+  def multi_get(self, uids, chunk_size=DEFAULT_GET_CHUNK_SIZE,
+                max_chunk_bytes=DEFAULT_GET_CHUNK_BYTES, parallelism=DEFAULT_GET_PARALLELISM):
+    """Get the source data of documents, as a {uid: data} dict."""
+
+    return dict(self.iter_get(uids, chunk_size, max_chunk_bytes, parallelism))
+
+  def get_sysinfo(self, refresh=False):
+    """Get Sensei system info.
+
+    The system info comes from the schema cache unless it is older than
+    the cache's TTL or refresh is true.
+
+    """
 
     if self.test_sysinfo:
       return self.test_sysinfo
-    urlReq = urllib2.Request(self.url + "/sysinfo")
-    res = self.opener.open(urlReq)
-    line = res.read()
-    jsonObj = json.loads(line)
-    self.sysinfo = SenseiSystemInfo(jsonObj)
+    if refresh:
+      self.schema_cache.invalidate(self.url)
+    self._schema_lock.acquire()
+    try:
+      self._set_schema(self.schema_cache.get(self.url, self._fetch_sysinfo))
+    finally:
+      self._schema_lock.release()
     return self.sysinfo
 
   def get_facet_map(self):
+    if self.facet_map is None:
+      self._load_schema()
     return self.facet_map
+
+  def get_parser(self):
+    if self.parser is None:
+      self._load_schema()
+    return self.parser
+
+  def get_stmt_cache_stats(self):
+    """Get the hit/miss/eviction counters of the compiled statement cache."""
+
+    if self.stmt_cache is None:
+      return None
+    return self.stmt_cache.get_stats()
+
+  def get_pool_stats(self):
+    """Get the counters of the broker connection pool.
+
+    Besides connection hits and misses, these include the bytes sent and
+    received, both on the wire and before compression.
+
+    """
+
+    return self.pool.get_stats()
   
   def run_example(self):
     """ a sample sensei request"""
@@ -321,6 +758,189 @@ class SenseiClient:
     columns.append("*")
     res.display(columns, max_col_width=40)
 
+
+class _PageFetcher:
+  """Fetch the hits of a request one page at a time."""
+
+  def __init__(self, client, req, page_size, var_map):
+    self.client = client
+    self.req = req
+    self.page_size = page_size
+    self.var_map = var_map
+    self.offset = req.offset
+    self.end = req.has_limit and req.offset + req.count or None
+
+  def __iter__(self):
+    return self
+
+  def next(self):
+    """Return the hits of the next page."""
+
+    if self.end is not None and self.offset >= self.end:
+      raise StopIteration
+    count = self.page_size
+    if self.end is not None:
+      count = min(count, self.end - self.offset)
+    self.req.offset = self.offset
+    self.req.count = count
+    res = self.client.doQuery(self.req, var_map=self.var_map)
+    if res.errors:
+      raise SenseiClientError("Query failed at offset %d: %s" % (self.offset, res.errors[0]))
+    hits = res.hits or []
+    self.offset += count
+    if self.end is None or res.numHits < self.end:
+      self.end = res.numHits
+    if not hits:
+      raise StopIteration
+    return hits
+
+  def close(self):
+    pass
+
+
+class _Prefetcher:
+  """Run a page fetcher in a background thread, a few pages ahead.
+
+  Pages, the end of the pages and errors are passed through a bounded
+  queue.  Closing the prefetcher stops the thread at the next page.
+
+  """
+
+  _END = object()
+
+  def __init__(self, pages, prefetch):
+    self.pages = pages
+    self.queue = Queue.Queue(prefetch)
+    self.closed = threading.Event()
+    self.thread = threading.Thread(target=self._run)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def _run(self):
+    try:
+      for page in self.pages:
+        if not self._put((page, None)):
+          return
+      self._put((self._END, None))
+    except Exception, err:
+      self._put((None, err))
+
+  def _put(self, item):
+    while not self.closed.is_set():
+      try:
+        self.queue.put(item, timeout=0.1)
+        return True
+      except Queue.Full:
+        pass
+    return False
+
+  def __iter__(self):
+    return self
+
+  def next(self):
+    page, err = self.queue.get()
+    if err is not None:
+      raise err
+    if page is self._END:
+      raise StopIteration
+    return page
+
+  def close(self):
+    self.closed.set()
+
+
+class SenseiPreparedStatement:
+  """A BQL statement that is parsed once and executed many times.
+
+  The statement may contain bind variables, such as $color, wherever a
+  value is expected.  A variable that is the only item of a value list,
+  as in "color IN ($colors)", binds a list of values.  Variables are
+  type-checked against the facet map when values are bound.
+
+  The statement is compiled into a JSON request once, and binding values
+  only splices their JSON encoding into that request.  Statements using
+  NOW, AGO or IN LAST are compiled again on every bind, so that they
+  follow the current time.
+
+  """
+
+  def __init__(self, client, bql_stmt):
+    self.client = client
+    self.bql_stmt = bql_stmt
+    self.time_relative = is_time_relative(normalize_bql(bql_stmt))
+    self._compile()
+
+  def _compile(self):
+    req = self.client.compile(self.bql_stmt)
+    if req is None or req.stmt_type != "select":
+      raise SenseiClientError("Only SELECT statements can be prepared: %s" % self.bql_stmt)
+
+    # Serialize the request with a unique marker in place of each variable,
+    # then split the JSON text around the markers.
+    variables = []
+    marker = "\x00%d\x00"
+    def _marker(var):
+      variables.append(var)
+      return marker % (len(variables) - 1)
+    template = json.dumps(SenseiClient.buildJsonMap(req), sort_keys=True, default=_marker)
+
+    self.parts = []
+    for i in xrange(len(variables)):
+      head, template = template.split(json.dumps(marker % i), 1)
+      self.parts.append(head)
+    self.parts.append(template)
+    self.variables = variables
+
+    self.names = set(var.name for var in self.variables)
+    for name in get_bql_variables(self.bql_stmt) - self.names:
+      raise SenseiClientError("Variable $%s is not supported here" % name)
+
+  def get_variable_names(self):
+    """Get the names of the bind variables."""
+
+    return sorted(self.names)
+
+  def bind(self, var_map=None, **kwargs):
+    """Bind values to the variables and return the JSON request."""
+
+    values = dict(var_map or {}, **kwargs)
+    for name in values:
+      if name not in self.names:
+        raise SenseiClientError("Unknown variable $%s" % name)
+    if self.time_relative:
+      self._compile()
+
+    output = [self.parts[0]]
+    for var, part in zip(self.variables, self.parts[1:]):
+      if var.name not in values:
+        raise SenseiClientError("Variable $%s is not bound" % var.name)
+      value = values[var.name]
+      if var.is_list:
+        if not isinstance(value, (list, tuple, set)):
+          value = [value]
+        for item in value:
+          self._verify(var, item)
+        output.append(", ".join(json.dumps(item) for item in value))
+      else:
+        self._verify(var, value)
+        output.append(json.dumps(value))
+      output.append(part)
+    return "".join(output)
+
+  def _verify(self, var, value):
+    if isinstance(value, (list, tuple, set, dict)):
+      raise SenseiClientError("Variable $%s takes a single value, not %s" % (var.name, value))
+    if var.column_type:
+      ok, msg = self.client.parser._verify_value_type(value, var.column_type)
+      if not ok:
+        raise SenseiClientError("%s (for variable $%s)" % (msg, var.name))
+
+  def execute(self, var_map=None, **kwargs):
+    """Bind values to the variables and execute the query."""
+
+    return self.client.doQueryString(self.bind(var_map, **kwargs))
+
+
 def main(argv):
   
   def help():
@@ -367,6 +987,7 @@ exit              Exit
   var_map = {}
 
   import readline
+  from pyparsing import ParseException, ParseFatalException, ParseSyntaxException
   readline.parse_and_bind("tab: complete")
   while 1:
     try:
@@ -404,7 +1025,7 @@ exit              Exit
         sysinfo = client.get_sysinfo()
         sysinfo.display()
       elif command == "set":
-        tokens = client.parser.parse(stmt)
+        tokens = client.get_parser().parse(stmt)
         if tokens.value:
           var_map[tokens.variable] = tokens.value
         elif tokens.value_list:
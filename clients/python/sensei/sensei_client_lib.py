@@ -16,7 +16,6 @@
 
 
 import urllib
-import urllib2
 import json
 import sys
 import logging
@@ -25,171 +24,15 @@ from datetime import datetime
 import time
 import re
 
+# Constants, display utilities and the classes shared with sensei_client
+from sensei_components import *
+from sensei_transport import get_connection_pool
+from sensei_codec import get_codec
+from sensei_get import iter_docs, DEFAULT_GET_CHUNK_SIZE, DEFAULT_GET_CHUNK_BYTES, \
+    DEFAULT_GET_PARALLELISM
 
-logger = logging.getLogger("sensei_client_lib")
-
-
-
-#
-# REST API parameter constants
-#
-PARAM_OFFSET = "start"
-PARAM_COUNT = "rows"
-PARAM_QUERY = "q"
-PARAM_QUERY_PARAM = "qparam"
-PARAM_SORT = "sort"
-PARAM_SORT_ASC = "asc"
-PARAM_SORT_DESC = "desc"
-PARAM_SORT_SCORE = "relevance"
-PARAM_SORT_SCORE_REVERSE = "relrev"
-PARAM_SORT_DOC = "doc"
-PARAM_SORT_DOC_REVERSE = "docrev"
-PARAM_FETCH_STORED = "fetchstored"
-PARAM_SHOW_EXPLAIN = "showexplain"
-PARAM_ROUTE_PARAM = "routeparam"
-PARAM_GROUP_BY = "groupby"
-PARAM_MAX_PER_GROUP = "maxpergroup"
-PARAM_SELECT = "select"
-PARAM_SELECT_VAL = "val"
-PARAM_SELECT_NOT = "not"
-PARAM_SELECT_OP = "op"
-PARAM_SELECT_OP_AND = "and"
-PARAM_SELECT_OP_OR = "or"
-PARAM_SELECT_PROP = "prop"
-PARAM_FACET = "facet"
-PARAM_DYNAMIC_INIT = "dyn"
-PARAM_PARTITIONS = "partitions"
-
-PARAM_FACET_EXPAND = "expand"
-PARAM_FACET_MAX = "max"
-PARAM_FACET_MINHIT = "minhit"
-PARAM_FACET_ORDER = "order"
-PARAM_FACET_ORDER_HITS = "hits"
-PARAM_FACET_ORDER_VAL = "val"
-
-PARAM_DYNAMIC_TYPE = "type"
-PARAM_DYNAMIC_TYPE_STRING = "string"
-PARAM_DYNAMIC_TYPE_BYTEARRAY = "bytearray"
-PARAM_DYNAMIC_TYPE_BOOL = "boolean"
-PARAM_DYNAMIC_TYPE_INT = "int"
-PARAM_DYNAMIC_TYPE_LONG = "long"
-PARAM_DYNAMIC_TYPE_DOUBLE = "double"
-PARAM_DYNAMIC_VAL = "vals"
-
-PARAM_RESULT_PARSEDQUERY = "parsedquery"
-PARAM_RESULT_HIT_STORED_FIELDS = "stored"
-PARAM_RESULT_HIT_STORED_FIELDS_NAME = "name"
-PARAM_RESULT_HIT_STORED_FIELDS_VALUE = "val"
-PARAM_RESULT_HIT_EXPLANATION = "explanation"
-PARAM_RESULT_FACETS = "facets"
-
-PARAM_RESULT_TID = "tid"
-PARAM_RESULT_TOTALDOCS = "totaldocs"
-PARAM_RESULT_NUMHITS = "numhits"
-PARAM_RESULT_HITS = "hits"
-PARAM_RESULT_HIT_UID = "uid"
-PARAM_RESULT_HIT_DOCID = "docid"
-PARAM_RESULT_HIT_SCORE = "score"
-PARAM_RESULT_HIT_SRC_DATA = "srcdata"
-PARAM_RESULT_TIME = "time"
-
-PARAM_SYSINFO_NUMDOCS = "numdocs"
-PARAM_SYSINFO_LASTMODIFIED = "lastmodified"
-PARAM_SYSINFO_VERSION = "version"
-PARAM_SYSINFO_FACETS = "facets"
-PARAM_SYSINFO_FACETS_NAME = "name"
-PARAM_SYSINFO_FACETS_RUNTIME = "runtime"
-PARAM_SYSINFO_FACETS_PROPS = "props"
-PARAM_SYSINFO_CLUSTERINFO = "clusterinfo"
-PARAM_SYSINFO_CLUSTERINFO_ID = "id"
-PARAM_SYSINFO_CLUSTERINFO_PARTITIONS = "partitions"
-PARAM_SYSINFO_CLUSTERINFO_NODELINK = "nodelink"
-PARAM_SYSINFO_CLUSTERINFO_ADMINLINK = "adminlink"
-
-PARAM_RESULT_HITS_EXPL_VALUE = "value"
-PARAM_RESULT_HITS_EXPL_DESC = "description"
-PARAM_RESULT_HITS_EXPL_DETAILS = "details"
-
-PARAM_RESULT_FACET_INFO_VALUE = "value"
-PARAM_RESULT_FACET_INFO_COUNT = "count"
-PARAM_RESULT_FACET_INFO_SELECTED = "selected"
-
-#
-# JSON API parameter constants
-#
-
-JSON_PARAM_COLUMNS = "columns"
-JSON_PARAM_EXPLAIN = "explain"
-JSON_PARAM_FACETS = "facets"
-JSON_PARAM_FACET_INIT = "facetInit"
-JSON_PARAM_FETCH_STORED = "fetchStored"
-JSON_PARAM_FETCH_TERM_VECTORS = "fetchTermVectors"
-JSON_PARAM_FILTER = "filter"
-JSON_PARAM_FROM = "from"
-JSON_PARAM_GROUPBY = "groupBy"
-JSON_PARAM_PARTITIONS = "partitions"
-JSON_PARAM_QUERY = "query"
-JSON_PARAM_QUERY_STRING = "query_string"
-JSON_PARAM_ROUTEPARAM = "routeParam"
-JSON_PARAM_SELECTIONS = "selections"
-JSON_PARAM_SIZE = "size"
-JSON_PARAM_SORT = "sort"
-JSON_PARAM_TOP = "top"
-JSON_PARAM_VALUES = "values"
-JSON_PARAM_EXCLUDES = "excludes"
-JSON_PARAM_OPERATOR = "operator"
-JSON_PARAM_NO_OPTIMIZE = "_noOptimize"
-
-# Group by related column names
-GROUP_VALUE = "groupvalue"
-GROUP_HITS = "grouphits"
-
-# Default constants
-DEFAULT_REQUEST_OFFSET = 0
-DEFAULT_REQUEST_COUNT = 10
-DEFAULT_REQUEST_MAX_PER_GROUP = 10
-DEFAULT_FACET_MINHIT = 1
-DEFAULT_FACET_MAXHIT = 10
-DEFAULT_FACET_ORDER = PARAM_FACET_ORDER_HITS
-
-#
-# Utilities for result display
-#
-
-def print_line(keys, max_lens, char='-', sep_char='+'):
-  sys.stdout.write(sep_char)
-  for key in keys:
-    sys.stdout.write(char * (max_lens[key] + 2) + sep_char)
-  sys.stdout.write('\n')
 
-def print_header(keys, max_lens, char='-', sep_char='+'):
-  print_line(keys, max_lens, char=char, sep_char=sep_char)
-  sys.stdout.write('|')
-  for key in keys:
-    sys.stdout.write(' %s%s |' % (key, ' ' * (max_lens[key] - len(key))))
-  sys.stdout.write('\n')
-  print_line(keys, max_lens, char=char, sep_char=sep_char)
-
-def print_footer(keys, max_lens, char='-', sep_char='+'):
-  print_line(keys, max_lens, char=char, sep_char=sep_char)
-
-def safe_str(obj):
-  """Return the byte string representation of obj."""
-  try:
-    return str(obj)
-  except UnicodeEncodeError:
-    # obj is unicode
-    return unicode(obj).encode("unicode_escape")
-
-
-class SenseiClientError(Exception):
-  """Exception raised for all errors related to Sensei client."""
-
-  def __init__(self, value):
-    self.value = value
-
-  def __str__(self):
-    return repr(self.value)
+logger = logging.getLogger("sensei_client_lib")
 
 
 class SenseiFacets:
@@ -238,17 +81,6 @@ class SenseiSelectionPath(SenseiSelection):
     self.selection={"path": {column : {"value":value, "strict":strict, "depth":depth}}}
     
 
-class SenseiQuery:
-  def __init__(self, type):
-    self.type = type
-    self.query = {}
-    
-  def get_type(self):
-    return self.type
-  
-  def get_query(self):
-    return self.query  
-
 class SenseiQueryMatchAll(SenseiQuery):
   def __init__(self):
     SenseiQuery.__init__(self, "match_all")
@@ -366,11 +198,6 @@ class SenseiQueryString(SenseiQuery):
     return self
                                 
    
-class SenseiQueryText(SenseiQuery):
-  def __init__(self, message, operator, type):
-    SenseiQuery.__init__(self, "text")
-    self.query={"text":{"message":message, "operator":operator, "type":type}}   
-    
 class SenseiQueryTerm(SenseiQuery):
   def __init__(self, column, value):
     SenseiQuery.__init__(self, "term")
@@ -383,18 +210,6 @@ class SenseiQueryTerm(SenseiQuery):
     return self  
         
                   
-class SenseiFilter:
-  def __init__(self, type):
-    self.type = type
-    self.filter = {}
-    
-  def get_type(self):
-    return self.type
-  
-  def get_filter(self):
-    return self.filter  
-  
-    
 class SenseiFilterIDs(SenseiFilter):
   def __init__(self, values, excludes):
     SenseiFilter.__init__(self, "ids")
@@ -441,43 +256,6 @@ class SenseiFilterBool(SenseiFilter):
       target = (self.filter)["bool"]
       target["should"]=should_filters_json
       
-class SenseiFilterAND(SenseiFilter):
-  def __init__(self, filter_list):
-    SenseiFilter.__init__(self, "and")
-    self.filter={"and":[]}
-    old_filter_list = (self.filter)["and"]
-    if isinstance(filter_list, list):
-      for new_filter in filter_list:
-        if isinstance(new_filter, SenseiFilter):
-          old_filter_list.append(new_filter.get_filter())  
-          
-class SenseiFilterOR(SenseiFilter):
-  def __init__(self, filter_list):
-    SenseiFilter.__init__(self, "or")
-    self.filter={"or":[]}
-    old_filter_list = (self.filter)["or"]
-    if isinstance(filter_list, list):
-      for new_filter in filter_list:
-        if isinstance(new_filter, SenseiFilter):
-          old_filter_list.append(new_filter.get_filter())              
-    
-class SenseiFilterTerm(SenseiFilter):
-  def __init__(self, column, value, noOptimize=False):
-    SenseiFilter.__init__(self, "term")
-    self.filter={"term":{column:{"value": value, "_noOptimize":noOptimize}}} 
-    
-
-class SenseiFilterTerms(SenseiFilter):
-  def __init__(self, column, values=None, excludes=None, operator="or", noOptimize=False):
-    SenseiFilter.__init__(self, "terms")
-    self.filter={"terms":{}}
-    if values is not None and isinstance(values, list):
-      if excludes is  not None and isinstance(excludes, list):
-        # complicated mode
-        self.filter={"terms":{column:{"values":values, "excludes":excludes, "operator":operator, "_noOptimize":noOptimize}}}
-      else:
-        self.filter={"terms":{column:values}}
-        
 class SenseiFilterRange(SenseiFilter):
   def __init__(self, column, from_val, to_val):
     SenseiFilter.__init__(self, "range")
@@ -493,13 +271,6 @@ class SenseiFilterRange(SenseiFilter):
           value["_date_format"]=date_format
     return self
   
-class SenseiFilterQuery(SenseiFilter):
-  def __init__(self, query):
-    SenseiFilter.__init__(self, "query")
-    self.filter={"query":{}}
-    if isinstance(query, SenseiQuery):
-      self.filter={"query": query.get_query()}
-      
 class SenseiFilterSelection(SenseiFilter):
   def __init__(self, selection):
     SenseiFilter.__init__(self, "selection")
@@ -508,36 +279,6 @@ class SenseiFilterSelection(SenseiFilter):
       self.filter={"selection":selection.get_selection()}        
     
     
-class SenseiSort:
-  def __init__(self, field, reverse=False):
-    self.field = field
-    self.dir = None
-    if not (field == PARAM_SORT_SCORE or
-            field == PARAM_SORT_SCORE_REVERSE or
-            field == PARAM_SORT_DOC or
-            field == PARAM_SORT_DOC_REVERSE):
-      if reverse:
-        self.dir = PARAM_SORT_DESC
-      else:
-        self.dir = PARAM_SORT_ASC
-
-  def __str__(self):
-    return self.build_sort_field()
-
-  def build_sort_field(self):
-    if self.dir:
-      return self.field + ":" + self.dir
-    else:
-      return self.field
-
-  def build_sort_spec(self):
-    if self.dir:
-      return {self.field: self.dir}
-    elif self.field == PARAM_SORT_SCORE:
-      return "_score"
-    else:
-      return self.field
-
 class SenseiFacetInits:
   def __init__(self):
     self.facet_init={}
@@ -558,166 +299,6 @@ class SenseiFacetInits:
     return self.facet_init
            
 
-class SenseiFacetInfo:
-
-  def __init__(self, name, runtime=False, props={}):
-    self.name = name
-    self.runtime = runtime
-    self.props = props
-
-  def get_name(self):
-    return self.name
-
-  def set_name(self, name):
-    self.name = name
-
-  def get_runtime(self):
-    return self.runtime
-
-  def set_runtime(self, runtime):
-    self.runtime = runtime
-
-  def get_props(self):
-    return self.props
-
-  def set_props(self, props):
-    self.props = props
-
-
-class SenseiNodeInfo:
-
-  def __init__(self, id, partitions, node_link, admin_link):
-    self.id = id
-    self.partitions = partitions
-    self.node_link = node_link
-    self.admin_link = admin_link
-
-  def get_id(self):
-    return self.id
-
-  def get_partitions(self):
-    return self.partitions
-
-  def get_node_link(self):
-    return self.node_link
-
-  def get_admin_link(self):
-    return self.admin_link
-
-
-class SenseiSystemInfo:
-
-  def __init__(self, json_data):
-    logger.debug("json_data = %s" % json_data)
-    self.num_docs = int(json_data.get(PARAM_SYSINFO_NUMDOCS))
-    self.last_modified = long(json_data.get(PARAM_SYSINFO_LASTMODIFIED))
-    self.version = json_data.get(PARAM_SYSINFO_VERSION)
-    self.facet_infos = []
-    for facet in json_data.get(PARAM_SYSINFO_FACETS):
-      facet_info = SenseiFacetInfo(facet.get(PARAM_SYSINFO_FACETS_NAME),
-                                   facet.get(PARAM_SYSINFO_FACETS_RUNTIME),
-                                   facet.get(PARAM_SYSINFO_FACETS_PROPS))
-      self.facet_infos.append(facet_info)
-    # TODO: get cluster_info
-    self.cluster_info = None
-
-  def display(self):
-    """Display sysinfo."""
-
-    keys = ["facet_name", "facet_type", "runtime", "column", "column_type", "depends"]
-    max_lens = None
-    # XXX add existing flags
-
-    def get_max_lens(columns):
-      max_lens = {}
-      for column in columns:
-        max_lens[column] = len(column)
-      for facet_info in self.facet_infos:
-        props = facet_info.get_props()
-
-        tmp_len = len(facet_info.get_name())
-        if tmp_len > max_lens["facet_name"]:
-          max_lens["facet_name"] = tmp_len
-
-        tmp_len = len(props.get("type"))
-        if tmp_len > max_lens["facet_type"]:
-          max_lens["facet_type"] = tmp_len
-
-        # runtime can only contain "true" or "false", so len("runtime")
-        # is big enough
-
-        tmp_len = len(props.get("column"))
-        if tmp_len > max_lens["column"]:
-          max_lens["column"] = tmp_len
-
-        tmp_len = len(props.get("column_type"))
-        if tmp_len > max_lens["column_type"]:
-          max_lens["column_type"] = tmp_len
-
-        tmp_len = len(props.get("depends"))
-        if tmp_len > max_lens["depends"]:
-          max_lens["depends"] = tmp_len
-      return max_lens
-
-    max_lens = get_max_lens(keys)
-    print_header(keys, max_lens)
-
-    for facet_info in self.facet_infos:
-      props = facet_info.get_props()
-      sys.stdout.write('|')
-      val = facet_info.get_name()
-      sys.stdout.write(' %s%s |' % (val, ' ' * (max_lens["facet_name"] - len(val))))
-
-      val = props.get("type")
-      sys.stdout.write(' %s%s |' % (val, ' ' * (max_lens["facet_type"] - len(val))))
-
-      val = facet_info.get_runtime() and "true" or "false"
-      sys.stdout.write(' %s%s |' % (val, ' ' * (max_lens["runtime"] - len(val))))
-
-      val = props.get("column")
-      sys.stdout.write(' %s%s |' % (val, ' ' * (max_lens["column"] - len(val))))
-
-      val = props.get("column_type")
-      sys.stdout.write(' %s%s |' % (val, ' ' * (max_lens["column_type"] - len(val))))
-
-      val = props.get("depends")
-      sys.stdout.write(' %s%s |' % (val, ' ' * (max_lens["depends"] - len(val))))
-
-      sys.stdout.write('\n')
-
-    print_footer(keys, max_lens)
-
-  def get_num_docs(self):
-    return self.num_docs
-
-  def set_num_docs(self, num_docs):
-    self.num_docs = num_docs
-
-  def get_last_modified(self):
-    return self.last_modified
-
-  def set_last_modified(self, last_modified):
-    self.last_modified = last_modified
-
-  def get_facet_infos(self):
-    return self.facet_infos
-
-  def set_facet_infos(self, facet_infos):
-    self.facet_infos = facet_infos
-
-  def get_version(self):
-    return self.version
-
-  def set_version(self, version):
-    self.version = version
-
-  def get_cluster_info(self):
-    return self.cluster_info
-
-  def set_cluster_info(self, cluster_info):
-    self.cluster_info = cluster_info
-
-
 class SenseiRequest:
 
   def __init__(self,
@@ -834,22 +415,11 @@ class SenseiHit:
       self.srcData = None
   
 
-class SenseiResultFacet:
-  value = None
-  count = None
-  selected = None
-  
-  def load(self,json):
-    self.value=json.get(PARAM_RESULT_FACET_INFO_VALUE)
-    self.count=json.get(PARAM_RESULT_FACET_INFO_COUNT)
-    self.selected=json.get(PARAM_RESULT_FACET_INFO_SELECTED,False)
-
-  
 class SenseiResult:
   """Sensei search results for a query."""
 
   def __init__(self, json_data):
-    logger.debug("json_data = %s" % json_data)
+    logger.debug("json_data = %s", json_data)
     self.jsonMap = json_data
     self.parsedQuery = json_data.get(PARAM_RESULT_PARSEDQUERY)
     self.totalDocs = json_data.get(PARAM_RESULT_TOTALDOCS, 0)
@@ -992,21 +562,24 @@ class SenseiResult:
 class SenseiServiceProxy:
   """Sensei client class."""
 
-  def __init__(self, host='localhost', port=8080, path='sensei', sysinfo=None):
+  def __init__(self, host='localhost', port=8080, path='sensei', sysinfo=None, codec=None,
+               compression=False):
     self.host = host
     self.port = port
     self.path = path
     self.url = 'http://%s:%d/%s' % (self.host, self.port, self.path)
-    self.opener = urllib2.build_opener()
-    self.opener.addheaders = [('User-agent', 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_6_7) AppleWebKit/534.30 (KHTML, like Gecko) Chrome/12.0.742.91 Safari/534.30')]
+    # Connections to the broker are kept alive and shared by all clients
+    self.pool = get_connection_pool(self.host, self.port)
+    # JSON codec for broker responses (see sensei_codec)
+    self.codec = get_codec(codec)
+    # Whether the broker may compress its responses
+    self.compression = compression
 
     if sysinfo:
       self.sysinfo = SenseiSystemInfo(sysinfo)
     else:
-      urlReq = urllib2.Request(self.url + "/sysinfo")
-      res = self.opener.open(urlReq)
-      line = res.read()
-      jsonObj = json.loads(line)
+      line = self.pool.request("/%s/sysinfo" % self.path, compression=self.compression)
+      jsonObj = self.codec.decode(line)
       # print json.dumps(jsonObj, indent=4)
       self.sysinfo = SenseiSystemInfo(jsonObj)
     self.facet_map = {}
@@ -1185,10 +758,8 @@ class SenseiServiceProxy:
     else:
       query_string = SenseiClient.buildUrlString(req)
     logger.debug(query_string)
-    urlReq = urllib2.Request(self.url, query_string)
-    res = self.opener.open(urlReq)
-    line = res.read()
-    jsonObj = json.loads(line)
+    line = self.pool.request("/" + self.path, query_string, compression=self.compression)
+    jsonObj = self.codec.decode(line)
     res = SenseiResult(jsonObj)
     delta = datetime.now() - time1
     res.total_time = delta.seconds * 1000 + delta.microseconds / 1000
@@ -1199,25 +770,30 @@ class SenseiServiceProxy:
        The input is either a list of ID numbers, or ID strings;
        The output is a jsonarray string;
     """
-    ids_str = '['
-    count = 0
-    for id in ids:
-      if count == 0 :
-        ids_str = ids_str + str(id)
-      else:
-        ids_str = ids_str + ',' + str(id)
-    ids_str = ids_str+ ']'
-    ids = '[1,2]'
-    urlReq = urllib2.Request(self.url + '/get', ids_str)
-    res = self.opener.open(urlReq)
-    #print res.read()
-    return res.read()
+    ids_str = json.dumps([safe_str(id) for id in ids])
+    return self.pool.request("/%s/get" % self.path, ids_str, compression=self.compression)
+
+  def multi_get(self, ids, chunk_size=DEFAULT_GET_CHUNK_SIZE,
+                max_chunk_bytes=DEFAULT_GET_CHUNK_BYTES, parallelism=DEFAULT_GET_PARALLELISM):
+    """Get the source data of documents, as a {uid: data} dict.
+
+    The IDs are sent in chunks, several at once (see sensei_get).
+    """
+    path = "/%s/get" % self.path
+    request = lambda body: self.pool.request(path, body, compression=self.compression)
+    return dict(iter_docs(request, self.codec.decode, ids, chunk_size, max_chunk_bytes,
+                          parallelism))
 
   def get_sysinfo(self):
     return self.sysinfo
 
   def get_facet_map(self):
     return self.facet_map
+
+  def get_pool_stats(self):
+    """Get the hit/miss counters of the broker connection pool."""
+
+    return self.pool.get_stats()
   
 
 
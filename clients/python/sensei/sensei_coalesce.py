@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Sharing one request among threads that make it at the same time.
+
+When many threads send the same search at once, for instance when a
+popular page expires from an upstream cache, only one of them needs to
+reach the broker: the others wait for its answer.
+
+"""
+
+import sys
+import threading
+
+
+class _Call:
+  """A call in flight, and its outcome once done."""
+
+  def __init__(self):
+    self.done = threading.Event()
+    self.value = None
+    self.exc_info = None
+
+
+class SingleFlight:
+  """Run at most one call per key at a time, sharing its outcome.
+
+  A thread calling do() with the key of a call in flight waits for that
+  call and gets its return value, or its exception, instead of making
+  the call itself.  Calls made after one finished are made again.
+
+  """
+
+  def __init__(self):
+    self._calls = {}
+    self._lock = threading.Lock()
+    self.calls = 0                      # Calls made
+    self.shared = 0                     # Calls answered by another thread's call
+
+  def do(self, key, func):
+    """Return func(), or the outcome of the call in flight for key."""
+
+    self._lock.acquire()
+    try:
+      call = self._calls.get(key)
+      if call is None:
+        call = self._calls[key] = _Call()
+        self.calls += 1
+        leader = True
+      else:
+        self.shared += 1
+        leader = False
+    finally:
+      self._lock.release()
+
+    if not leader:
+      call.done.wait()
+      if call.exc_info is not None:
+        raise call.exc_info[0], call.exc_info[1], call.exc_info[2]
+      return call.value
+
+    try:
+      call.value = func()
+    except:
+      call.exc_info = sys.exc_info()
+      raise
+    finally:
+      self._lock.acquire()
+      try:
+        del self._calls[key]
+      finally:
+        self._lock.release()
+      call.done.set()
+    return call.value
+
+  def get_stats(self):
+    """Return the counters as a dict."""
+
+    return {"calls": self.calls, "shared": self.shared, "in_flight": len(self._calls)}
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""JSON codecs for Sensei broker responses.
+
+Decoding responses is where the client spends most of its CPU, so the
+JSON module used for it can be chosen: ujson, simplejson (with its C
+speedups) or the standard json module.  The standard module is used
+unless another codec is asked for, per client with codec=..., or for all
+clients with set_default_codec().  The faster modules may decode some
+values differently, such as floats (ujson rounds them differently) or
+strings (simplejson returns str instead of unicode for ASCII text), so
+they are opt-in; get_available_codecs()[0] is the fastest one installed.
+Requests are still built with the standard module, which they need for
+sort_keys and default.
+
+"""
+
+import json
+
+
+class JsonCodec:
+  """Encode and decode JSON with one JSON module."""
+
+  def __init__(self, name, loads, dumps):
+    self.name = name
+    self.loads = loads
+    self.dumps = dumps
+
+  def decode(self, text):
+    return self.loads(text)
+
+  def encode(self, obj):
+    return self.dumps(obj)
+
+  def __repr__(self):
+    return "<JsonCodec %s>" % self.name
+
+
+def _make_ujson():
+  import ujson
+  return JsonCodec("ujson", ujson.loads, ujson.dumps)
+
+def _make_simplejson():
+  import simplejson
+  if not simplejson._speedups:
+    # The pure Python decoder is no faster than the standard one
+    raise ImportError("simplejson speedups are not available")
+  return JsonCodec("simplejson", simplejson.loads, simplejson.dumps)
+
+def _make_json():
+  return JsonCodec("json", json.loads, json.dumps)
+
+# Known codecs, fastest first
+CODEC_FACTORIES = [
+  ("ujson", _make_ujson),
+  ("simplejson", _make_simplejson),
+  ("json", _make_json),
+  ]
+
+_codecs = {}
+_default_codec = None
+
+def get_codec(name=None):
+  """Return the codec with the given name, or the default codec.
+
+  Raises ValueError for unknown names and ImportError for codecs whose
+  JSON module is not installed.  A codec object is returned as is.
+
+  """
+
+  if name is None:
+    return get_default_codec()
+  if isinstance(name, JsonCodec):
+    return name
+  codec = _codecs.get(name)
+  if codec is None:
+    factories = dict(CODEC_FACTORIES)
+    if name not in factories:
+      raise ValueError("Unknown JSON codec: %s" % name)
+    codec = _codecs[name] = factories[name]()
+  return codec
+
+def get_available_codecs():
+  """Return the names of the codecs that can be used, fastest first."""
+
+  names = []
+  for name, factory in CODEC_FACTORIES:
+    try:
+      get_codec(name)
+      names.append(name)
+    except ImportError:
+      pass
+  return names
+
+def get_default_codec():
+  """Return the codec used by clients that are not given one: json unless set."""
+
+  global _default_codec
+  if _default_codec is None:
+    _default_codec = get_codec("json")
+  return _default_codec
+
+def set_default_codec(codec):
+  """Set the codec used by clients that are not given one."""
+
+  global _default_codec
+  _default_codec = get_codec(codec)
+
+
+class LazyJson:
+  """Wrap an object so that it is encoded only when formatted.
+
+  Pass it as an argument of a logging call so that nothing is encoded
+  unless the message is actually logged:
+
+    logger.debug("Result: %s", LazyJson(result))
+
+  """
+
+  def __init__(self, obj):
+    self.obj = obj
+
+  def __str__(self):
+    return json.dumps(self.obj)
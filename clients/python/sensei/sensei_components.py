@@ -11,8 +11,6 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
-import urllib
-import urllib2
 import json
 import sys
 import logging
@@ -21,6 +19,8 @@ from datetime import datetime
 import time
 import re
 
+from sensei_codec import get_default_codec
+
 logger = logging.getLogger("sensei_components")
 
 # Regular expression that matches a range facet value
@@ -91,6 +91,7 @@ PARAM_RESULT_HIT_UID = "uid"
 PARAM_RESULT_HIT_DOCID = "docid"
 PARAM_RESULT_HIT_SCORE = "score"
 PARAM_RESULT_HIT_SRC_DATA = "srcdata"
+PARAM_RESULT_HIT_SRC_DATA_FIELD = "_srcdata"   # Name used by the broker
 PARAM_RESULT_TIME = "time"
 PARAM_RESULT_SELECT_LIST = "select_list"
 PARAM_RESULT_ERRORS = "errors"
@@ -149,6 +150,7 @@ JSON_PARAM_NO_OPTIMIZE = "_noOptimize"
 # Group by related column names
 GROUP_VALUE = "groupvalue"
 GROUP_HITS = "grouphits"
+GROUP_HITS_COUNT = "grouphitscount"
 
 # Default constants
 DEFAULT_REQUEST_OFFSET = 0
@@ -722,7 +724,7 @@ class SenseiNodeInfo:
 class SenseiSystemInfo:
 
   def __init__(self, json_data):
-    logger.debug("json_data = %s" % json_data)
+    logger.debug("json_data = %s", json_data)
     self.num_docs = int(json_data.get(PARAM_SYSINFO_NUMDOCS))
     self.last_modified = long(json_data.get(PARAM_SYSINFO_LASTMODIFIED))
     self.version = json_data.get(PARAM_SYSINFO_VERSION)
@@ -732,8 +734,13 @@ class SenseiSystemInfo:
                                    facet.get(PARAM_SYSINFO_FACETS_RUNTIME),
                                    facet.get(PARAM_SYSINFO_FACETS_PROPS))
       self.facet_infos.append(facet_info)
-    # TODO: get cluster_info
-    self.cluster_info = None
+    self.cluster_info = []
+    for node in json_data.get(PARAM_SYSINFO_CLUSTERINFO) or []:
+      node_info = SenseiNodeInfo(node.get(PARAM_SYSINFO_CLUSTERINFO_ID),
+                                 node.get(PARAM_SYSINFO_CLUSTERINFO_PARTITIONS) or [],
+                                 node.get(PARAM_SYSINFO_CLUSTERINFO_NODELINK),
+                                 node.get(PARAM_SYSINFO_CLUSTERINFO_ADMINLINK))
+      self.cluster_info.append(node_info)
 
   def display(self):
     """Display sysinfo."""
@@ -843,6 +850,7 @@ class SenseiRequest:
     self.qParam = {}
     self.explain = False
     self.route_param = None
+    self.partitions = None      # Only search these partitions, if given
     self.prepare_time = 0       # Statement prepare time in milliseconds
     self.stmt_type = "unknown"
 
@@ -861,6 +869,8 @@ class SenseiRequest:
         self.query = bql_req.get_query()
         self.offset = bql_req.get_offset() or offset
         self.count = bql_req.get_count() or count
+        # Whether count was given by a LIMIT clause, or is the default
+        self.has_limit = bql_req.get_count() is not None
         self.columns = bql_req.get_columns()
         self.sorts = bql_req.get_sorts()
         self.selections = bql_req.get_selections()
@@ -879,11 +889,12 @@ class SenseiRequest:
         self.facet_init_param_map = bql_req.get_facet_init_param_map()
         delta = datetime.now() - time1
         self.prepare_time = delta.seconds * 1000 + delta.microseconds / 1000
-        logger.debug("Prepare time: %sms" % self.prepare_time)
+        logger.debug("Prepare time: %sms", self.prepare_time)
     else:
       self.query = None
       self.offset = offset
       self.count = count
+      self.has_limit = True
       self.columns = []
       self.sorts = None
       self.selections = []
@@ -912,6 +923,9 @@ class SenseiRequest:
     
   def set_route_param(self, route_param):
     self.route_param = route_param
+
+  def set_partitions(self, partitions):
+    self.partitions = partitions
     
   def set_sorts(self, sorts):    
     self.sorts = sorts
@@ -970,27 +984,75 @@ class SenseiRequest:
     return self.columns
 
   
-class SenseiHit:
-  def __init__(self):
-    self.docid = None
-    self.uid = None
-    self.srcData = {}
-    self.score = None
-    self.explanation = None
-    self.stored = None
-  
+# Marks a source document that has not been decoded yet
+_NOT_DECODED = object()
+
+def _hit_field(name):
+  """A SenseiHit attribute read from, and written to, its JSON hit."""
+
+  def _get(self):
+    return self._json.get(name)
+  def _set(self, value):
+    self._json[name] = value
+  return property(_get, _set)
+
+class SenseiHit(object):
+  """A hit of a search result.
+
+  A hit is a lightweight view on the JSON hit returned by the broker.  Its
+  fields are read from the JSON hit when asked for, and the source
+  document is decoded from JSON on first access only, then kept.  Callers
+  that only need uid and score never pay for decoding wide documents.  It
+  is decoded with codec (see sensei_codec), or the default codec.
+
+  Setting uid, docid, score, explanation or stored writes to the JSON hit.
+  Other attributes may be added to a hit as before; their dictionary is
+  only created when one is.
+
+  """
+
+  __slots__ = ("_json", "_src_data", "_codec", "__dict__")
+
+  def __init__(self, jsonHit=None, codec=None):
+    self._codec = codec
+    self.load(jsonHit or {})
+    if jsonHit is None:
+      # An empty hit, to be filled in by the caller
+      self._src_data = {}
+
   def load(self, jsonHit):
-    self.docid = jsonHit.get(PARAM_RESULT_HIT_DOCID)
-    self.uid = jsonHit.get(PARAM_RESULT_HIT_UID)
-    self.score = jsonHit.get(PARAM_RESULT_HIT_SCORE)
-    srcStr = jsonHit.get(PARAM_RESULT_HIT_SRC_DATA)
-    self.explanation = jsonHit.get(PARAM_RESULT_HIT_EXPLANATION)
-    self.stored = jsonHit.get(PARAM_RESULT_HIT_STORED_FIELDS)
-    if srcStr:
-      self.srcData = json.loads(srcStr)
-    else:
-      self.srcData = None
-  
+    self._json = jsonHit
+    self._src_data = _NOT_DECODED
+    return self
+
+  def get(self, name, default=None):
+    """Get the value of a field of the hit."""
+
+    return self._json.get(name, default)
+
+  def get_json(self):
+    return self._json
+
+  def _get_src_data(self):
+    if self._src_data is _NOT_DECODED:
+      srcStr = (self._json.get(PARAM_RESULT_HIT_SRC_DATA) or
+                self._json.get(PARAM_RESULT_HIT_SRC_DATA_FIELD))
+      if srcStr:
+        self._src_data = (self._codec or get_default_codec()).decode(srcStr)
+      else:
+        self._src_data = None
+    return self._src_data
+
+  def _set_src_data(self, src_data):
+    self._src_data = src_data
+
+  srcData = property(_get_src_data, _set_src_data)
+  docid = _hit_field(PARAM_RESULT_HIT_DOCID)
+  uid = _hit_field(PARAM_RESULT_HIT_UID)
+  score = _hit_field(PARAM_RESULT_HIT_SCORE)
+  explanation = _hit_field(PARAM_RESULT_HIT_EXPLANATION)
+  stored = _hit_field(PARAM_RESULT_HIT_STORED_FIELDS)
+
 
 class SenseiResultFacet:
   value = None
@@ -1004,10 +1066,14 @@ class SenseiResultFacet:
 
   
 class SenseiResult:
-  """Sensei search results for a query."""
+  """Sensei search results for a query.
 
-  def __init__(self, json_data):
-    logger.debug("json_data = %s" % json_data)
+  codec decodes the source documents of the hits (see SenseiHit).
+
+  """
+
+  def __init__(self, json_data, codec=None):
+    logger.debug("json_data = %s", json_data)
     self.jsonMap = json_data
     self.parsedQuery = json_data.get(PARAM_RESULT_PARSEDQUERY)
     self.totalDocs = json_data.get(PARAM_RESULT_TOTALDOCS, 0)
@@ -1015,6 +1081,8 @@ class SenseiResult:
     self.total_time = 0
     self.numHits = json_data.get(PARAM_RESULT_NUMHITS, 0)
     self.hits = json_data.get(PARAM_RESULT_HITS)
+    self._hit_views = None
+    self.codec = codec
     self.errors = json_data.get(PARAM_RESULT_ERRORS)
     map = json_data.get(PARAM_RESULT_FACETS)
     self.facetMap = {}
@@ -1027,6 +1095,29 @@ class SenseiResult:
           facetList.append(facetObj)
         self.facetMap[k]=facetList
 
+  def get_hits(self):
+    """Get the hits as SenseiHit views, which are built on first use.
+
+    The raw JSON hits are still available as self.hits.
+
+    """
+
+    if self._hit_views is None:
+      self._hit_views = [SenseiHit(hit, self.codec) for hit in self.hits or []]
+    return self._hit_views
+
+  def to_columns(self, columns=None, facet_map=None):
+    """Get the hits as a SenseiFrame, with one array per column.
+
+    Group hits are flattened into rows carrying their group value.
+    Column types come from the facet infos in facet_map (see
+    SenseiClient.get_facet_map).  This needs NumPy.
+
+    """
+
+    from sensei_frame import build_frame
+    return build_frame(self.hits, columns, facet_map)
+
   def display(self, columns=['*'], max_col_width=40):
     """Print the results in SQL SELECT result format."""
 
@@ -1047,9 +1138,10 @@ class SenseiResult:
       if len(srcdata_subcols) > 0:
         srcdata_subcols_selected = True
 
-      for hit in self.hits:
-        if srcdata_subcols_selected and hit.has_key('_srcdata'):
-          srcdata_json = json.loads(hit.get('_srcdata'))
+      for hit, hit_view in zip(self.hits, self.get_hits()):
+        if srcdata_subcols_selected and hit.has_key(PARAM_RESULT_HIT_SRC_DATA_FIELD):
+          # Decoded once, and shared with the hit's srcData
+          srcdata_json = hit_view.srcData
           for subcol in srcdata_subcols:
             new_col = '_srcdata.' + subcol
             if srcdata_json.has_key(subcol):
@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Searching several Sensei clusters at once.
+
+FederatedSenseiClient sends a request to the broker of each cluster in
+parallel, and merges the results as one broker merges the results of its
+partitions: hits are sorted by the sorts of the request, groups of a
+GROUP BY are joined and cut to their TOP n, and facet counts are added
+up, then filtered and cut by the facet specs of BROWSE BY.
+
+"""
+
+import copy
+import logging
+import sys
+import threading
+from datetime import datetime
+
+from sensei_components import *
+from sensei_client import SenseiClient
+from sensei_balancer import parse_broker
+
+logger = logging.getLogger("sensei_federated")
+
+# Column types whose values are sorted as numbers
+NUMERIC_COLUMN_TYPES = ("int", "short", "long", "float", "double")
+
+
+def _first_value(hit, field):
+  value = hit.get(field)
+  if isinstance(value, list):
+    # Facet values of a hit come as lists of strings
+    value = value and value[0] or None
+  return value
+
+def _number_key(field):
+  def _key(hit):
+    value = _first_value(hit, field)
+    try:
+      return float(value)
+    except (TypeError, ValueError):
+      return value
+  return _key
+
+def _string_key(field):
+  return lambda hit: _first_value(hit, field)
+
+def _sort_keys(sorts, facet_map=None):
+  """Return the (key, reverse) pairs hits are sorted by, most significant first."""
+
+  keys = []
+  for sort in sorts or [SenseiSort(PARAM_SORT_SCORE)]:
+    if sort.field == PARAM_SORT_SCORE:
+      keys.append((_number_key(PARAM_RESULT_HIT_SCORE), True))
+    elif sort.field == PARAM_SORT_SCORE_REVERSE:
+      keys.append((_number_key(PARAM_RESULT_HIT_SCORE), False))
+    elif sort.field == PARAM_SORT_DOC:
+      keys.append((_number_key(PARAM_RESULT_HIT_DOCID), False))
+    elif sort.field == PARAM_SORT_DOC_REVERSE:
+      keys.append((_number_key(PARAM_RESULT_HIT_DOCID), True))
+    else:
+      key = _number_key(sort.field)
+      facet_info = facet_map and facet_map.get(sort.field)
+      if (facet_info and
+          facet_info.get_props().get("column_type") not in NUMERIC_COLUMN_TYPES):
+        key = _string_key(sort.field)
+      keys.append((key, sort.dir == PARAM_SORT_DESC))
+  return keys
+
+def sort_hits(hits, sorts=None, facet_map=None):
+  """Sort JSON hits by the sorts of a request.
+
+  Without sorts, hits are sorted by relevance.  Field values are compared
+  as numbers, unless facet_map says the column holds strings.  Hits that
+  compare equal keep their order.
+
+  """
+
+  hits = list(hits)
+  # Stable sorts, least significant key first
+  for key, reverse in reversed(_sort_keys(sorts, facet_map)):
+    hits.sort(key=key, reverse=reverse)
+  return hits
+
+def merge_groups(hits, max_per_group, sorts=None, facet_map=None):
+  """Join the sorted group hits of several results that have the same group value.
+
+  Each group keeps the fields of its best hit, its max_per_group best
+  group hits, and the sum of its hit counts.
+
+  """
+
+  groups = {}
+  merged = []
+  for hit in hits:
+    value = hit.get(GROUP_VALUE)
+    group = groups.get(value)
+    if group is None:
+      groups[value] = group = dict(hit)
+      group[GROUP_HITS] = list(hit.get(GROUP_HITS) or [])
+      merged.append(group)
+      continue
+    group[GROUP_HITS].extend(hit.get(GROUP_HITS) or [])
+    if GROUP_HITS_COUNT in hit:
+      group[GROUP_HITS_COUNT] = group.get(GROUP_HITS_COUNT, 0) + hit[GROUP_HITS_COUNT]
+  for group in merged:
+    group[GROUP_HITS] = sort_hits(group[GROUP_HITS], sorts, facet_map)[:max_per_group]
+  return merged
+
+def merge_facets(facet_lists, spec=None):
+  """Add up the counts of the values of one facet in several results.
+
+  facet_lists holds the JSON facet values of each result.  Values with
+  fewer than spec.minHits hits are dropped, unless selected, and at most
+  spec.maxCounts values are kept, in the order of spec.orderBy.  A value
+  cut from the top values of one result is missing the count it had
+  there.
+
+  """
+
+  spec = spec or SenseiFacet()
+  counts = {}
+  selected = {}
+  for facets in facet_lists:
+    for facet in facets or []:
+      value = facet.get(PARAM_RESULT_FACET_INFO_VALUE)
+      counts[value] = counts.get(value, 0) + facet.get(PARAM_RESULT_FACET_INFO_COUNT, 0)
+      selected[value] = (selected.get(value, False) or
+                         facet.get(PARAM_RESULT_FACET_INFO_SELECTED, False))
+  values = [value for value in counts
+            if counts[value] >= spec.minHits or selected[value]]
+  if spec.orderBy == PARAM_FACET_ORDER_VAL:
+    values.sort()
+  else:
+    values.sort(key=lambda value: (-counts[value], value))
+  if spec.maxCounts > 0:
+    values = values[:spec.maxCounts]
+  return [{PARAM_RESULT_FACET_INFO_VALUE: value,
+           PARAM_RESULT_FACET_INFO_COUNT: counts[value],
+           PARAM_RESULT_FACET_INFO_SELECTED: selected[value]}
+          for value in values]
+
+def merge_results(req, results, facet_map=None):
+  """Merge the JSON results of a request sent to several clusters.
+
+  Each cluster must have been asked for the first req.offset + req.count
+  hits; the merged result holds hits req.offset to req.offset + req.count.
+
+  """
+
+  hits = []
+  facet_names = []
+  errors = []
+  merged = {PARAM_RESULT_NUMHITS: 0, PARAM_RESULT_TOTALDOCS: 0, PARAM_RESULT_TIME: 0}
+  for result in results:
+    hits.extend(result.get(PARAM_RESULT_HITS) or [])
+    for name in (result.get(PARAM_RESULT_FACETS) or {}):
+      if name not in facet_names:
+        facet_names.append(name)
+    errors.extend(result.get(PARAM_RESULT_ERRORS) or [])
+    merged[PARAM_RESULT_NUMHITS] += result.get(PARAM_RESULT_NUMHITS, 0)
+    merged[PARAM_RESULT_TOTALDOCS] += result.get(PARAM_RESULT_TOTALDOCS, 0)
+    # The clusters are searched at the same time
+    merged[PARAM_RESULT_TIME] = max(merged[PARAM_RESULT_TIME], result.get(PARAM_RESULT_TIME, 0))
+
+  hits = sort_hits(hits, req.sorts, facet_map)
+  if req.groupby:
+    hits = merge_groups(hits, req.max_per_group, req.sorts, facet_map)
+  merged[PARAM_RESULT_HITS] = hits[req.offset:req.offset + req.count]
+
+  facets = {}
+  for name in facet_names:
+    facets[name] = merge_facets([(result.get(PARAM_RESULT_FACETS) or {}).get(name)
+                                 for result in results],
+                                req.facets.get(name))
+  merged[PARAM_RESULT_FACETS] = facets
+  if errors:
+    merged[PARAM_RESULT_ERRORS] = errors
+  return merged
+
+
+class FederatedSenseiClient:
+  """A Sensei client that searches several clusters and merges their results.
+
+  clusters is a list of SenseiClient objects, or of "host:port" strings
+  or (host, port) tuples of brokers, for which clients are made with the
+  other keyword arguments.  The clusters must have the same facets;
+  statements are compiled by the first one.
+
+  If a cluster fails, doQuery() raises its error, or with allow_partial
+  returns the results of the other clusters, with an error for each
+  failed one in the errors of the result.
+
+  """
+
+  def __init__(self, clusters, allow_partial=False, **kwargs):
+    self.clients = []
+    for cluster in clusters:
+      if not isinstance(cluster, SenseiClient):
+        host, port = parse_broker(cluster)
+        cluster = SenseiClient(host, port, **kwargs)
+      self.clients.append(cluster)
+    if not self.clients:
+      raise ValueError("No clusters given")
+    self.allow_partial = allow_partial
+
+  def compile(self, bql_stmt):
+    return self.clients[0].compile(bql_stmt)
+
+  def get_facet_map(self):
+    return self.clients[0].get_facet_map()
+
+  def doQuery(self, req, using_json=True, var_map={}):
+    """Execute a search query on all clusters and merge the results."""
+
+    if req.stmt_type == "desc":
+      raise SenseiClientError("Only searches can be sent to several clusters")
+    # Any of the first offset + count hits may come from any cluster
+    cluster_req = copy.copy(req)
+    cluster_req.offset = 0
+    cluster_req.count = req.offset + req.count
+
+    time1 = datetime.now()
+    results = [None] * len(self.clients)
+    failures = [None] * len(self.clients)
+    def _search(i):
+      try:
+        results[i] = self.clients[i].doQuery(cluster_req, using_json, var_map)
+      except:
+        failures[i] = sys.exc_info()
+    threads = [threading.Thread(target=_search, args=(i,))
+               for i in xrange(1, len(self.clients))]
+    for thread in threads:
+      thread.setDaemon(True)
+      thread.start()
+    _search(0)
+    for thread in threads:
+      thread.join()
+
+    errors = []
+    for client, failure in zip(self.clients, failures):
+      if failure is None:
+        continue
+      if not self.allow_partial:
+        raise failure[0], failure[1], failure[2]
+      logger.warning("Cluster %s failed: %s", client.url, failure[1])
+      errors.append({PARAM_RESULT_ERROR_MESSAGE: "%s: %s" % (client.url, failure[1]),
+                     PARAM_RESULT_ERROR_TYPE: failure[0].__name__})
+
+    merged = merge_results(req, [result.jsonMap for result in results if result is not None],
+                           self.clients[0].facet_map)
+    if errors:
+      merged[PARAM_RESULT_ERRORS] = merged.get(PARAM_RESULT_ERRORS, []) + errors
+    res = SenseiResult(merged, self.clients[0].codec)
+    delta = datetime.now() - time1
+    res.total_time = delta.seconds * 1000 + delta.microseconds / 1000
+    return res
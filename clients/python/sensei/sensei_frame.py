@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Columnar frames built from Sensei search results.
+
+A frame holds one array per column instead of one dict per hit, so that
+aggregations can be done with NumPy rather than in Python loops.  NumPy
+is only needed when a frame is built.
+
+"""
+
+from sensei_components import *
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+# Column types of the fields every hit has
+HIT_COLUMN_TYPES = {
+  PARAM_RESULT_HIT_UID: "long",
+  PARAM_RESULT_HIT_DOCID: "int",
+  PARAM_RESULT_HIT_SCORE: "float",
+  }
+
+INT_COLUMN_TYPES = set(["int", "long", "short"])
+FLOAT_COLUMN_TYPES = set(["float", "double"])
+MULTI_FACET_TYPES = set(["multi", "weighted-multi"])
+
+# Fields that are not columns of their own
+SKIPPED_FIELDS = set([GROUP_HITS, PARAM_RESULT_HIT_SRC_DATA, PARAM_RESULT_HIT_SRC_DATA_FIELD])
+
+
+class DictColumn:
+  """A dictionary-encoded column.
+
+  Each row is stored as an index (code) into the list of distinct values
+  of the column, or -1 if the row has no value.
+
+  """
+
+  def __init__(self, codes, values):
+    self.codes = codes
+    self.values = values
+
+  def __len__(self):
+    return len(self.codes)
+
+  def __getitem__(self, i):
+    code = self.codes[i]
+    if code < 0:
+      return None
+    return self.values[code]
+
+  def decode(self):
+    """Return the values of all rows as a list."""
+
+    return [self[i] for i in xrange(len(self.codes))]
+
+  def equals(self, value):
+    """Return a boolean array telling which rows hold value."""
+
+    try:
+      return self.codes == self.values.index(value)
+    except ValueError:
+      return numpy.zeros(len(self.codes), dtype=bool)
+
+  def value_counts(self):
+    """Return a dict of the number of rows holding each value."""
+
+    counts = numpy.bincount(self.codes[self.codes >= 0], minlength=len(self.values))
+    return dict(zip(self.values, counts.tolist()))
+
+
+class SenseiFrame:
+  """Columns of a search result, in row order.
+
+  Numeric columns are NumPy arrays (float columns with missing values use
+  NaN; int columns with missing values become float columns), string
+  columns are DictColumns and multi-valued columns are object arrays of
+  lists.
+
+  """
+
+  def __init__(self, columns, data, num_rows):
+    self.columns = columns
+    self.data = data
+    self.num_rows = num_rows
+
+  def __len__(self):
+    return self.num_rows
+
+  def __getitem__(self, column):
+    return self.data[column]
+
+  def __contains__(self, column):
+    return column in self.data
+
+  def get_columns(self):
+    return self.columns
+
+
+def _flatten_hits(hits):
+  """Return the rows of hits, with group hits turned into rows.
+
+  Each group hit gets the group value of the hit it belongs to.
+
+  """
+
+  rows = []
+  for hit in hits:
+    group_hits = hit.get(GROUP_HITS)
+    if group_hits is None:
+      rows.append(hit)
+      continue
+    group_value = hit.get(GROUP_VALUE)
+    for group_hit in group_hits:
+      if GROUP_VALUE not in group_hit:
+        group_hit = dict(group_hit)
+        group_hit[GROUP_VALUE] = group_value
+      rows.append(group_hit)
+  return rows
+
+def _single(value):
+  # Facet values come back as lists, even for single-valued facets
+  if isinstance(value, list):
+    if not value:
+      return None
+    return value[0]
+  return value
+
+def _infer_column_type(values):
+  column_type = "int"
+  for value in values:
+    if value is None:
+      continue
+    if isinstance(value, bool) or not isinstance(value, (int, long, float)):
+      return "string"
+    if isinstance(value, float):
+      column_type = "float"
+  return column_type
+
+def _numeric_column(values, dtype):
+  if dtype is int and None not in values:
+    return numpy.array([int(value) for value in values], dtype=numpy.int64)
+  return numpy.array([value is None and numpy.nan or float(value) for value in values],
+                     dtype=numpy.float64)
+
+def _dict_column(values):
+  index = {}
+  distinct = []
+  codes = numpy.empty(len(values), dtype=numpy.int32)
+  for i, value in enumerate(values):
+    if value is None:
+      codes[i] = -1
+      continue
+    code = index.get(value)
+    if code is None:
+      code = index[value] = len(distinct)
+      distinct.append(value)
+    codes[i] = code
+  return DictColumn(codes, distinct)
+
+def _make_column(rows, column, facet_info):
+  column_type = HIT_COLUMN_TYPES.get(column)
+  if facet_info is not None:
+    props = facet_info.get_props()
+    column_type = props.get("column_type")
+    if props.get("type") in MULTI_FACET_TYPES:
+      data = numpy.empty(len(rows), dtype=object)
+      for i, row in enumerate(rows):
+        data[i] = row.get(column) or []
+      return data
+
+  values = [_single(row.get(column)) for row in rows]
+  if column_type is None:
+    column_type = _infer_column_type(values)
+  if column_type in INT_COLUMN_TYPES:
+    return _numeric_column(values, int)
+  elif column_type in FLOAT_COLUMN_TYPES:
+    return _numeric_column(values, float)
+  return _dict_column(values)
+
+def build_frame(hits, columns=None, facet_map=None):
+  """Build a SenseiFrame from the JSON hits of a search result.
+
+  The types of facet columns come from the column_type of their
+  SenseiFacetInfo in facet_map; other columns are typed by their values.
+  By default all columns of the first row are included.
+
+  """
+
+  if numpy is None:
+    raise SenseiClientError("NumPy is needed to build columns from search results")
+  facet_map = facet_map or {}
+  rows = _flatten_hits(hits or [])
+  if columns is None:
+    columns = []
+    if rows:
+      columns = sorted(name for name in rows[0] if name not in SKIPPED_FIELDS)
+  data = {}
+  for column in columns:
+    data[column] = _make_column(rows, column, facet_map.get(column))
+  return SenseiFrame(list(columns), data, len(rows))
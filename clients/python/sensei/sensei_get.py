@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Fetching the source data of documents by uid through /get.
+
+The broker's /get takes a JSON array of uids and answers with a JSON
+object mapping each uid found to its source data.  iter_docs() splits a
+large set of uids into bounded chunks and sends several of them at once,
+so that no single request or response grows with the number of uids.
+
+"""
+
+import json
+import sys
+import threading
+import Queue
+
+from sensei_components import safe_str
+
+# Most uids sent in one /get request
+DEFAULT_GET_CHUNK_SIZE = 100
+
+# Most bytes in the body of one /get request
+DEFAULT_GET_CHUNK_BYTES = 16 * 1024
+
+# Most /get requests in flight at once
+DEFAULT_GET_PARALLELISM = 4
+
+
+def chunk_uids(uids, chunk_size=DEFAULT_GET_CHUNK_SIZE, max_bytes=DEFAULT_GET_CHUNK_BYTES):
+  """Split uids into JSON arrays of at most chunk_size uids and about max_bytes bytes.
+
+  Duplicate uids are sent once.
+
+  """
+
+  seen = set()
+  chunk = []
+  size = 2
+  for uid in uids:
+    uid = safe_str(uid)
+    if uid in seen:
+      continue
+    seen.add(uid)
+    # The quotes and the separator
+    uid_size = len(uid) + 3
+    if chunk and (len(chunk) >= chunk_size or size + uid_size > max_bytes):
+      yield json.dumps(chunk)
+      chunk = []
+      size = 2
+    chunk.append(uid)
+    size += uid_size
+  if chunk:
+    yield json.dumps(chunk)
+
+def iter_docs(request, decode, uids, chunk_size=DEFAULT_GET_CHUNK_SIZE,
+              max_chunk_bytes=DEFAULT_GET_CHUNK_BYTES, parallelism=DEFAULT_GET_PARALLELISM):
+  """Generate (uid, source data) pairs for the documents found among uids.
+
+  request(body) sends a /get request and returns the response body.
+  Chunks are sent by up to parallelism threads, and each response is
+  only decoded when the caller gets to it, in the order the responses
+  arrive.  Closing the generator stops the threads after the requests
+  they have in flight.
+
+  """
+
+  bodies = list(chunk_uids(uids, chunk_size, max_chunk_bytes))
+  if len(bodies) <= 1 or parallelism <= 1:
+    for body in bodies:
+      for item in decode(request(body)).iteritems():
+        yield item
+    return
+
+  chunks = Queue.Queue()
+  for body in bodies:
+    chunks.put(body)
+  responses = Queue.Queue()
+
+  def _fetch():
+    while True:
+      try:
+        body = chunks.get_nowait()
+      except Queue.Empty:
+        return
+      try:
+        responses.put((request(body), None))
+      except:
+        responses.put((None, sys.exc_info()))
+
+  for i in xrange(min(parallelism, len(bodies))):
+    thread = threading.Thread(target=_fetch)
+    thread.setDaemon(True)
+    thread.start()
+  try:
+    for i in xrange(len(bodies)):
+      line, failure = responses.get()
+      if failure is not None:
+        raise failure[0], failure[1], failure[2]
+      for item in decode(line).iteritems():
+        yield item
+  finally:
+    # Chunks not sent yet are dropped
+    try:
+      while True:
+        chunks.get_nowait()
+    except Queue.Empty:
+      pass
@@ -10,6 +10,7 @@ import logging
 import re
 
 from sensei_client import *
+from pyparsing import ParseException
 
 PARSER_AGENT_PORT = 18888
 
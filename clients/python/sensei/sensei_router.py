@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Routing of requests straight to the Sensei node that owns their data.
+
+The system info of a broker lists the nodes of the cluster with the
+partitions each of them serves (see SenseiNodeInfo).  A request limited
+to some partitions, or carrying a route parameter, can be sent to a node
+serving all the partitions it needs, skipping the broker hop.
+
+"""
+
+import httplib
+import socket
+import threading
+import urllib2
+import urlparse
+import zlib
+
+from sensei_transport import get_connection_pool
+
+# Errors after which a request is sent to the broker instead of the node
+NODE_ERRORS = (urllib2.URLError, httplib.HTTPException, socket.error)
+
+
+class ClusterRouter:
+  """Choose the node a request is sent to.
+
+  Only nodes serving every partition a request needs are used.  Among
+  those, the route parameter picks the same node every time, so that
+  requests for one key hit the same node, as they would through the
+  broker.
+
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self.routed = 0                     # Requests sent straight to a node
+    self.fallbacks = 0                  # Requests sent to the broker after a node failed
+
+  def route(self, cluster_info, partitions=None, route_param=None):
+    """Return the SenseiNodeInfo to send a request to, or None for the broker."""
+
+    if not cluster_info or (not partitions and route_param is None):
+      return None
+    if partitions:
+      needed = set(partitions)
+    else:
+      needed = set()
+      for node in cluster_info:
+        needed.update(node.get_partitions())
+    candidates = [node for node in cluster_info
+                  if node.get_admin_link() and needed.issubset(node.get_partitions())]
+    if not candidates:
+      return None
+    candidates.sort(key=lambda node: node.get_id())
+    if route_param is None:
+      return candidates[0]
+    return candidates[(zlib.crc32(str(route_param)) & 0xffffffff) % len(candidates)]
+
+  def get_pool(self, node):
+    """Return the connection pool for the HTTP server of a node."""
+
+    url = urlparse.urlparse(node.get_admin_link())
+    return get_connection_pool(url.hostname, url.port or 80)
+
+  def count(self, routed=0, fallbacks=0):
+    self._lock.acquire()
+    try:
+      self.routed += routed
+      self.fallbacks += fallbacks
+    finally:
+      self._lock.release()
+
+  def get_stats(self):
+    """Return the routing counters as a dict."""
+
+    return {"routed": self.routed, "fallbacks": self.fallbacks}
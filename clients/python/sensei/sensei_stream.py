@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Incremental parsing of search results as they arrive from the broker.
+
+A search response is one JSON object, whose "hits" array can run into
+megabytes.  SenseiResultStream reads the response a chunk at a time and
+hands out each hit as soon as its JSON text is complete, so that memory
+use depends on the chunk size and the size of one hit, not on the number
+of hits.
+
+"""
+
+import re
+from collections import deque
+
+from sensei_components import *
+from sensei_codec import get_codec
+
+# Bytes read from the response at a time
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_STRING = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"', re.DOTALL)
+# Text up to the next bracket, with any complete strings in it
+_SKIP = re.compile(r'(?:[^][{}"]+|"[^"\\]*(?:\\.[^"\\]*)*")*', re.DOTALL)
+_SCALAR_END = re.compile(r'[],} \t\n\r]')
+
+
+class JsonScanner:
+  """Split JSON text read from a stream into the text of its values.
+
+  The scanner only finds where values start and end; decoding them is
+  left to a codec.  Text before the value being scanned is dropped when
+  more is read, so the buffer holds at most one value plus one chunk.
+
+  """
+
+  def __init__(self, read, chunk_size=DEFAULT_CHUNK_SIZE):
+    self.read = read
+    self.chunk_size = chunk_size
+    self.buf = ""
+    self.pos = 0                        # Next character to scan
+    self.mark = 0                       # Start of the text still needed
+
+  def _fill(self):
+    chunk = self.read(self.chunk_size)
+    if not chunk:
+      raise ValueError("Unexpected end of JSON text")
+    self.buf = self.buf[self.mark:] + chunk
+    self.pos -= self.mark
+    self.mark = 0
+
+  def peek(self):
+    """Skip whitespace and return the next character, without consuming it."""
+
+    while True:
+      self.pos = _WHITESPACE.match(self.buf, self.pos).end()
+      if self.pos < len(self.buf):
+        return self.buf[self.pos]
+      self.mark = self.pos
+      self._fill()
+
+  def expect(self, chars):
+    """Consume the next character, which must be one of chars."""
+
+    c = self.peek()
+    if c not in chars:
+      raise ValueError("Expected one of %r at %r" % (chars, self.buf[self.pos:self.pos + 20]))
+    self.pos += 1
+    return c
+
+  def scan_value(self):
+    """Consume the next value and return its JSON text."""
+
+    c = self.peek()
+    self.mark = self.pos
+    if c == '"':
+      m = _STRING.match(self.buf, self.pos)
+      while m is None:
+        self._fill()
+        m = _STRING.match(self.buf, self.pos)
+      self.pos = m.end()
+      return self.buf[self.mark:self.pos]
+    elif c not in '{[':
+      # A number, true, false or null
+      while True:
+        m = _SCALAR_END.search(self.buf, self.pos)
+        if m is not None:
+          self.pos = m.start()
+          break
+        self.pos = len(self.buf)
+        self._fill()
+      return self.buf[self.mark:self.pos]
+
+    # An object or array: only brackets outside strings count
+    depth = 0
+    while True:
+      self.pos = _SKIP.match(self.buf, self.pos).end()
+      if self.pos == len(self.buf):
+        self._fill()
+        continue
+      c = self.buf[self.pos]
+      if c == '"':
+        # The rest of the string has not been read yet
+        self._fill()
+      elif c in '{[':
+        depth += 1
+        self.pos += 1
+      else:
+        depth -= 1
+        self.pos += 1
+        if depth == 0:
+          break
+    return self.buf[self.mark:self.pos]
+
+
+class SenseiResultStream:
+  """A search result that is parsed while it is read from the broker.
+
+  Iterating over the stream yields the hits as SenseiHit objects, one at
+  a time.  Other top-level fields (numhits, facets, time, ...) are found
+  with get() once they have been parsed.  Asking for a field that comes
+  after the hits in the response reads ahead, keeping the hits passed
+  over until they are iterated over.
+
+  """
+
+  def __init__(self, response, codec=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    self.response = response
+    self.codec = get_codec(codec)
+    self.fields = {}
+    self._pending = deque()
+    self.scanner = JsonScanner(response.read, chunk_size)
+    self._events = self._parse(self.scanner)
+    self._done = False
+
+  def _parse(self, scanner):
+    """Generate ("hit", hit) and ("field", (name, value)) events."""
+
+    decode = self.codec.decode
+    scanner.expect("{")
+    if scanner.peek() == "}":
+      return
+    while True:
+      name = decode(scanner.scan_value())
+      scanner.expect(":")
+      if name == PARAM_RESULT_HITS and scanner.peek() == "[":
+        scanner.expect("[")
+        if scanner.peek() != "]":
+          while True:
+            yield "hit", decode(scanner.scan_value())
+            if scanner.expect(",]") == "]":
+              break
+        else:
+          scanner.expect("]")
+      else:
+        yield "field", (name, decode(scanner.scan_value()))
+      if scanner.expect(",}") == "}":
+        return
+
+  def _next_event(self):
+    try:
+      return self._events.next()
+    except StopIteration:
+      self._done = True
+      self.response.close()
+      return None
+    except:
+      self._done = True
+      self.response.close()
+      raise
+
+  def __iter__(self):
+    while True:
+      if self._pending:
+        yield SenseiHit(self._pending.popleft(), self.codec)
+        continue
+      if self._done:
+        return
+      event = self._next_event()
+      if event is None:
+        return
+      kind, value = event
+      if kind == "hit":
+        yield SenseiHit(value, self.codec)
+      else:
+        self.fields[value[0]] = value[1]
+
+  def get(self, name, default=None):
+    """Get a top-level field of the result, reading ahead if needed."""
+
+    while name not in self.fields and not self._done:
+      event = self._next_event()
+      if event is None:
+        break
+      kind, value = event
+      if kind == "hit":
+        self._pending.append(value)
+      else:
+        self.fields[value[0]] = value[1]
+    return self.fields.get(name, default)
+
+  def get_num_hits(self):
+    return self.get(PARAM_RESULT_NUMHITS, 0)
+
+  def get_total_docs(self):
+    return self.get(PARAM_RESULT_TOTALDOCS, 0)
+
+  def get_time(self):
+    return self.get(PARAM_RESULT_TIME, 0)
+
+  def get_errors(self):
+    return self.get(PARAM_RESULT_ERRORS)
+
+  def get_facets(self):
+    return self.get(PARAM_RESULT_FACETS)
+
+  def close(self):
+    """Stop reading the result."""
+
+    self._done = True
+    self.response.close()
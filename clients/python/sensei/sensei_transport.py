@@ -0,0 +1,462 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""HTTP transport for the Sensei clients.
+
+All requests to a broker go through a SenseiConnectionPool, which keeps a
+bounded number of HTTP/1.1 keep-alive connections open so that consecutive
+queries do not pay for a new TCP handshake each time.
+
+Responses may be compressed with gzip or deflate if the caller asks for
+it; they are decompressed while they are read.
+"""
+
+import httplib
+import logging
+import select
+import socket
+from StringIO import StringIO
+import threading
+import time
+import urllib2
+import zlib
+
+logger = logging.getLogger("sensei_transport")
+
+USER_AGENT = 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_6_7) AppleWebKit/534.30 (KHTML, like Gecko) Chrome/12.0.742.91 Safari/534.30'
+
+# Default pool settings
+DEFAULT_POOL_MAX_SIZE = 8
+DEFAULT_POOL_IDLE_TIMEOUT = 60      # Seconds an idle connection is kept around
+DEFAULT_POOL_ACQUIRE_TIMEOUT = None # Wait forever for a free connection
+
+# Content codings the pool can decode
+ACCEPT_ENCODING = "gzip, deflate"
+
+# Request bodies smaller than this are not worth compressing
+COMPRESS_MIN_SIZE = 1024
+
+
+class SenseiConnectionPool:
+  """A bounded, thread-safe pool of keep-alive connections to one broker.
+
+  At most max_size connections (idle plus in use) are open at any time;
+  callers block until a connection is handed back once the limit is
+  reached.  Idle connections are evicted after idle_timeout seconds, and
+  every idle connection is health-checked before it is reused.
+
+  """
+
+  def __init__(self, host, port,
+               max_size=DEFAULT_POOL_MAX_SIZE,
+               idle_timeout=DEFAULT_POOL_IDLE_TIMEOUT,
+               acquire_timeout=DEFAULT_POOL_ACQUIRE_TIMEOUT,
+               timeout=None):
+    self.host = host
+    self.port = port
+    self.max_size = max_size
+    self.idle_timeout = idle_timeout
+    self.acquire_timeout = acquire_timeout
+    self.timeout = timeout
+    self._idle = []                     # [(connection, last_used_time)]
+    self._num_open = 0
+    self._cond = threading.Condition(threading.Lock())
+    self.hits = 0                       # Requests served by a pooled connection
+    self.misses = 0                     # Requests that had to open a connection
+    self.evictions = 0                  # Idle connections dropped (stale or dead)
+    self.wire_bytes_sent = 0            # Request bodies, as sent
+    self.bytes_sent = 0                 # Request bodies, before compression
+    self.wire_bytes_received = 0        # Response bodies, as received
+    self.bytes_received = 0             # Response bodies, after decompression
+
+  def _new_connection(self):
+    if self.timeout is None:
+      return httplib.HTTPConnection(self.host, self.port)
+    return httplib.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+  def _set_timeout(self, conn, timeout):
+    """Apply the socket timeout of one request, or the pool's, to a connection."""
+
+    if timeout is None:
+      timeout = self.timeout
+    if timeout is None:
+      timeout = socket.getdefaulttimeout()
+    conn.timeout = timeout
+    if conn.sock is not None:
+      conn.sock.settimeout(timeout)
+
+  @staticmethod
+  def is_connection_dropped(conn):
+    """Check whether an idle connection has been closed by the broker.
+
+    An idle keep-alive socket should never be readable; if it is, the
+    peer has either closed it or sent garbage, and it cannot be reused.
+
+    """
+
+    sock = conn.sock
+    if sock is None:
+      return True
+    try:
+      readable, _, _ = select.select([sock], [], [], 0.0)
+    except (select.error, socket.error, ValueError):
+      return True
+    return bool(readable)
+
+  def _evict(self, conn):
+    """Close a connection that will not be reused.  Caller holds the lock."""
+
+    self.evictions += 1
+    self._num_open -= 1
+    conn.close()
+    self._cond.notify()
+
+  def _evict_expired(self, now):
+    """Drop idle connections past their idle timeout.  Caller holds the lock."""
+
+    if self.idle_timeout is None:
+      return
+    live = []
+    for conn, last_used in self._idle:
+      if now - last_used > self.idle_timeout:
+        self._evict(conn)
+      else:
+        live.append((conn, last_used))
+    self._idle = live
+
+  def evict_idle(self):
+    """Drop all idle connections that have expired or been closed."""
+
+    self._cond.acquire()
+    try:
+      self._evict_expired(time.time())
+      live = []
+      for conn, last_used in self._idle:
+        if self.is_connection_dropped(conn):
+          self._evict(conn)
+        else:
+          live.append((conn, last_used))
+      self._idle = live
+    finally:
+      self._cond.release()
+
+  def acquire(self):
+    """Check out a connection, reusing a healthy idle one when possible.
+
+    Return a (connection, reused) tuple.
+
+    """
+
+    deadline = None
+    if self.acquire_timeout is not None:
+      deadline = time.time() + self.acquire_timeout
+    self._cond.acquire()
+    try:
+      while True:
+        self._evict_expired(time.time())
+        while self._idle:
+          conn, _ = self._idle.pop()
+          if self.is_connection_dropped(conn):
+            self._evict(conn)
+            continue
+          self.hits += 1
+          return conn, True
+        if self._num_open < self.max_size:
+          self._num_open += 1
+          self.misses += 1
+          return self._new_connection(), False
+        if deadline is None:
+          self._cond.wait()
+        else:
+          remaining = deadline - time.time()
+          if remaining <= 0:
+            raise urllib2.URLError("Timed out waiting for a connection to %s:%d"
+                                   % (self.host, self.port))
+          self._cond.wait(remaining)
+    finally:
+      self._cond.release()
+
+  def release(self, conn, reusable=True):
+    """Hand a connection back to the pool, or close it if not reusable."""
+
+    self._cond.acquire()
+    try:
+      if reusable and conn.sock is not None:
+        self._idle.append((conn, time.time()))
+      else:
+        self._num_open -= 1
+        conn.close()
+      self._cond.notify()
+    finally:
+      self._cond.release()
+
+  def close(self):
+    """Close all idle connections."""
+
+    self._cond.acquire()
+    try:
+      for conn, _ in self._idle:
+        self._num_open -= 1
+        conn.close()
+      self._idle = []
+      self._cond.notify_all()
+    finally:
+      self._cond.release()
+
+  def get_stats(self):
+    """Return the pool counters as a dict."""
+
+    self._cond.acquire()
+    try:
+      return {"hits": self.hits,
+              "misses": self.misses,
+              "evictions": self.evictions,
+              "open": self._num_open,
+              "idle": len(self._idle),
+              "wire_bytes_sent": self.wire_bytes_sent,
+              "bytes_sent": self.bytes_sent,
+              "wire_bytes_received": self.wire_bytes_received,
+              "bytes_received": self.bytes_received}
+    finally:
+      self._cond.release()
+
+  def count_bytes(self, wire_sent=0, sent=0, wire_received=0, received=0):
+    """Add to the byte counters."""
+
+    self._cond.acquire()
+    try:
+      self.wire_bytes_sent += wire_sent
+      self.bytes_sent += sent
+      self.wire_bytes_received += wire_received
+      self.bytes_received += received
+    finally:
+      self._cond.release()
+
+  def urlopen(self, path, data=None, headers=None, compression=False, compress_request=False,
+              timeout=None, on_connection=None):
+    """Send a request over a pooled connection and return the response.
+
+    A POST is sent if data is given, otherwise a GET.  The connection goes
+    back to the pool once the response body has been read in full; closing
+    the response early discards the connection instead.  HTTP errors are
+    raised as urllib2.HTTPError and network errors as urllib2.URLError,
+    just like urllib2.urlopen does.
+
+    With compression, the broker may send a gzip or deflate compressed
+    response, which is decompressed as it is read.  With compress_request,
+    request bodies of COMPRESS_MIN_SIZE bytes or more are sent gzipped;
+    only use it with brokers that accept compressed requests.
+
+    A timeout, in seconds, overrides the one of the pool for each socket
+    operation of this request, reading the response body included.
+
+    on_connection, if given, is called with the connection once the
+    request has it, and with None before it goes back to the pool.  In
+    between, another thread may abort the request by shutting down the
+    socket of the connection.
+
+    """
+
+    req_headers = {"User-agent": USER_AGENT}
+    if data is not None:
+      req_headers["Content-Type"] = "application/x-www-form-urlencoded"
+      size = len(data)
+      if compress_request and size >= COMPRESS_MIN_SIZE:
+        data = gzip_encode(data)
+        req_headers["Content-Encoding"] = "gzip"
+      self.count_bytes(wire_sent=len(data), sent=size)
+    if compression:
+      req_headers["Accept-Encoding"] = ACCEPT_ENCODING
+    if headers:
+      req_headers.update(headers)
+    method = data is None and "GET" or "POST"
+
+    while True:
+      conn, reused = self.acquire()
+      try:
+        if on_connection is not None:
+          on_connection(conn)
+        self._set_timeout(conn, timeout)
+        conn.request(method, path, data, req_headers)
+        res = conn.getresponse()
+        break
+      except (httplib.HTTPException, socket.error) as err:
+        if on_connection is not None:
+          on_connection(None)
+        self.release(conn, reusable=False)
+        if reused and not isinstance(err, socket.timeout):
+          # The broker closed the keep-alive connection between our health
+          # check and the request; retry once on a fresh connection.
+          logger.debug("Stale pooled connection to %s:%d: %s" % (self.host, self.port, err))
+          continue
+        raise urllib2.URLError(err)
+      except:
+        if on_connection is not None:
+          on_connection(None)
+        self.release(conn, reusable=False)
+        raise
+
+    pooled_res = PooledResponse(self, conn, res, on_connection)
+    if res.status >= 400:
+      body = pooled_res.read()
+      raise urllib2.HTTPError("http://%s:%d%s" % (self.host, self.port, path),
+                              res.status, res.reason, res.msg, StringIO(body))
+    return pooled_res
+
+  def request(self, path, data=None, headers=None, compression=False, compress_request=False,
+              timeout=None):
+    """Send a request and return the whole response body."""
+
+    return self.urlopen(path, data, headers, compression, compress_request, timeout).read()
+
+
+class PooledResponse:
+  """An HTTP response whose connection goes back to its pool when done.
+
+  A gzip or deflate compressed body is decompressed as it is read.
+
+  """
+
+  def __init__(self, pool, conn, response, on_connection=None):
+    self.pool = pool
+    self.conn = conn
+    self.response = response
+    self.on_connection = on_connection
+    self.status = response.status
+    self.reason = response.reason
+    self.msg = response.msg
+    self.decoder = None
+    encoding = (response.getheader("content-encoding") or "").strip().lower()
+    if encoding in ("gzip", "x-gzip"):
+      self.decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif encoding == "deflate":
+      self.decoder = _DeflateDecoder()
+    self._decoded = ""
+
+  def getheader(self, name, default=None):
+    return self.response.getheader(name, default)
+
+  def _read_raw(self, amt):
+    if self.conn is None:
+      return ''
+    try:
+      data = self.response.read(amt)
+    except:
+      self.close()
+      raise
+    if self.response.isclosed():
+      self._release(not self.response.will_close)
+    return data
+
+  def read(self, amt=None):
+    if self.decoder is None:
+      data = self._read_raw(amt)
+      self.pool.count_bytes(wire_received=len(data), received=len(data))
+      return data
+
+    while amt is None or len(self._decoded) < amt:
+      if self.conn is None:
+        break
+      raw = self._read_raw(amt)
+      decoded = self.decoder.decompress(raw)
+      if self.conn is None:
+        decoded += self.decoder.flush()
+      self.pool.count_bytes(wire_received=len(raw), received=len(decoded))
+      self._decoded += decoded
+    if amt is None:
+      data, self._decoded = self._decoded, ""
+    else:
+      data, self._decoded = self._decoded[:amt], self._decoded[amt:]
+    return data
+
+  def close(self):
+    """Close the response, discarding the connection if the body is unread."""
+
+    if self.conn is not None:
+      self._release(False)
+
+  def _release(self, reusable):
+    conn, self.conn = self.conn, None
+    if self.on_connection is not None:
+      self.on_connection(None)
+    self.pool.release(conn, reusable)
+
+
+class _DeflateDecoder:
+  """Decode a deflate body, with or without the zlib wrapper.
+
+  HTTP says deflate means zlib-wrapped data, but some servers send raw
+  deflate data; try the former first.
+
+  """
+
+  def __init__(self):
+    self.decoder = zlib.decompressobj()
+    self.started = False
+
+  def decompress(self, data):
+    if not self.started and data:
+      self.started = True
+      try:
+        return self.decoder.decompress(data)
+      except zlib.error:
+        self.decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+    return self.decoder.decompress(data)
+
+  def flush(self):
+    return self.decoder.flush()
+
+
+def gzip_encode(data):
+  """Compress data in the gzip format."""
+
+  compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+  return compressor.compress(data) + compressor.flush()
+
+
+#
+# Process-wide pool registry, so that all clients talking to the same
+# broker share one set of connections.
+#
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_connection_pool(host, port, **kwargs):
+  """Return the shared connection pool for a broker, creating it if needed.
+
+  Keyword arguments are passed to SenseiConnectionPool when the pool is
+  created and ignored afterwards.
+
+  """
+
+  key = (host, port)
+  _pools_lock.acquire()
+  try:
+    pool = _pools.get(key)
+    if pool is None:
+      pool = SenseiConnectionPool(host, port, **kwargs)
+      _pools[key] = pool
+    return pool
+  finally:
+    _pools_lock.release()
+
+def get_connection_pool_stats():
+  """Return the counters of all shared pools, keyed by "host:port"."""
+
+  _pools_lock.acquire()
+  try:
+    pools = _pools.values()
+  finally:
+    _pools_lock.release()
+  return dict(("%s:%d" % (pool.host, pool.port), pool.get_stats()) for pool in pools)
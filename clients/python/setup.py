@@ -13,6 +13,7 @@ setup(
   author        = 'senseidb.com',
   url           = 'https://github.com/senseidb/sensei',
   install_requires = ['pyparsing', 'twisted'],
+  extras_require = {'columns': ['numpy']},
   packages      = find_packages(),
   classifiers   = ['Development Status :: 5 - Production/Stable',
                    'Intended Audience :: Developers',
@@ -0,0 +1,170 @@
+"""A minimal in-process Sensei broker used by the client tests.
+
+It speaks HTTP/1.1 with keep-alive and serves /sensei, /sensei/sysinfo and
+/sensei/get from canned data, so the transport code can be tested without
+a running Sensei cluster.
+"""
+
+import json
+import zlib
+import socket
+import threading
+import BaseHTTPServer
+import SocketServer
+
+CARS_SYSINFO = {
+  "lastmodified": 0,
+  "version": "4957216",
+  "numdocs": 15000,
+  "facets": [
+    {"runtime": False, "name": "color",
+     "props": {"column": "color", "depends": "[]", "type": "simple", "column_type": "string"}},
+    {"runtime": False, "name": "category",
+     "props": {"column": "category", "depends": "[]", "type": "simple", "column_type": "string"}},
+    {"runtime": False, "name": "year",
+     "props": {"column": "year", "range": "[1993-1994, 1995-1996, 1997-1998, 1999-2000, 2001-2002]",
+               "depends": "[]", "type": "range", "column_type": "int"}},
+    {"runtime": False, "name": "price",
+     "props": {"column": "price", "range": "[*-6700, 6800-9900, 10000-13100, 13200-17300, 17400-*]",
+               "depends": "[]", "type": "range", "column_type": "float"}},
+    {"runtime": False, "name": "mileage",
+     "props": {"column": "mileage", "range": "[*-12500, 12501-15000, 15001-17500, 17501-*]",
+               "depends": "[]", "type": "range", "column_type": "int"}},
+    {"runtime": False, "name": "tags",
+     "props": {"column": "tags", "depends": "[]", "type": "multi", "column_type": "string"}},
+    {"runtime": False, "name": "makemodel",
+     "props": {"column": "makemodel", "depends": "[]", "type": "path", "column_type": "string"}},
+    ],
+  "clusterinfo": [
+    {"adminlink": "http://192.168.1.104:8080", "nodelink": "192.168.1.104:1234",
+     "id": 1, "partitions": [0, 1]}
+    ],
+  }
+
+
+def unused_port():
+  """Return a local port nothing listens on."""
+
+  sock = socket.socket()
+  sock.bind(("127.0.0.1", 0))
+  port = sock.getsockname()[1]
+  sock.close()
+  return port
+
+def make_hit(uid, **fields):
+  hit = {"uid": str(uid), "docid": str(uid), "score": 1.0,
+         "srcdata": json.dumps(dict(fields, id=uid))}
+  for name, value in fields.items():
+    hit[name] = [str(value)]
+  return hit
+
+def make_cars(num):
+  colors = ["red", "blue", "white", "black", "silver"]
+  return [make_hit(i, color=colors[i % len(colors)], year=1993 + i % 10,
+                   price=float(5000 + 100 * i))
+          for i in xrange(num)]
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+  protocol_version = "HTTP/1.1"
+
+  def setup(self):
+    BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+    self.server.broker.num_connections += 1
+
+  def log_message(self, *args):
+    pass
+
+  def _handle(self):
+    broker = self.server.broker
+    length = int(self.headers.getheader("Content-Length") or 0)
+    body = length and self.rfile.read(length) or None
+    if body and self.headers.getheader("Content-Encoding") == "gzip":
+      body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+    broker.requests.append((self.command, self.path, body, dict(self.headers)))
+    status, data, headers = broker.respond(self.path, body, self.headers)
+    accepted = self.headers.getheader("Accept-Encoding") or ""
+    if broker.encoding and broker.encoding.split("-")[-1] in accepted:
+      data = broker.encode(data)
+      headers = headers + [("Content-Encoding", broker.encoding.split("-")[-1])]
+    self.send_response(status)
+    for name, value in headers:
+      self.send_header(name, value)
+    self.send_header("Content-Length", str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+  do_GET = _handle
+  do_POST = _handle
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+
+  def handle_error(self, request, client_address):
+    # Clients hanging up early (timeouts, cancellation) are expected
+    pass
+
+
+class FakeBroker:
+  """Serve canned Sensei responses on a local port.
+
+  The search endpoint answers with a result built by search_handler(body),
+  which by default returns the first "size" hits of the cars index.
+
+  """
+
+  def __init__(self, sysinfo=CARS_SYSINFO, hits=None, search_handler=None, encoding=None):
+    self.sysinfo = sysinfo
+    # "gzip", "deflate" or "raw-deflate", used when the client accepts it
+    self.encoding = encoding
+    self.hits = hits is None and make_cars(100) or hits
+    self.search_handler = search_handler or self.default_search
+    self.requests = []
+    self.num_connections = 0
+    self.server = _Server(("127.0.0.1", 0), _Handler)
+    self.server.broker = self
+    self.host, self.port = self.server.server_address
+    self.thread = threading.Thread(target=self.server.serve_forever)
+    self.thread.daemon = True
+
+  def start(self):
+    self.thread.start()
+    return self
+
+  def stop(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+  def encode(self, data):
+    wbits = {"gzip": 16 + zlib.MAX_WBITS, "deflate": zlib.MAX_WBITS,
+             "raw-deflate": -zlib.MAX_WBITS}[self.encoding]
+    compressor = zlib.compressobj(6, zlib.DEFLATED, wbits)
+    return compressor.compress(data) + compressor.flush()
+
+  def default_search(self, body):
+    req = {}
+    try:
+      req = json.loads(body or "{}")
+    except ValueError:
+      pass
+    offset = req.get("from", 0)
+    size = req.get("size", 10)
+    return {"numhits": len(self.hits), "totaldocs": len(self.hits), "time": 1,
+            "hits": self.hits[offset:offset + size], "facets": {}}
+
+  def respond(self, path, body, headers):
+    """Return (status, body, extra_headers) for a request."""
+
+    if path.endswith("/sysinfo"):
+      return 200, json.dumps(self.sysinfo), []
+    elif path.endswith("/get"):
+      uids = set(str(uid) for uid in json.loads(body))
+      docs = dict((hit["uid"], json.loads(hit["srcdata"]))
+                  for hit in self.hits if hit["uid"] in uids)
+      return 200, json.dumps(docs), []
+    result = self.search_handler(body)
+    if isinstance(result, tuple):
+      return result[0], result[1], []
+    return 200, json.dumps(result), []
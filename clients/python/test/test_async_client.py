@@ -0,0 +1,133 @@
+import sys
+import json
+import time
+from os.path import dirname
+
+sys.path.insert(0, dirname(__file__) + "/../sensei")
+sys.path.insert(0, dirname(__file__))
+from twisted.internet import defer, reactor, task
+from twisted.trial import unittest
+from twisted.web import error
+from sensei_async_client import AsyncSenseiClient
+from fake_broker import FakeBroker
+
+
+class TestAsyncSenseiClient(unittest.TestCase):
+  """Test cases for the Twisted-based Sensei client."""
+
+  def setUp(self):
+    self.broker = FakeBroker().start()
+    self.client = AsyncSenseiClient(self.broker.host, self.broker.port)
+
+  def tearDown(self):
+    self.broker.stop()
+    # Give aborted connections a chance to go away before closing the pool
+    return task.deferLater(reactor, 0.1, self.client.close)
+
+  @defer.inlineCallbacks
+  def testCompileAndQuery(self):
+    req = yield self.client.compile("select * from cars where color = 'red'")
+    self.assertEqual(req.selections, [{"term": {"color": {"value": "red"}}}])
+    res = yield self.client.doQuery("select * from cars limit 5")
+    self.assertEqual(res.numHits, 100)
+
+  @defer.inlineCallbacks
+  def testGet(self):
+    docs = yield self.client.get([1, 2])
+    self.assertEqual(sorted(docs.keys()), ["1", "2"])
+
+  @defer.inlineCallbacks
+  def testCompression(self):
+    self.broker.encoding = "gzip"
+    client = AsyncSenseiClient(self.broker.host, self.broker.port, compression=True)
+    try:
+      res = yield client.doQuery("select * from cars limit 5")
+      self.assertEqual(res.numHits, 100)
+      self.assertEqual(self.broker.requests[-1][3]["accept-encoding"], "gzip")
+    finally:
+      yield client.close()
+
+  @defer.inlineCallbacks
+  def testExecuteMany(self):
+    def search(body):
+      size = int(json.loads(body)["bql"].split()[-1])
+      return {"numhits": size, "hits": []}
+    self.broker.search_handler = search
+    stmts = ["select * from cars limit %d" % i for i in xrange(1, 101)]
+    results = yield self.client.execute_many(stmts, concurrency=10)
+    self.assertEqual([res.numHits for res in results], range(1, 101))
+    self.assertTrue(self.broker.num_connections <= 10)
+
+  @defer.inlineCallbacks
+  def testExecuteManyFailure(self):
+    def search(body):
+      if "bad" in body:
+        return 500, "Internal error"
+      return {"numhits": 1, "hits": []}
+    self.broker.search_handler = search
+    stmts = ["select * from cars", "select bad from cars", "select * from cars"]
+    try:
+      yield self.client.execute_many(stmts, concurrency=1)
+      self.fail("error.Error expected")
+    except error.Error as err:
+      self.assertEqual(err.status, "500")
+
+  @defer.inlineCallbacks
+  def testTimeout(self):
+    def search(body):
+      time.sleep(0.5)
+      return {"numhits": 1, "hits": []}
+    self.broker.search_handler = search
+    try:
+      yield self.client.doQuery("select * from cars", timeout=0.05)
+      self.fail("TimeoutError expected")
+    except defer.TimeoutError:
+      pass
+
+  @defer.inlineCallbacks
+  def testZeroTimeout(self):
+    def search(body):
+      time.sleep(0.2)
+      return {"numhits": 1, "hits": []}
+    self.broker.search_handler = search
+    # Coalescing does not change what a timeout means
+    for coalesce in (False, True):
+      client = AsyncSenseiClient(self.broker.host, self.broker.port, coalesce=coalesce)
+      try:
+        yield client.doQuery("select * from cars", timeout=0)
+        self.fail("TimeoutError expected")
+      except defer.TimeoutError:
+        pass
+      finally:
+        yield task.deferLater(reactor, 0.3, client.close)
+
+  def testCancel(self):
+    def search(body):
+      time.sleep(0.5)
+      return {"numhits": 1, "hits": []}
+    self.broker.search_handler = search
+    d = self.client.execute_many(["select * from cars"] * 4, concurrency=2)
+    d.cancel()
+    return self.assertFailure(d, defer.CancelledError)
+
+  @defer.inlineCallbacks
+  def testCoalesce(self):
+    def search(body):
+      time.sleep(0.2)
+      return {"numhits": 7, "hits": []}
+    self.broker.search_handler = search
+    client = AsyncSenseiClient(self.broker.host, self.broker.port, coalesce=True)
+    try:
+      queries = [client.doQuery("select * from cars") for i in xrange(10)]
+      # The first query is cancelled; the others still get the response
+      queries[0].cancel()
+      queries[0].addErrback(lambda failure: failure.trap(defer.CancelledError))
+      results = yield defer.gatherResults(queries[1:] + [client.doQuery("select * from cars limit 3")])
+      self.assertEqual([res.numHits for res in results], [7] * 10)
+      self.assertEqual((client.searches, client.shared), (2, 9))
+      self.assertEqual(client.flights, {})
+      # Once answered, the query is sent again
+      res = yield client.doQuery("select * from cars")
+      self.assertEqual((res.numHits, client.searches), (7, 3))
+    finally:
+      yield client.close()
@@ -0,0 +1,268 @@
+import sys
+import time
+import socket
+import urllib2
+import unittest
+from os.path import dirname
+
+sys.path.insert(0, dirname(__file__) + "/../sensei")
+sys.path.insert(0, dirname(__file__))
+from sensei_balancer import BrokerBalancer, SenseiMultiBrokerClient, POLICY_EWMA, parse_broker
+from sensei_cache import SchemaCache
+from sensei_transport import get_connection_pool
+from fake_broker import FakeBroker, CARS_SYSINFO, unused_port
+
+
+def failing_search(body):
+  return 503, "busy"
+
+def slow_search(broker, delay):
+  def _search(body):
+    time.sleep(delay)
+    return broker.default_search(body)
+  return _search
+
+
+class TestBalancer(unittest.TestCase):
+  """Test cases for spreading requests over several brokers."""
+
+  def setUp(self):
+    self.brokers = [FakeBroker().start() for i in xrange(2)]
+
+  def tearDown(self):
+    for broker in self.brokers:
+      get_connection_pool(broker.host, broker.port).close()
+      broker.stop()
+
+  def make_client(self, brokers=None, **kwargs):
+    if brokers is None:
+      brokers = ["%s:%d" % (broker.host, broker.port) for broker in self.brokers]
+    return SenseiMultiBrokerClient(brokers, sysinfo=CARS_SYSINFO, **kwargs)
+
+  def num_searches(self, broker):
+    return len([req for req in broker.requests if req[1] == "/sensei"])
+
+  def testParseBroker(self):
+    self.assertEqual(parse_broker("localhost:8080"), ("localhost", 8080))
+    self.assertEqual(parse_broker(("::1", "8080")), ("::1", 8080))
+    self.assertRaises(ValueError, BrokerBalancer, [])
+    self.assertRaises(ValueError, BrokerBalancer, ["localhost:8080"], policy="fastest")
+
+  def testLeastOutstanding(self):
+    balancer = BrokerBalancer([(broker.host, broker.port) for broker in self.brokers])
+    first = balancer.choose()
+    # The other broker has nothing in flight
+    second = balancer.choose()
+    self.assertTrue(second is not first)
+    balancer.report_success(second, 0.01)
+    self.assertTrue(balancer.choose() is second)
+
+  def testSpread(self):
+    client = self.make_client()
+    req = client.compile("select * from cars limit 5")
+    for i in xrange(40):
+      self.assertEqual(len(client.doQuery(req).hits), 5)
+    for broker in self.brokers:
+      self.assertTrue(self.num_searches(broker) > 0)
+
+  def testEwma(self):
+    slow = self.brokers[0]
+    slow.search_handler = slow_search(slow, 0.05)
+    client = self.make_client(policy=POLICY_EWMA)
+    req = client.compile("select * from cars limit 5")
+    for i in xrange(20):
+      client.doQuery(req)
+    self.assertTrue(self.num_searches(slow) <= 2, self.num_searches(slow))
+    stats = client.get_broker_stats()
+    self.assertTrue(stats["%s:%d" % (slow.host, slow.port)]["ewma_ms"] >= 50)
+
+  def testFailover(self):
+    bad = self.brokers[0]
+    bad.search_handler = failing_search
+    client = self.make_client(max_failures=2, eject_time=60)
+    req = client.compile("select * from cars limit 5")
+    for i in xrange(30):
+      self.assertEqual(len(client.doQuery(req).hits), 5)
+    # Ejected after two failures
+    self.assertEqual(self.num_searches(bad), 2)
+    stats = client.get_broker_stats()["%s:%d" % (bad.host, bad.port)]
+    self.assertEqual((stats["failures"], stats["ejections"], stats["ejected"]), (2, 1, True))
+
+  def testDeadBroker(self):
+    broker = self.brokers[0]
+    client = self.make_client(["127.0.0.1:%d" % unused_port(), "%s:%d" % (broker.host, broker.port)])
+    req = client.compile("select * from cars limit 5")
+    for i in xrange(5):
+      self.assertEqual(len(client.doQuery(req).hits), 5)
+      self.assertEqual(len(list(client.doQueryStream(req))), 5)
+
+  def testSilentBroker(self):
+    # The kernel accepts connections to it, but nothing ever answers
+    silent = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    silent.bind(("127.0.0.1", 0))
+    silent.listen(16)
+    name = "127.0.0.1:%d" % silent.getsockname()[1]
+    broker = self.brokers[0]
+    try:
+      client = self.make_client([name], retry_deadline=0.2)
+      req = client.compile("select * from cars limit 5")
+      begin = time.time()
+      self.assertRaises(urllib2.URLError, client.doQuery, req)
+      self.assertTrue(time.time() - begin < 2)
+      # A broker that has never answered is preferred by its response time
+      client = self.make_client([name, "%s:%d" % (broker.host, broker.port)],
+                                policy=POLICY_EWMA, timeout=0.1)
+      for i in xrange(5):
+        begin = time.time()
+        self.assertEqual(len(client.doQuery(req).hits), 5)
+        self.assertTrue(time.time() - begin < 2)
+      stats = client.get_broker_stats()[name]
+      self.assertEqual((stats["failures"], stats["ejected"]), (3, True))
+    finally:
+      get_connection_pool(*parse_broker(name)).close()
+      silent.close()
+
+  def testProbe(self):
+    bad = self.brokers[0]
+    bad.search_handler = failing_search
+    client = self.make_client(max_failures=1, eject_time=0.05)
+    req = client.compile("select * from cars limit 5")
+    while not client.get_broker_stats()["%s:%d" % (bad.host, bad.port)]["ejected"]:
+      client.doQuery(req)
+    bad.search_handler = bad.default_search
+    time.sleep(0.1)
+    deadline = time.time() + 5
+    while (client.get_broker_stats()["%s:%d" % (bad.host, bad.port)]["ejected"] and
+           time.time() < deadline):
+      # Choosing a broker starts the probe
+      client.doQuery(req)
+      time.sleep(0.01)
+    self.assertTrue([req for req in bad.requests if req[1].endswith("/sysinfo")])
+    self.assertFalse(client.get_broker_stats()["%s:%d" % (bad.host, bad.port)]["ejected"])
+
+  def testAllFailing(self):
+    for broker in self.brokers:
+      broker.search_handler = failing_search
+    client = self.make_client()
+    req = client.compile("select * from cars limit 5")
+    self.assertRaises(urllib2.HTTPError, client.doQuery, req)
+    # Tried once on each broker
+    self.assertEqual([self.num_searches(broker) for broker in self.brokers], [1, 1])
+
+  def testClientErrorNotRetried(self):
+    for broker in self.brokers:
+      broker.search_handler = lambda body: (400, "bad request")
+    client = self.make_client()
+    req = client.compile("select * from cars limit 5")
+    self.assertRaises(urllib2.HTTPError, client.doQuery, req)
+    self.assertEqual(sum(self.num_searches(broker) for broker in self.brokers), 1)
+
+  def testSchemaFetch(self):
+    client = SenseiMultiBrokerClient(["127.0.0.1:%d" % unused_port()] +
+                                     ["%s:%d" % (broker.host, broker.port)
+                                      for broker in self.brokers],
+                                     schema_cache=SchemaCache())
+    self.assertTrue("color" in client.get_facet_map())
+
+
+
+class TestHedging(unittest.TestCase):
+  """Test cases for sending slow queries to a second broker."""
+
+  def setUp(self):
+    self.brokers = [FakeBroker().start() for i in xrange(2)]
+    self.num_requests = []
+    for broker in self.brokers:
+      broker.search_handler = self.make_handler(broker)
+    self.client = SenseiMultiBrokerClient(["%s:%d" % (broker.host, broker.port)
+                                           for broker in self.brokers],
+                                          sysinfo=CARS_SYSINFO, max_hedge_rate=0.5)
+    self.req = self.client.compile("select * from cars limit 5")
+    self.delays = {}
+    self.failures = set()
+
+  def tearDown(self):
+    for broker in self.brokers:
+      get_connection_pool(broker.host, broker.port).close()
+      broker.stop()
+
+  def make_handler(self, broker):
+    def _search(body):
+      # The nth search request over all brokers takes delays[n] seconds
+      self.num_requests.append(broker)
+      n = len(self.num_requests)
+      time.sleep(self.delays.get(n, 0))
+      if n in self.failures:
+        return 503, "busy"
+      return broker.default_search(body)
+    return _search
+
+  def testHedgeWins(self):
+    self.delays[1] = 1.0
+    start = time.time()
+    res = self.client.doQuery(self.req, hedge_after_ms=20)
+    self.assertTrue(time.time() - start < 0.5)
+    self.assertEqual(len(res.hits), 5)
+    # The hedge went to the other broker
+    self.assertTrue(self.num_requests[0] is not self.num_requests[1])
+    stats = self.client.get_hedge_stats()
+    self.assertEqual((stats["requests"], stats["hedges"], stats["wins"]), (1, 1, 1))
+
+  def testLoserNotRetried(self):
+    self.delays[1] = 0.2
+    self.failures.add(1)
+    res = self.client.doQuery(self.req, hedge_after_ms=20)
+    self.assertEqual(len(res.hits), 5)
+    # The primary fails after the hedge has answered
+    time.sleep(0.4)
+    self.assertEqual(len(self.num_requests), 2)
+
+  def testLoserAborted(self):
+    self.delays[1] = 2.0
+    start = time.time()
+    self.client.doQuery(self.req, hedge_after_ms=20)
+    slow = "%s:%d" % (self.num_requests[0].host, self.num_requests[0].port)
+    while (self.client.get_broker_stats()[slow]["outstanding"] and
+           time.time() - start < 1.5):
+      time.sleep(0.01)
+    # The request to the slow broker is given up on without waiting for it
+    stats = self.client.get_broker_stats()[slow]
+    self.assertEqual((stats["outstanding"], stats["failures"]), (0, 0))
+
+  def testNoHedgeWhenFast(self):
+    for i in xrange(5):
+      self.client.doQuery(self.req, hedge_after_ms=500)
+    self.assertEqual(len(self.num_requests), 5)
+    self.assertEqual(self.client.get_hedge_stats()["hedges"], 0)
+
+  def testPrimaryWins(self):
+    self.delays[1] = 0.1
+    self.delays[2] = 1.0
+    start = time.time()
+    self.client.doQuery(self.req, hedge_after_ms=20)
+    self.assertTrue(time.time() - start < 0.5)
+    stats = self.client.get_hedge_stats()
+    self.assertEqual((stats["hedges"], stats["wins"]), (1, 0))
+
+  def testRateCap(self):
+    self.client.hedger.max_rate = 0.1
+    for i in xrange(1, 40):
+      self.delays[i] = 0.02
+    for i in xrange(20):
+      self.client.doQuery(self.req, hedge_after_ms=1)
+    self.assertEqual(self.client.get_hedge_stats()["hedges"], 2)
+
+  def testPercentile(self):
+    self.client.hedger.percentile = 90
+    for i in xrange(25):
+      self.client.doQuery(self.req)
+    stats = self.client.get_hedge_stats()
+    # Queries slower than the 90th percentile may have been hedged, and
+    # hedges may still be on their way to the broker
+    self.assertTrue(25 <= len(self.num_requests) <= 25 + stats["hedges"])
+    self.assertTrue(stats["delay_ms"] > 0)
+    self.assertEqual(stats["requests"], 25)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,93 @@
+"""Parse-time benchmark for the pyparsing engine of the BQL parser.
+
+Run this file directly to print parse times against the number of ORed
+predicates and the nesting depth of the WHERE clause.  Both should grow
+roughly linearly, which needs packrat parsing: without it, each extra
+nesting level multiplies the parse time.  As times depend on the load
+of the machine, the tests only check generous bounds, which are well
+out of reach without packrat parsing.
+"""
+
+import sys
+import time
+import logging
+import unittest
+import subprocess
+from os.path import dirname, abspath
+
+sys.path.insert(0, dirname(__file__) + "/../sensei")
+sys.path.insert(0, dirname(__file__))
+from pyparsing import ParserElement
+from bql_parser import BQLParser
+from sensei_client import SenseiClient
+from fake_broker import CARS_SYSINFO
+
+logger = logging.getLogger("test_bql_benchmark")
+
+def flat_stmt(num_preds):
+  return ("select * from cars where " +
+          " or ".join("color = 'c%d'" % i for i in xrange(num_preds)))
+
+def nested_stmt(depth):
+  expr = "color = 'red'"
+  for i in xrange(depth):
+    expr = "((%s) and year > %d) or price < %d.0" % (expr, 1990 + i, 1000 + i)
+  return "select * from cars where " + expr
+
+def time_parse(parser, stmt, repeat=3):
+  best = None
+  for i in xrange(repeat):
+    start = time.time()
+    parser.parse(stmt)
+    elapsed = time.time() - start
+    if best is None or elapsed < best:
+      best = elapsed
+  return best
+
+
+class TestParseBenchmark(unittest.TestCase):
+  """Benchmark parse time against statement size."""
+
+  def setUp(self):
+    client = SenseiClient(sysinfo=CARS_SYSINFO, stmt_cache_size=0, parser_engine="pyparsing")
+    self.parser = client.parser
+
+  def testPackratEnabled(self):
+    self.assertTrue(ParserElement._packratEnabled)
+
+  def testPackratNotAtImport(self):
+    code = ("import bql_parser, pyparsing\n"
+            "print pyparsing.ParserElement._packratEnabled\n"
+            "bql_parser.PACKRAT_PARSING = False\n"
+            "bql_parser.get_bql_grammar()\n"
+            "print pyparsing.ParserElement._packratEnabled")
+    output = subprocess.check_output([sys.executable, "-c", code],
+                                     cwd=dirname(abspath(__file__)) + "/../sensei")
+    self.assertEqual(output.split(), ["False", "False"])
+
+  def testPredicateCount(self):
+    times = {}
+    for num_preds in [1, 5, 10, 20, 40]:
+      times[num_preds] = time_parse(self.parser, flat_stmt(num_preds))
+      logger.info("%3d ORed predicates: %7.2f ms" % (num_preds, times[num_preds] * 1000))
+    self.assertTrue(times[40] < 2.0, times)
+
+  def testNestingDepth(self):
+    times = {}
+    for depth in [1, 2, 4, 8]:
+      times[depth] = time_parse(self.parser, nested_stmt(depth))
+      logger.info("nesting depth %2d:    %7.2f ms" % (depth, times[depth] * 1000))
+    # Seconds at depth 2 already without packrat parsing
+    self.assertTrue(times[4] < 1.0, times)
+
+  def testNestedResult(self):
+    tokens = self.parser.parse(nested_stmt(2))
+    where = tokens.where
+    self.assertEqual(where["or"][1], {"range": {"price": {"to": 1001.0, "include_upper": False}}})
+    self.assertEqual(where["or"][0]["and"][0]["or"][1],
+                     {"range": {"price": {"to": 1000.0, "include_upper": False}}})
+
+
+if __name__ == "__main__":
+  logging.basicConfig(level=logging.INFO, format="%(message)s")
+  unittest.main()
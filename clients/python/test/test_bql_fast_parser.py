@@ -0,0 +1,108 @@
+"""Tests for the hand-written BQL parser engine.
+
+All JSON API test cases are run again with the fast engine, which must
+produce exactly the same requests (and errors) as the pyparsing grammar.
+"""
+
+import sys
+import time
+import logging
+import unittest
+from os.path import dirname
+
+sys.path.insert(0, dirname(__file__))
+# Only the cases and their client: TestJsonAPI itself runs in its own module
+from test_json_api import JsonAPICases, sensei_client as client
+from pyparsing import ParseException
+
+logger = logging.getLogger("test_bql_fast_parser")
+
+BQLParser = client.parser.__class__
+
+
+class TestFastJsonAPI(JsonAPICases, unittest.TestCase):
+  """The JSON API test cases, compiled with the fast parser engine."""
+
+  def setUp(self):
+    self.parser = client.parser
+    client.parser = BQLParser(client.facet_map, engine="fast")
+    client.stmt_cache.clear()
+
+  def tearDown(self):
+    client.parser = self.parser
+    client.stmt_cache.clear()
+
+
+class TestFastParser(unittest.TestCase):
+  """Compare the fast parser engine with the pyparsing grammar."""
+
+  STMTS = [
+    "SELECT * FROM cars",
+    "DESCRIBE cars",
+    "set colors ('red', 'blue')",
+    "SELECT color, year FROM cars WHERE color = 'red' OR (year > 1999 AND year <= 2003) "
+    "ORDER BY color DESC, year LIMIT 2, 5 GROUP BY color TOP 3 "
+    "BROWSE BY color, year(true, 1, 10, hits) FETCHING STORED false",
+    "SELECT * WHERE color NOT IN ('a') EXCEPT ('b') AND tags CONTAINS ALL ('x', 'y') "
+    "AND year NOT BETWEEN 1995 AND 2000 AND price BETWEEN 1.5 AND 2.5 AND color <> 'x'",
+    "SELECT * WHERE MATCH (color, category) AGAINST ('x') AND category LIKE 'ab%_' "
+    "AND QUERY IS 'hello' AND makemodel = 'asian/acura' WITH ('strict': true, 'depth': 1)",
+    "SELECT * WHERE time > '2011-01-01 10:00:00' GIVEN FACET PARAM (my, 'a', int, 5) -- done\n;",
+    "SELECT * WHERE color IN ($colors) AND price < $max",
+    ]
+
+  BAD_STMTS = [
+    "",
+    "SELECT",
+    "SELECT * FROM",
+    "SELECT * WHERE",
+    "SELECT * WHERE color = ",
+    "SELECT * WHERE color IN 'red'",
+    "SELECT * WHERE NOT IN ('red')",
+    "SELECT * WHERE (color = 'red'",
+    "SELECT * LIMIT 5 LIMIT 6",
+    "SELECT * ORDER BY",
+    "SELECT * FROM cars garbage",
+    "SELECT where FROM cars",
+    ]
+
+  def setUp(self):
+    self.slow = client.parser
+    self.fast = BQLParser(client.facet_map, engine="fast")
+
+  def testSameTokens(self):
+    for stmt in self.STMTS:
+      expected = self.slow.parse(stmt)
+      tokens = self.fast.parse(stmt)
+      self.assertEqual(repr(list(tokens)), repr(expected.asList()), stmt)
+      for name in ["columns", "describe", "where", "index", "limit", "groupby",
+                   "max_per_group", "facet_specs", "fetching_stored", "variable",
+                   "value", "value_list"]:
+        value = getattr(expected, name)
+        if hasattr(value, "asList"):
+          value = value.asList()
+        self.assertEqual(repr(getattr(tokens, name)), repr(value), "%s: %s" % (name, stmt))
+
+  def testSameErrors(self):
+    for stmt in self.BAD_STMTS:
+      self.assertRaises(ParseException, self.slow.parse, stmt)
+      self.assertRaises(ParseException, self.fast.parse, stmt)
+
+  def testFaster(self):
+    stmt = self.STMTS[3]
+    times = []
+    for parser in [self.slow, self.fast]:
+      start = time.time()
+      for i in xrange(20):
+        parser.parse(stmt)
+      times.append((time.time() - start) / 20)
+    logger.info("pyparsing: %.2f ms, fast: %.2f ms" % (times[0] * 1000, times[1] * 1000))
+    self.assertTrue(times[1] < times[0])
+
+  def testUnknownEngine(self):
+    self.assertRaises(ValueError, BQLParser, client.facet_map, engine="yacc")
+
+
+if __name__ == "__main__":
+  logging.basicConfig(level=logging.INFO, format="%(message)s")
+  unittest.main()
@@ -0,0 +1,123 @@
+import sys
+import time
+import threading
+import unittest
+from os.path import dirname
+
+sys.path.insert(0, dirname(__file__) + "/../sensei")
+sys.path.insert(0, dirname(__file__))
+from bql_parser import BQLParser, get_bql_grammar
+from sensei_client import SenseiClient
+from sensei_components import SenseiSystemInfo
+from fake_broker import CARS_SYSINFO
+from pyparsing import ParseException, ParseSyntaxException, ParseBaseException
+
+def make_facet_map(sysinfo):
+  return dict((info.get_name(), info)
+              for info in SenseiSystemInfo(sysinfo).get_facet_infos())
+
+# The cars schema, with "color" turned into an int column
+INT_COLOR_SYSINFO = dict(CARS_SYSINFO, facets=[
+    {"runtime": False, "name": "color",
+     "props": {"column": "color", "depends": "[]", "type": "simple", "column_type": "int"}}])
+
+
+class TestSharedGrammar(unittest.TestCase):
+  """Test cases for sharing one pyparsing grammar between parsers."""
+
+  def testOneGrammar(self):
+    parser1 = BQLParser(make_facet_map(CARS_SYSINFO), engine="pyparsing")
+    parser2 = BQLParser(make_facet_map(INT_COLOR_SYSINFO), engine="pyparsing")
+    self.assertTrue(parser1._parser is parser2._parser)
+    self.assertTrue(parser1._parser is get_bql_grammar())
+
+  def testCheapConstruction(self):
+    facet_map = make_facet_map(CARS_SYSINFO)
+    start = time.time()
+    for i in xrange(100):
+      BQLParser(facet_map, engine="pyparsing")
+    self.assertTrue(time.time() - start < 0.5)
+
+  def testPerParserFacetMap(self):
+    parser1 = BQLParser(make_facet_map(CARS_SYSINFO), engine="pyparsing")
+    parser2 = BQLParser(make_facet_map(INT_COLOR_SYSINFO), engine="pyparsing")
+    stmt = "select * where color = 'red'"
+    self.assertEqual(parser1.parse(stmt).where, {"term": {"color": {"value": "red"}}})
+    self.assertRaises(ParseSyntaxException, parser2.parse, stmt)
+    self.assertEqual(parser2.parse("select * where color = 1").where,
+                     {"term": {"color": {"value": 1}}})
+
+  def testClausesOncePerParse(self):
+    parser = BQLParser(make_facet_map(CARS_SYSINFO), engine="pyparsing")
+    self.assertRaises(ParseException, parser.parse, "select * limit 5 limit 6")
+    for i in xrange(3):
+      self.assertEqual(parser.parse("select * order by color limit 5").limit[1][0], 5)
+
+  def testTimeNowPerParse(self):
+    parser = BQLParser(make_facet_map(CARS_SYSINFO), engine="pyparsing")
+    stmt = "select * where time > now and year < now"
+    bounds = set()
+    for pred in parser.parse(stmt).where["and"]:
+      spec = pred["range"].values()[0]
+      bounds.add(spec.get("from") or spec.get("to"))
+    self.assertEqual(len(bounds), 1)
+
+
+def compile_result(client, stmt):
+  """Return the JSON request for stmt, or a description of the error."""
+
+  try:
+    return SenseiClient.buildJsonString(client.compile(stmt))
+  except ParseBaseException, err:
+    return (err.__class__.__name__, err.loc, err.msg)
+
+
+class TestConcurrentParsing(unittest.TestCase):
+  """Stress test for many threads sharing one client."""
+
+  def make_stmts(self, count):
+    # Valid for one schema or the other, or for neither
+    templates = [
+      "select * from cars where color = 'red' and year > %d limit %d",
+      "select color, year where color = %d order by price desc limit %d",
+      "select * where ((price < %d.0 and year in (1999, 2000)) or tags contains all ('cool')) limit %d",
+      "select * where year > %d limit %d limit 10",
+      "select * where year between %d and %d group by color",
+      "select * where price > %d and price < %d and color <> 'blue'",
+    ]
+    return [templates[i % len(templates)] % (i, i % 50 + 1) for i in xrange(count)]
+
+  def run_threads(self, clients, stmts, thread_count):
+    expected = dict(((id(client), stmt), compile_result(client, stmt))
+                    for client in clients for stmt in stmts)
+    mismatches = []
+    def work(offset):
+      for i in xrange(len(stmts)):
+        stmt = stmts[(i + offset) % len(stmts)]
+        client = clients[(i + offset) % len(clients)]
+        try:
+          if compile_result(client, stmt) != expected[(id(client), stmt)]:
+            mismatches.append((client.facet_map["color"].get_props(), stmt))
+        except Exception, err:
+          mismatches.append((stmt, repr(err)))
+    threads = [threading.Thread(target=work, args=(n * 7,)) for n in xrange(thread_count)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(mismatches, [])
+
+  def make_clients(self, engine):
+    return [SenseiClient(sysinfo=sysinfo, stmt_cache_size=0, parser_engine=engine)
+            for sysinfo in (CARS_SYSINFO, INT_COLOR_SYSINFO)]
+
+  def testPyparsingEngine(self):
+    # Thousands of parses, so that a race has a chance to show
+    self.run_threads(self.make_clients("pyparsing"), self.make_stmts(250), 8)
+
+  def testFastEngine(self):
+    self.run_threads(self.make_clients("fast"), self.make_stmts(600), 16)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,104 @@
+import sys
+import time
+import threading
+import unittest
+from os.path import dirname
+
+sys.path.insert(0, dirname(__file__) + "/../sensei")
+sys.path.insert(0, dirname(__file__))
+from sensei_coalesce import SingleFlight
+from sensei_client import SenseiClient
+from sensei_transport import get_connection_pool
+from fake_broker import FakeBroker, CARS_SYSINFO
+
+
+def run_threads(num, func):
+  """Run func(i) in num threads at once, and return their results."""
+
+  results = [None] * num
+  start = threading.Event()
+  def _run(i):
+    start.wait()
+    try:
+      results[i] = func(i)
+    except Exception, err:
+      results[i] = err
+  threads = [threading.Thread(target=_run, args=(i,)) for i in xrange(num)]
+  for thread in threads:
+    thread.start()
+  start.set()
+  for thread in threads:
+    thread.join()
+  return results
+
+
+class TestSingleFlight(unittest.TestCase):
+  """Test cases for sharing calls in flight."""
+
+  def testShared(self):
+    flight = SingleFlight()
+    calls = []
+    def _call():
+      calls.append(1)
+      time.sleep(0.1)
+      return object()
+    results = run_threads(10, lambda i: flight.do(i % 2, _call))
+    self.assertEqual(len(calls), 2)
+    # Threads with the same key get the same object
+    self.assertEqual(len(set(results[0::2])), 1)
+    self.assertEqual(len(set(results[1::2])), 1)
+    self.assertTrue(results[0] is not results[1])
+    self.assertEqual(flight.get_stats(), {"calls": 2, "shared": 8, "in_flight": 0})
+    # Calls in flight are forgotten once done
+    flight.do(0, _call)
+    self.assertEqual(len(calls), 3)
+
+  def testError(self):
+    flight = SingleFlight()
+    def _call():
+      time.sleep(0.1)
+      raise ValueError("bad")
+    results = run_threads(5, lambda i: flight.do("key", _call))
+    self.assertEqual([type(result) for result in results], [ValueError] * 5)
+    self.assertEqual(flight.get_stats()["calls"], 1)
+
+
+class TestClientCoalesce(unittest.TestCase):
+  """Test cases for sending identical searches once."""
+
+  def setUp(self):
+    self.broker = FakeBroker().start()
+    search = self.broker.search_handler
+    def _slow_search(body):
+      time.sleep(0.2)
+      return search(body)
+    self.broker.search_handler = _slow_search
+
+  def tearDown(self):
+    get_connection_pool(self.broker.host, self.broker.port).close()
+    self.broker.stop()
+
+  def num_searches(self):
+    return len([req for req in self.broker.requests if req[1] == "/sensei"])
+
+  def testCoalesce(self):
+    client = SenseiClient(self.broker.host, self.broker.port, sysinfo=CARS_SYSINFO,
+                          coalesce=True)
+    stmts = ["select * from cars limit 5", "SELECT * FROM cars LIMIT 6"]
+    reqs = [client.compile(stmt) for stmt in stmts]
+    results = run_threads(20, lambda i: client.doQuery(reqs[i % 2]))
+    self.assertEqual([len(res.hits) for res in results[:2]], [5, 6])
+    self.assertTrue(results[0] is results[2])
+    self.assertEqual(self.num_searches(), 2)
+    self.assertEqual(client.get_coalesce_stats()["shared"], 18)
+
+  def testNoCoalesce(self):
+    client = SenseiClient(self.broker.host, self.broker.port, sysinfo=CARS_SYSINFO)
+    req = client.compile("select * from cars limit 5")
+    run_threads(3, lambda i: client.doQuery(req))
+    self.assertEqual(self.num_searches(), 3)
+    self.assertEqual(client.get_coalesce_stats(), None)
+
+
+if __name__ == "__main__":
+  unittest.main()
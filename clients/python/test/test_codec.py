@@ -0,0 +1,139 @@
+"""Tests and decode-time benchmark for the JSON codecs.
+
+Run this file directly to print the time each available codec takes to
+decode typical cars and tweets responses.  Times are only logged, as they
+depend on the load of the machine.
+"""
+
+import sys
+import json
+import time
+import random
+import logging
+import unittest
+from os.path import dirname
+
+sys.path.insert(0, dirname(__file__) + "/../sensei")
+sys.path.insert(0, dirname(__file__))
+import sensei_codec
+from sensei_codec import JsonCodec, LazyJson, get_codec, get_available_codecs, \
+    get_default_codec, set_default_codec
+from sensei_client import SenseiClient
+from sensei_cache import SchemaCache
+from sensei_transport import get_connection_pool
+from fake_broker import FakeBroker, CARS_SYSINFO, make_cars
+
+logger = logging.getLogger("test_codec")
+
+def cars_response(num_hits):
+  colors = ["red", "blue", "white", "black", "silver", "green", "gold", "yellow"]
+  return json.dumps({
+    "numhits": 15000, "totaldocs": 15000, "time": 12, "tid": 0,
+    "hits": make_cars(num_hits),
+    "facets": {"color": [{"value": color, "count": 15000 / (i + 2), "selected": False}
+                         for i, color in enumerate(colors)],
+               "year": [{"value": "%d" % year, "count": 1500, "selected": False}
+                        for year in xrange(1993, 2003)]},
+    })
+
+def tweets_response(num_hits):
+  rand = random.Random(1)
+  words = ["sensei", "search", "realtime", "index", "query", "facet", u"caf\xe9", "lucene"]
+  def text():
+    return " ".join(rand.choice(words) for i in xrange(20))
+  hits = [{"uid": str(i), "docid": str(i), "score": rand.random(),
+           "srcdata": json.dumps({"id": i, "text": text(), "time": 1330000000000 + i,
+                                  "user": "user%d" % rand.randint(0, 1000)}),
+           "text": [text()], "time": [str(1330000000000 + i)]}
+          for i in xrange(num_hits)]
+  return json.dumps({
+    "numhits": 100000, "totaldocs": 2000000, "time": 30, "tid": 0, "hits": hits,
+    "facets": {"user": [{"value": "user%d" % i, "count": 100 - i, "selected": False}
+                        for i in xrange(100)]},
+    })
+
+def time_decode(codec, text, repeat=5):
+  best = None
+  for i in xrange(repeat):
+    start = time.time()
+    codec.decode(text)
+    elapsed = time.time() - start
+    if best is None or elapsed < best:
+      best = elapsed
+  return best
+
+
+class TestCodec(unittest.TestCase):
+  """Test cases for choosing a JSON codec."""
+
+  def tearDown(self):
+    sensei_codec._default_codec = None
+
+  def testAvailable(self):
+    names = get_available_codecs()
+    self.assertEqual(names[-1], "json")
+    # Faster codecs are opt-in
+    self.assertEqual(get_default_codec().name, "json")
+    self.assertTrue(get_codec("json") is get_codec("json"))
+    self.assertRaises(ValueError, get_codec, "yaml")
+
+  def testSetDefault(self):
+    set_default_codec("json")
+    self.assertEqual(get_default_codec().name, "json")
+    codec = JsonCodec("custom", json.loads, json.dumps)
+    set_default_codec(codec)
+    self.assertTrue(get_codec() is codec)
+    self.assertEqual(SenseiClient(sysinfo=CARS_SYSINFO).codec, codec)
+
+  def testSameResults(self):
+    for text in [cars_response(50), tweets_response(50)]:
+      expected = json.loads(text)
+      for name in get_available_codecs():
+        self.assertEqual(get_codec(name).decode(text), expected)
+
+  def testLazyJson(self):
+    test_logger = logging.getLogger("test_codec.lazy")
+    test_logger.setLevel(logging.INFO)
+    # Not encoded, or this would fail
+    test_logger.debug("%s", LazyJson(object()))
+    self.assertEqual(str(LazyJson({"a": [1]})), '{"a": [1]}')
+
+  def testDecodeTime(self):
+    for kind, text in [("cars", cars_response(1000)), ("tweets", tweets_response(1000))]:
+      for name in get_available_codecs():
+        logger.info("%-6s %-10s %7.2f ms" % (kind, name, time_decode(get_codec(name), text) * 1000))
+
+
+class TestClientCodec(unittest.TestCase):
+  """Test cases for the codec of a client."""
+
+  def setUp(self):
+    self.broker = FakeBroker().start()
+
+  def tearDown(self):
+    get_connection_pool(self.broker.host, self.broker.port).close()
+    self.broker.stop()
+
+  def testClientDecodes(self):
+    decoded = []
+    def _loads(text):
+      decoded.append(text)
+      return json.loads(text)
+    client = SenseiClient(self.broker.host, self.broker.port,
+                          codec=JsonCodec("counting", _loads, json.dumps),
+                          schema_cache=SchemaCache())
+    res = client.doQuery(client.compile("select * from cars limit 3"))
+    self.assertEqual(len(res.hits), 3)
+    # sysinfo and the search result
+    self.assertEqual(len(decoded), 2)
+    # Source documents are decoded by the client's codec too
+    self.assertEqual(res.get_hits()[0].srcData["color"], "red")
+    self.assertEqual(len(decoded), 3)
+    hit = client.iter_hits("select * from cars limit 1").next()
+    self.assertEqual(hit.srcData["id"], 0)
+    self.assertEqual(json.loads(decoded[-1]), hit.srcData)
+
+
+if __name__ == "__main__":
+  logging.basicConfig(level=logging.INFO, format="%(message)s")
+  unittest.main()
@@ -0,0 +1,133 @@
+import sys
+import json
+import unittest
+import urllib2
+from os.path import dirname
+
+sys.path.insert(0, dirname(__file__) + "/../sensei")
+sys.path.insert(0, dirname(__file__))
+from sensei_components import *
+from sensei_federated import FederatedSenseiClient, sort_hits, merge_groups, merge_facets
+from sensei_transport import get_connection_pool
+from fake_broker import FakeBroker, CARS_SYSINFO, make_hit
+
+
+def facet_values(facets):
+  return [(facet["value"], facet["count"]) for facet in facets]
+
+def group(value, count, *uids):
+  hits = [make_hit(uid, color=value) for uid in uids]
+  for hit in hits:
+    hit["score"] = 10.0 - int(hit["uid"])
+  return dict(hits[0], groupvalue=value, grouphitscount=count, grouphits=hits)
+
+
+class TestMerge(unittest.TestCase):
+  """Test cases for merging the results of several clusters."""
+
+  def testSortHits(self):
+    hits = [make_hit(1, year=2001, color="red"), make_hit(2, year=1999, color="blue"),
+            make_hit(3, year=2001, color="blue"), make_hit(4, year=10, color="red")]
+    uids = lambda hits: [hit["uid"] for hit in hits]
+    self.assertEqual(uids(sort_hits(hits, [SenseiSort("year")])), ["4", "2", "1", "3"])
+    self.assertEqual(uids(sort_hits(hits, [SenseiSort("year", True), SenseiSort("color")])),
+                     ["3", "1", "2", "4"])
+    hits[2]["score"] = 3.0
+    self.assertEqual(uids(sort_hits(hits)), ["3", "1", "2", "4"])
+    self.assertEqual(uids(sort_hits(hits, [SenseiSort(PARAM_SORT_DOC_REVERSE)])),
+                     ["4", "3", "2", "1"])
+
+  def testSortStrings(self):
+    hits = [make_hit(1, year=9), make_hit(2, year=10)]
+    self.assertEqual([hit["uid"] for hit in sort_hits(hits, [SenseiSort("year")])],
+                     ["1", "2"])
+    facet_map = {"year": SenseiFacetInfo("year", props={"column_type": "string"})}
+    self.assertEqual([hit["uid"] for hit in sort_hits(hits, [SenseiSort("year")], facet_map)],
+                     ["2", "1"])
+
+  def testMergeGroups(self):
+    hits = sort_hits([group("red", 5, 1, 4), group("blue", 2, 2), group("red", 3, 3, 5, 6)])
+    groups = merge_groups(hits, 3)
+    self.assertEqual([g["groupvalue"] for g in groups], ["red", "blue"])
+    red = groups[0]
+    self.assertEqual(red["uid"], "1")
+    self.assertEqual(red["grouphitscount"], 8)
+    self.assertEqual([hit["uid"] for hit in red["grouphits"]], ["1", "3", "4"])
+
+  def testMergeFacets(self):
+    lists = [[{"value": "red", "count": 5}, {"value": "blue", "count": 1}],
+             [{"value": "blue", "count": 3}, {"value": "white", "count": 1, "selected": True}],
+             None]
+    self.assertEqual(facet_values(merge_facets(lists)), [("red", 5), ("blue", 4), ("white", 1)])
+    spec = SenseiFacet(minHits=2, maxCounts=1)
+    self.assertEqual(facet_values(merge_facets(lists, spec)), [("red", 5)])
+    spec = SenseiFacet(minHits=2, orderBy=PARAM_FACET_ORDER_VAL)
+    merged = merge_facets(lists, spec)
+    # Selected values are kept whatever their count
+    self.assertEqual(facet_values(merged), [("blue", 4), ("red", 5), ("white", 1)])
+    self.assertEqual([facet["selected"] for facet in merged], [False, False, True])
+
+
+class TestFederatedClient(unittest.TestCase):
+  """Test cases for searching several clusters."""
+
+  def setUp(self):
+    self.brokers = [FakeBroker(hits=[make_hit(i, year=1990 + i) for i in xrange(0, 20, 2)]),
+                    FakeBroker(hits=[make_hit(i, year=1990 + i) for i in xrange(1, 20, 2)])]
+    for broker in self.brokers:
+      broker.start()
+      broker.search_handler = self.make_handler(broker)
+    self.client = FederatedSenseiClient(["%s:%d" % (broker.host, broker.port)
+                                         for broker in self.brokers],
+                                        sysinfo=CARS_SYSINFO)
+
+  def tearDown(self):
+    for broker in self.brokers:
+      get_connection_pool(broker.host, broker.port).close()
+      broker.stop()
+
+  def make_handler(self, broker):
+    def _search(body):
+      req = json.loads(body)
+      hits = broker.hits
+      if req.get("sort") == [{"year": "desc"}]:
+        hits = hits[::-1]
+      res = broker.default_search(body)
+      res["hits"] = hits[req["from"]:req["from"] + req["size"]]
+      res["facets"] = {"color": [{"value": "red", "count": len(hits)}]}
+      return res
+    return _search
+
+  def testSearch(self):
+    req = self.client.compile("select * from cars order by year desc limit 3, 4 "
+                              "browse by color")
+    res = self.client.doQuery(req)
+    self.assertEqual([hit["uid"] for hit in res.hits], ["16", "15", "14", "13"])
+    self.assertEqual((res.numHits, res.totalDocs), (20, 20))
+    self.assertEqual([(facet.value, facet.count) for facet in res.facetMap["color"]],
+                     [("red", 20)])
+    # Each cluster was asked for the first seven hits
+    for broker in self.brokers:
+      body = json.loads(broker.requests[-1][2])
+      self.assertEqual((body["from"], body["size"]), (0, 7))
+    # The request itself is left alone
+    self.assertEqual((req.offset, req.count), (3, 4))
+
+  def testFailure(self):
+    self.brokers[1].search_handler = lambda body: (503, "busy")
+    req = self.client.compile("select * from cars order by year desc")
+    self.assertRaises(urllib2.HTTPError, self.client.doQuery, req)
+    self.client.allow_partial = True
+    res = self.client.doQuery(req)
+    self.assertEqual(res.numHits, 10)
+    self.assertEqual(res.hits[0]["uid"], "18")
+    self.assertEqual(len(res.errors), 1)
+    self.assertTrue(str(self.brokers[1].port) in res.errors[0]["message"])
+
+  def testDesc(self):
+    self.assertRaises(SenseiClientError, self.client.doQuery,
+                      self.client.compile("describe cars"))
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,90 @@
+import sys
+import json
+import time
+import threading
+import unittest
+import urllib2
+from os.path import dirname
+
+sys.path.insert(0, dirname(__file__) + "/../sensei")
+sys.path.insert(0, dirname(__file__))
+from sensei_get import chunk_uids, iter_docs
+from sensei_client import SenseiClient
+from sensei_client_lib import SenseiServiceProxy
+from sensei_transport import get_connection_pool
+from fake_broker import FakeBroker, CARS_SYSINFO, make_cars
+
+
+class TestChunks(unittest.TestCase):
+  """Test cases for splitting uids into /get requests."""
+
+  def testChunkSize(self):
+    chunks = [json.loads(chunk) for chunk in chunk_uids(xrange(10), 4)]
+    self.assertEqual(chunks, [["0", "1", "2", "3"], ["4", "5", "6", "7"], ["8", "9"]])
+    self.assertEqual(list(chunk_uids([])), [])
+
+  def testChunkBytes(self):
+    uids = ["x" * 10] * 3 + ["y" * 10, "z" * 10, u"\xe9"]
+    chunks = list(chunk_uids(uids, 100, 30))
+    for chunk in chunks:
+      self.assertTrue(len(chunk) <= 30, chunk)
+    # Duplicates are sent once
+    self.assertEqual(sum((json.loads(chunk) for chunk in chunks), []),
+                     ["x" * 10, "y" * 10, "z" * 10, "\\xe9"])
+
+  def testParallel(self):
+    lock = threading.Lock()
+    in_flight = [0, 0]
+    def _request(body):
+      lock.acquire()
+      in_flight[0] += 1
+      in_flight[1] = max(in_flight)
+      lock.release()
+      time.sleep(0.02)
+      lock.acquire()
+      in_flight[0] -= 1
+      lock.release()
+      return json.dumps(dict((uid, {"id": uid}) for uid in json.loads(body)))
+    docs = dict(iter_docs(_request, json.loads, xrange(100), chunk_size=10, parallelism=3))
+    self.assertEqual(sorted(docs), sorted(str(i) for i in xrange(100)))
+    self.assertEqual(in_flight[1], 3)
+
+  def testError(self):
+    def _request(body):
+      if "5" in json.loads(body):
+        raise urllib2.URLError("down")
+      return "{}"
+    docs = iter_docs(_request, json.loads, xrange(10), chunk_size=2, parallelism=2)
+    self.assertRaises(urllib2.URLError, list, docs)
+
+
+class TestMultiGet(unittest.TestCase):
+  """Test cases for getting documents from a broker."""
+
+  def setUp(self):
+    self.broker = FakeBroker(hits=make_cars(300)).start()
+
+  def tearDown(self):
+    get_connection_pool(self.broker.host, self.broker.port).close()
+    self.broker.stop()
+
+  def num_gets(self):
+    return len([req for req in self.broker.requests if req[1] == "/sensei/get"])
+
+  def testMultiGet(self):
+    client = SenseiClient(self.broker.host, self.broker.port, sysinfo=CARS_SYSINFO)
+    docs = client.multi_get(range(250) + [1000], chunk_size=50)
+    self.assertEqual(len(docs), 250)
+    self.assertEqual(docs["7"]["color"], "white")
+    self.assertEqual(self.num_gets(), 6)
+    self.assertEqual(client.multi_get([]), {})
+
+  def testProxy(self):
+    proxy = SenseiServiceProxy(self.broker.host, self.broker.port, sysinfo=CARS_SYSINFO)
+    self.assertEqual(sorted(json.loads(proxy.get([1, "2", 3]))), ["1", "2", "3"])
+    self.assertEqual(json.loads(self.broker.requests[-1][2]), ["1", "2", "3"])
+    self.assertEqual(len(proxy.multi_get(range(20), chunk_size=8)), 20)
+
+
+if __name__ == "__main__":
+  unittest.main()
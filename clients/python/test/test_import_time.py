@@ -0,0 +1,70 @@
+"""Guards against making the sensei package slower to import.
+
+Importing the package for raw BQL or JSON queries must not load the BQL
+parser (and pyparsing), the shell or optional dependencies.  Run this
+file directly to print the import times.
+"""
+
+import sys
+import logging
+import unittest
+import subprocess
+from os.path import dirname, abspath
+
+logger = logging.getLogger("test_import_time")
+
+CLIENT_DIR = dirname(dirname(abspath(__file__)))
+
+# Modules only needed by clients that compile BQL, or by other entry points
+HEAVY_MODULES = ["pyparsing", "sensei.bql_parser", "sensei.bql_fast_parser", "readline",
+                 "twisted", "numpy"]
+
+# Seconds "import sensei" may take: about 35 ms here, of which the
+# standard library takes most; the margin is for loaded machines
+IMPORT_TIME_BUDGET = 0.5
+
+SYSINFO = {"numdocs": 0, "lastmodified": 0, "version": "1", "clusterinfo": [],
+           "facets": [{"name": "color", "runtime": False,
+                       "props": {"column": "color", "type": "simple", "column_type": "string",
+                                 "depends": "[]"}}]}
+
+def run_python(code):
+  """Run code in a new interpreter and return what it prints."""
+
+  return subprocess.check_output([sys.executable, "-c", code], cwd=CLIENT_DIR)
+
+def loaded_modules(code):
+  return set(run_python(code + "\nimport sys\nprint ' '.join(sys.modules)").split())
+
+def import_time(stmt, repeat=3):
+  """Return the best time stmt takes in a new interpreter, in seconds."""
+
+  code = "import time\nstart = time.time()\n%s\nprint time.time() - start" % stmt
+  return min(float(run_python(code)) for i in xrange(repeat))
+
+
+class TestImportTime(unittest.TestCase):
+  """Test cases for what importing the sensei package loads."""
+
+  def assertNotLoaded(self, modules):
+    self.assertEqual([name for name in HEAVY_MODULES if name in modules], [])
+
+  def testPackage(self):
+    self.assertNotLoaded(loaded_modules("import sensei"))
+
+  def testLazyClient(self):
+    code = "import sensei\nclient = sensei.SenseiClient(sysinfo=%r, lazy=True)" % SYSINFO
+    self.assertNotLoaded(loaded_modules(code))
+    modules = loaded_modules(code + "\nclient.compile('select * from cars')")
+    self.assertTrue("sensei.bql_parser" in modules)
+
+  def testImportTime(self):
+    light = import_time("import sensei")
+    full = import_time("import sensei, sensei.bql_parser")
+    logger.info("import sensei: %.1f ms, with the parser: %.1f ms" % (light * 1000, full * 1000))
+    self.assertTrue(light < IMPORT_TIME_BUDGET, light)
+
+
+if __name__ == "__main__":
+  logging.basicConfig(level=logging.INFO, format="%(message)s")
+  unittest.main()
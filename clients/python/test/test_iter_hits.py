@@ -0,0 +1,69 @@
+import sys
+import json
+import time
+import unittest
+from os.path import dirname
+
+sys.path.insert(0, dirname(__file__) + "/../sensei")
+sys.path.insert(0, dirname(__file__))
+from sensei_components import SenseiClientError
+from sensei_client import SenseiClient
+from sensei_transport import get_connection_pool
+from fake_broker import FakeBroker, CARS_SYSINFO
+
+
+class TestIterHits(unittest.TestCase):
+  """Test cases for paging through results with iter_hits."""
+
+  def setUp(self):
+    self.broker = FakeBroker().start()
+    self.client = SenseiClient(self.broker.host, self.broker.port, sysinfo=CARS_SYSINFO)
+
+  def tearDown(self):
+    get_connection_pool(self.broker.host, self.broker.port).close()
+    self.broker.stop()
+
+  def get_pages(self):
+    return [(body["from"], body["size"])
+            for body in [json.loads(request[2]) for request in self.broker.requests]]
+
+  def testAllHits(self):
+    for prefetch in [0, 1, 3]:
+      self.broker.requests = []
+      uids = [hit.uid for hit in self.client.iter_hits("select * from cars",
+                                                       page_size=30, prefetch=prefetch)]
+      self.assertEqual(uids, [str(i) for i in xrange(100)])
+      self.assertEqual(self.get_pages(), [(0, 30), (30, 30), (60, 30), (90, 10)])
+
+  def testLimit(self):
+    hits = list(self.client.iter_hits("select * from cars limit 5, 42", page_size=10))
+    self.assertEqual([hit.uid for hit in hits], [str(i) for i in xrange(5, 47)])
+    self.assertEqual(hits[0].srcData["color"], "red")
+    self.assertEqual(self.get_pages(), [(5, 10), (15, 10), (25, 10), (35, 10), (45, 2)])
+
+  def testLimitPastNumHits(self):
+    hits = list(self.client.iter_hits("select * from cars limit 90, 50", page_size=25))
+    self.assertEqual(len(hits), 10)
+    self.assertEqual(self.get_pages(), [(90, 25)])
+
+  def testBoundedPrefetch(self):
+    hits = self.client.iter_hits("select * from cars", page_size=10, prefetch=2)
+    hits.next()
+    time.sleep(0.3)
+    # The page in use, two queued pages and one waiting to be queued
+    self.assertEqual(len(self.broker.requests), 4)
+    hits.close()
+    time.sleep(0.3)
+    self.assertEqual(len(self.broker.requests), 4)
+
+  def testErrors(self):
+    self.broker.search_handler = lambda body: {
+      "numhits": 0, "hits": [], "errors": [{"code": 1, "message": "boom"}]}
+    self.assertRaises(SenseiClientError, list, self.client.iter_hits("select * from cars"))
+    self.assertRaises(SenseiClientError, list,
+                      self.client.iter_hits("select * from cars", prefetch=0))
+    self.assertRaises(SenseiClientError, list, self.client.iter_hits("describe cars"))
+
+
+if __name__ == "__main__":
+  unittest.main()
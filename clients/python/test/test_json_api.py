@@ -121,11 +121,15 @@ sensei_client = SenseiClient(sysinfo={
         }
       ], 
     "numdocs": 15000
-    })
+    }, parser_engine="pyparsing")
 
 
-class TestJsonAPI(unittest.TestCase):
-  """ Test cases for BQL using JSON API."""
+class JsonAPICases:
+  """ Test cases for BQL using JSON API.
+
+  They are shared with test_bql_fast_parser, which runs them with the
+  fast parser engine, so they are kept out of any TestCase.
+  """
 
   def testBasics(self):
     stmt = \
@@ -1511,6 +1515,10 @@ class TestJsonAPI(unittest.TestCase):
   "size": 10
 }""")
 
+class TestJsonAPI(JsonAPICases, unittest.TestCase):
+  """The JSON API test cases, compiled with the pyparsing parser engine."""
+
+
 if __name__ == "__main__":
     unittest.main()
 
@@ -0,0 +1,107 @@
+import sys
+import unittest
+from os.path import dirname
+
+sys.path.insert(0, dirname(__file__) + "/../sensei")
+sys.path.insert(0, dirname(__file__))
+from bql_request import and_range_specs, or_range_specs, normalize_pred, normalize_preds
+from sensei_client import SenseiClient
+from sensei_components import SenseiRequest
+from fake_broker import CARS_SYSINFO
+
+
+def spec(lower=None, include_lower=True, upper=None, include_upper=True):
+  result = {}
+  if lower is not None:
+    result.update({"from": lower, "include_lower": include_lower})
+  if upper is not None:
+    result.update({"to": upper, "include_upper": include_upper})
+  return result
+
+
+class TestRangeSpecs(unittest.TestCase):
+  """Test cases for folding range specs."""
+
+  def testAnd(self):
+    self.assertEqual(and_range_specs(spec(1, False), spec(upper=5)), spec(1, False, 5))
+    self.assertEqual(and_range_specs(spec(0, True, 9), spec(0, False, 5)), spec(0, False, 5))
+    self.assertEqual(and_range_specs(spec(upper=5, include_upper=False), spec(5)), None)
+    self.assertEqual(and_range_specs(spec(upper=5), spec(5)), spec(5, True, 5))
+
+  def testOr(self):
+    self.assertEqual(or_range_specs(spec(3, True, 8), spec(1, True, 5)), spec(1, True, 8))
+    self.assertEqual(or_range_specs(spec(upper=0, include_upper=False), spec(0)), {})
+    self.assertEqual(or_range_specs(spec(upper=0, include_upper=False),
+                                    spec(0, False)), None)
+    self.assertEqual(or_range_specs(spec(1, False, 5), spec(1, True, 3)), spec(1, True, 5))
+    self.assertEqual(or_range_specs(spec(1, True, 3), spec(4, True, 6)), None)
+
+
+class TestNormalize(unittest.TestCase):
+  """Test cases for the canonical form of predicates and requests."""
+
+  def setUp(self):
+    self.client = SenseiClient(sysinfo=CARS_SYSINFO)
+
+  def key(self, stmt):
+    return SenseiClient.buildRequestKey(self.client.compile(stmt),
+                                        facet_map=self.client.facet_map)
+
+  def assertSameKey(self, stmt1, stmt2):
+    self.assertEqual(self.key(stmt1), self.key(stmt2), (stmt1, stmt2))
+
+  def testPredicates(self):
+    pred = {"or": [{"terms": {"color": {"values": ["red", "blue", "red"], "operator": "or"}}},
+                   {"or": [{"term": {"category": {"value": "suv"}}},
+                           {"terms": {"color": {"values": ["green"], "operator": "or"}}}]}]}
+    self.assertEqual(normalize_pred(pred),
+                     {"or": [{"term": {"category": {"value": "suv"}}},
+                             {"terms": {"color": {"values": ["blue", "green", "red"],
+                                                  "operator": "or"}}}]})
+    # The predicate itself is left alone
+    self.assertEqual(pred["or"][0]["terms"]["color"]["values"], ["red", "blue", "red"])
+    term = {"term": {"color": {"value": "red"}}}
+    self.assertEqual(normalize_preds([term, term]), [term])
+
+  def testSameKey(self):
+    self.assertSameKey("select * from cars where year > 1999 and year <= 2003",
+                       "select * from cars where year between 2000 and 2003")
+    self.assertSameKey("select * from cars where color in ('red', 'blue', 'red') and tags contains all ('a')",
+                       "SELECT * FROM cars WHERE tags CONTAINS ALL ('a') AND color IN ('blue', 'red')")
+    self.assertSameKey("select * from cars where price > 1 or color = 'red' or price < 0",
+                       "select * from cars where color = 'red' or price not between 0 and 1")
+    self.assertSameKey("select * from cars where color <> 'red' and color <> 'blue'",
+                       "select * from cars where color not in ('blue', 'red')")
+    self.assertSameKey("select * from cars where year = 0 and year >= 0",
+                       "select * from cars where year = 0")
+    self.assertSameKey("select * from cars where color = $c", "select * from cars where color = $c")
+
+  def testDifferentKey(self):
+    # price is a float column
+    self.assertNotEqual(self.key("select * from cars where price > 1"),
+                        self.key("select * from cars where price >= 2"))
+    # A selection and a filter count facets differently
+    self.assertNotEqual(self.key("select * from cars where year between 1 and 8"),
+                        self.key("select * from cars where year between 1 and 5 or year between 3 and 8"))
+    req = self.client.compile("select * from cars where color = $c")
+    self.assertNotEqual(SenseiClient.buildRequestKey(req, var_map={"c": "red"}),
+                        SenseiClient.buildRequestKey(req, var_map={"c": "blue"}))
+
+  def testUrlRequest(self):
+    keys = []
+    for query in ["color:red", "color:blue"]:
+      req = SenseiRequest()
+      req.selections = {}
+      req.qParam["query"] = query
+      keys.append(SenseiClient.buildRequestKey(req, using_json=False))
+      # The key leaves the query for the request itself
+      self.assertEqual(req.qParam, {"query": query})
+    self.assertNotEqual(keys[0], keys[1])
+
+  def testZeroBound(self):
+    req = self.client.compile("select * from cars where year >= 0 and year < 5")
+    self.assertEqual(req.selections, [{"range": {"year": spec(0, True, 5, False)}}])
+
+
+if __name__ == "__main__":
+  unittest.main()
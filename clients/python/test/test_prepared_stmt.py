@@ -0,0 +1,91 @@
+import sys
+import json
+import unittest
+from os.path import dirname
+
+sys.path.insert(0, dirname(__file__) + "/../sensei")
+sys.path.insert(0, dirname(__file__))
+from sensei_components import SenseiClientError
+from sensei_client import SenseiClient
+from sensei_transport import get_connection_pool
+from fake_broker import FakeBroker, CARS_SYSINFO
+from pyparsing import ParseSyntaxException
+
+
+class TestPreparedStatement(unittest.TestCase):
+  """Test cases for prepared statements with bind variables."""
+
+  def setUp(self):
+    self.client = SenseiClient(sysinfo=CARS_SYSINFO)
+
+  def testBind(self):
+    stmt = self.client.prepare("select * from cars where color in ($colors) and price < $max")
+    self.assertEqual(stmt.get_variable_names(), ["colors", "max"])
+    bound = json.loads(stmt.bind(colors=["red", "blue"], max=9000.0))
+    expected = json.loads(self.client.buildJsonString(self.client.compile(
+          "select * from cars where color in ('red', 'blue') and price < 9000.0")))
+    self.assertEqual(bound, expected)
+
+  def testBindMap(self):
+    stmt = self.client.prepare("select * from cars where year between $low and $high")
+    bound = json.loads(stmt.bind({"low": 1995}, high=2000))
+    self.assertEqual(bound["selections"],
+                     [{"range": {"year": {"from": 1995, "to": 2000,
+                                          "include_lower": True, "include_upper": True}}}])
+
+  def testScalarForList(self):
+    stmt = self.client.prepare("select * from cars where color in ($colors)")
+    bound = json.loads(stmt.bind(colors="red"))
+    self.assertEqual(bound["selections"][0]["terms"]["color"]["values"], ["red"])
+
+  def testNoRangeMerge(self):
+    stmt = self.client.prepare("select * from cars where year > $low and year < 2000")
+    bound = json.loads(stmt.bind(low=1995))
+    self.assertEqual(len(bound["selections"]), 2)
+
+  def testTypeCheck(self):
+    stmt = self.client.prepare("select * from cars where color in ($colors) and year = $year")
+    self.assertRaises(SenseiClientError, stmt.bind, colors=[1, 2], year=1999)
+    self.assertRaises(SenseiClientError, stmt.bind, colors=["red"], year="1999")
+    self.assertRaises(SenseiClientError, stmt.bind, colors=["red"], year=[1999])
+
+  def testUnboundAndUnknown(self):
+    stmt = self.client.prepare("select * from cars where color = $color")
+    self.assertRaises(SenseiClientError, stmt.bind)
+    self.assertRaises(SenseiClientError, stmt.bind, color="red", year=1999)
+
+  def testQuotedDollar(self):
+    stmt = self.client.prepare("select * from cars where color = '$color'")
+    self.assertEqual(stmt.get_variable_names(), [])
+    self.assertTrue('"$color"' in stmt.bind())
+
+  def testVariableNotAllowed(self):
+    self.assertRaises(ParseSyntaxException, self.client.prepare,
+                      "select * from cars where year in ($years)")
+    self.assertRaises(SenseiClientError, self.client.prepare, "desc cars")
+
+  def testServerTemplate(self):
+    req = self.client.compile("select * from cars where color = $color")
+    self.assertEqual(json.loads(self.client.buildJsonString(req))["selections"],
+                     [{"term": {"color": {"value": "$color"}}}])
+
+
+class TestPreparedExecute(unittest.TestCase):
+  """Test cases for executing prepared statements against a broker."""
+
+  def setUp(self):
+    self.broker = FakeBroker().start()
+    self.client = SenseiClient(self.broker.host, self.broker.port)
+
+  def tearDown(self):
+    get_connection_pool(self.broker.host, self.broker.port).close()
+    self.broker.stop()
+
+  def testExecute(self):
+    stmt = self.client.prepare("select * from cars where color = $color limit 3")
+    for color in ["red", "blue"]:
+      res = stmt.execute(color=color)
+      self.assertEqual(len(res.hits), 3)
+      body = json.loads(self.broker.requests[-1][2])
+      self.assertEqual(body["selections"], [{"term": {"color": {"value": color}}}])
+    self.assertEqual(self.client.get_stmt_cache_stats()["misses"], 1)
@@ -0,0 +1,179 @@
+import os
+import sys
+import copy
+import time
+import shutil
+import tempfile
+import unittest
+from os.path import dirname
+
+sys.path.insert(0, dirname(__file__) + "/../sensei")
+sys.path.insert(0, dirname(__file__))
+from sensei_cache import ResultCache, SchemaCache
+from sensei_client import SenseiClient
+from sensei_transport import get_connection_pool
+from fake_broker import FakeBroker, CARS_SYSINFO
+
+URL = "http://localhost:8080/sensei"
+
+
+def modified_at(sysinfo, last_modified):
+  sysinfo = copy.deepcopy(sysinfo)
+  sysinfo["lastmodified"] = last_modified
+  return sysinfo
+
+
+class TestResultCache(unittest.TestCase):
+  """Test cases for the cache of search results."""
+
+  def setUp(self):
+    self.cache_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+  def testVersions(self):
+    cache = ResultCache()
+    cache.set_version(URL, 5)
+    cache.put(URL, "q1", 5, "r1")
+    cache.put("http://other:8080/sensei", "q1", 5, "r2")
+    self.assertEqual(cache.get(URL, "q1", 5), "r1")
+    # Going back is ignored
+    self.assertEqual(cache.set_version(URL, 4), 5)
+    self.assertEqual(cache.get(URL, "q1", 5), "r1")
+    self.assertEqual(cache.set_version(URL, 6), 6)
+    self.assertEqual(cache.get(URL, "q1", 6), None)
+    self.assertEqual(cache.get("http://other:8080/sensei", "q1", 5), "r2")
+    # Results of an older version are not stored
+    cache.put(URL, "q1", 5, "r1")
+    self.assertEqual(len(cache), 1)
+    stats = cache.get_stats()
+    self.assertEqual((stats["hits"], stats["misses"], stats["invalidations"]), (3, 1, 1))
+
+  def testCheckInterval(self):
+    cache = ResultCache(check_interval=0.05)
+    self.assertEqual(cache.get_version(URL), None)
+    cache.set_version(URL, 1)
+    self.assertEqual(cache.get_version(URL), 1)
+    time.sleep(0.06)
+    # One caller checks, the others keep the last version meanwhile
+    self.assertEqual(cache.get_version(URL), None)
+    self.assertEqual(cache.get_version(URL), 1)
+
+  def testEviction(self):
+    cache = ResultCache(max_bytes=10)
+    cache.put(URL, "a", 1, "xxxx")
+    cache.put(URL, "b", 1, "xxxx")
+    cache.get(URL, "a", 1)
+    cache.put(URL, "c", 1, "xxxx")
+    self.assertEqual(cache.get(URL, "b", 1), None)
+    self.assertEqual(cache.get(URL, "a", 1), "xxxx")
+    # Too large to be cached
+    cache.put(URL, "d", 1, "x" * 11)
+    self.assertEqual(cache.get(URL, "d", 1), None)
+    stats = cache.get_stats()
+    self.assertEqual((stats["size"], stats["bytes"], stats["evictions"]), (2, 8, 1))
+
+  def testDisk(self):
+    writer = ResultCache(cache_dir=self.cache_dir)
+    writer.put(URL, 'q\n"1"', 7, "result\nline 2")
+    reader = ResultCache(cache_dir=self.cache_dir)
+    self.assertEqual(reader.get(URL, 'q\n"1"', 7), "result\nline 2")
+    self.assertEqual(reader.get(URL, 'q\n"1"', 8), None)
+    self.assertEqual(reader.get_stats()["disk_hits"], 1)
+    # Files of older versions are removed once a later one is seen
+    reader.set_version(URL, 8)
+    self.assertEqual(ResultCache(cache_dir=self.cache_dir).get(URL, 'q\n"1"', 7), None)
+
+  def testClear(self):
+    other = os.path.join(self.cache_dir, "sysinfo-x.json")
+    open(other, "w").close()
+    cache = ResultCache(cache_dir=self.cache_dir)
+    cache.put(URL, "q1", 1, "r1")
+    cache.clear()
+    self.assertEqual(ResultCache(cache_dir=self.cache_dir).get(URL, "q1", 1), None)
+    # Files of others in the directory are left alone
+    self.assertEqual(os.listdir(self.cache_dir), ["sysinfo-x.json"])
+
+
+class TestClientResultCache(unittest.TestCase):
+  """Test cases for caching the results of a client."""
+
+  def setUp(self):
+    self.broker = FakeBroker(sysinfo=modified_at(CARS_SYSINFO, 1000)).start()
+    self.client = SenseiClient(self.broker.host, self.broker.port, schema_cache=SchemaCache(),
+                               result_cache=ResultCache(check_interval=0.05))
+
+  def tearDown(self):
+    get_connection_pool(self.broker.host, self.broker.port).close()
+    self.broker.stop()
+
+  def num_searches(self):
+    return len([req for req in self.broker.requests if req[1] == "/sensei"])
+
+  def testCache(self):
+    req = self.client.compile("select * from cars limit 5")
+    res = self.client.doQuery(req)
+    res.hits.pop()
+    res = self.client.doQuery(self.client.compile("SELECT *  FROM cars LIMIT 5"))
+    self.assertEqual(len(res.hits), 5)
+    self.assertEqual(self.num_searches(), 1)
+    self.client.doQuery(self.client.compile("select * from cars limit 6"))
+    self.assertEqual(self.num_searches(), 2)
+    stats = self.client.get_result_cache_stats()
+    self.assertEqual((stats["hits"], stats["misses"]), (1, 2))
+
+  def testEquivalentRequests(self):
+    self.client.doQuery(self.client.compile(
+        "select * from cars where color in ('red', 'blue') and year > 1999 limit 5"))
+    self.client.doQuery(self.client.compile(
+        "select * from cars where year >= 2000 and color in ('blue', 'red', 'blue') limit 5"))
+    self.assertEqual(self.num_searches(), 1)
+
+  def testIndexChange(self):
+    req = self.client.compile("select * from cars limit 5")
+    self.client.doQuery(req)
+    self.client.doQuery(req)
+    self.broker.sysinfo = modified_at(CARS_SYSINFO, 2000)
+    time.sleep(0.06)
+    self.client.doQuery(req)
+    self.client.doQuery(req)
+    self.assertEqual(self.num_searches(), 2)
+    self.assertEqual(self.client.get_result_cache_stats()["invalidations"], 1)
+
+  def testTimeRelative(self):
+    stmt = "select * from cars where time in last 1 hour"
+    for i in xrange(3):
+      self.client.doQuery(stmt)
+    self.assertEqual(self.num_searches(), 3)
+    self.assertEqual(self.client.get_result_cache_stats()["hits"], 0)
+
+  def testSysinfoDown(self):
+    req = self.client.compile("select * from cars limit 5")
+    self.client.doQuery(req)
+    respond = self.broker.respond
+    def _respond(path, body, headers):
+      if path.endswith("/sysinfo"):
+        return 503, "unavailable", []
+      return respond(path, body, headers)
+    self.broker.respond = _respond
+    time.sleep(0.06)
+    # Searches work without the cache while the version cannot be checked
+    self.assertEqual(len(self.client.doQuery(req).hits), 5)
+    self.assertEqual(self.num_searches(), 2)
+    self.broker.respond = respond
+    time.sleep(0.06)
+    self.client.doQuery(req)
+    self.assertEqual(self.num_searches(), 2)
+
+  def testErrorsNotCached(self):
+    self.broker.search_handler = lambda body: {"numhits": 0, "hits": [],
+                                               "errors": [{"message": "busy"}]}
+    req = self.client.compile("select * from cars limit 5")
+    self.client.doQuery(req)
+    self.client.doQuery(req)
+    self.assertEqual(self.num_searches(), 2)
+
+
+if __name__ == "__main__":
+  unittest.main()
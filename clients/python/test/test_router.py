@@ -0,0 +1,136 @@
+import sys
+import copy
+import time
+import unittest
+from os.path import dirname
+
+sys.path.insert(0, dirname(__file__) + "/../sensei")
+sys.path.insert(0, dirname(__file__))
+from sensei_components import SenseiSystemInfo, SenseiNodeInfo
+from sensei_router import ClusterRouter
+from sensei_cache import SchemaCache
+from sensei_client import SenseiClient
+from sensei_transport import get_connection_pool
+from fake_broker import FakeBroker, CARS_SYSINFO, unused_port
+
+
+def with_cluster(sysinfo, nodes):
+  """Return sysinfo with a cluster of (id, partitions, port) nodes."""
+
+  sysinfo = copy.deepcopy(sysinfo)
+  sysinfo["clusterinfo"] = [{"id": id, "partitions": partitions,
+                             "nodelink": "127.0.0.1:1234",
+                             "adminlink": "http://127.0.0.1:%d" % port}
+                            for id, partitions, port in nodes]
+  return sysinfo
+
+
+class TestClusterRouter(unittest.TestCase):
+  """Test cases for choosing the node a request goes to."""
+
+  def setUp(self):
+    self.nodes = [SenseiNodeInfo(1, [0, 1], None, "http://a:8080"),
+                  SenseiNodeInfo(2, [0, 1], None, "http://b:8080"),
+                  SenseiNodeInfo(3, [2, 3], None, "http://c:8080")]
+    self.router = ClusterRouter()
+
+  def testClusterInfo(self):
+    sysinfo = SenseiSystemInfo(CARS_SYSINFO)
+    node = sysinfo.get_cluster_info()[0]
+    self.assertEqual((node.get_id(), node.get_partitions()), (1, [0, 1]))
+    self.assertEqual(node.get_admin_link(), "http://192.168.1.104:8080")
+    self.assertEqual(node.get_node_link(), "192.168.1.104:1234")
+
+  def testPartitions(self):
+    route = self.router.route
+    self.assertEqual(route(self.nodes, [2]).get_id(), 3)
+    self.assertEqual(route(self.nodes, [0, 1]).get_id(), 1)
+    # No node has all of them
+    self.assertEqual(route(self.nodes, [1, 2]), None)
+    self.assertEqual(route(self.nodes), None)
+    self.assertEqual(route([], [0]), None)
+
+  def testRouteParam(self):
+    route = self.router.route
+    # The whole index is on no single node
+    self.assertEqual(route(self.nodes, None, "key"), None)
+    ids = set()
+    for i in xrange(20):
+      node = route(self.nodes, [0], "key%d" % i)
+      self.assertEqual(route(self.nodes, [0], "key%d" % i), node)
+      ids.add(node.get_id())
+    self.assertEqual(ids, set([1, 2]))
+
+
+class TestDirectRouting(unittest.TestCase):
+  """Test cases for sending requests straight to nodes."""
+
+  def setUp(self):
+    self.nodes = [FakeBroker().start() for i in xrange(2)]
+    self.broker = FakeBroker(sysinfo=with_cluster(CARS_SYSINFO,
+                                                  [(1, [0, 1], self.nodes[0].port),
+                                                   (2, [2, 3], self.nodes[1].port)])).start()
+
+  def tearDown(self):
+    for broker in self.nodes + [self.broker]:
+      get_connection_pool(broker.host, broker.port).close()
+      broker.stop()
+
+  def make_client(self, ttl=60):
+    return SenseiClient(self.broker.host, self.broker.port, schema_cache=SchemaCache(ttl),
+                        direct_routing=True)
+
+  def num_searches(self, broker):
+    return len([req for req in broker.requests if req[1] == "/sensei"])
+
+  def query(self, client, partitions=None):
+    req = client.compile("select * from cars limit 5")
+    req.set_partitions(partitions)
+    self.assertEqual(len(client.doQuery(req).hits), 5)
+
+  def testRouting(self):
+    client = self.make_client()
+    self.query(client, [0])
+    self.query(client, [2, 3])
+    self.query(client, [1, 2])
+    self.query(client)
+    self.assertEqual([self.num_searches(node) for node in self.nodes], [1, 1])
+    self.assertEqual(self.num_searches(self.broker), 2)
+    self.assertEqual(client.get_routing_stats(), {"routed": 2, "fallbacks": 0})
+    body = [req for req in self.nodes[1].requests if req[1] == "/sensei"][0][2]
+    self.assertTrue('"partitions": [2, 3]' in body, body)
+
+  def testRawBql(self):
+    client = self.make_client()
+    client.doQuery("select * from cars limit 5")
+    self.assertEqual(self.num_searches(self.broker), 1)
+    self.assertEqual(client.get_routing_stats(), {"routed": 0, "fallbacks": 0})
+
+  def testNoRouting(self):
+    client = SenseiClient(self.broker.host, self.broker.port, schema_cache=SchemaCache())
+    self.query(client, [0])
+    self.assertEqual(self.num_searches(self.broker), 1)
+    self.assertEqual(client.get_routing_stats(), None)
+
+  def testDeadNode(self):
+    self.broker.sysinfo = with_cluster(CARS_SYSINFO, [(1, [0, 1], unused_port())])
+    client = self.make_client()
+    self.query(client, [0])
+    self.assertEqual(self.num_searches(self.broker), 1)
+    self.assertEqual(client.get_routing_stats(), {"routed": 0, "fallbacks": 1})
+    # The cluster map is fetched again for the next request
+    self.query(client, [0])
+    self.assertEqual(client.schema_cache.get_stats()["misses"], 2)
+    self.assertEqual(self.num_searches(self.broker), 2)
+
+  def testClusterChange(self):
+    client = self.make_client(ttl=0.05)
+    self.query(client, [0])
+    self.broker.sysinfo = with_cluster(CARS_SYSINFO, [(1, [0, 1], self.nodes[1].port)])
+    time.sleep(0.1)
+    self.query(client, [0])
+    self.assertEqual([self.num_searches(node) for node in self.nodes], [1, 1])
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,141 @@
+import sys
+import copy
+import time
+import shutil
+import tempfile
+import unittest
+from os.path import dirname
+
+sys.path.insert(0, dirname(__file__) + "/../sensei")
+sys.path.insert(0, dirname(__file__))
+from sensei_cache import SchemaCache
+from sensei_client import SenseiClient
+from sensei_transport import get_connection_pool
+from fake_broker import FakeBroker, CARS_SYSINFO
+
+
+def with_facet(sysinfo, name):
+  sysinfo = copy.deepcopy(sysinfo)
+  sysinfo["facets"].append({"runtime": False, "name": name,
+                            "props": {"column": name, "depends": "[]", "type": "simple",
+                                      "column_type": "string"}})
+  return sysinfo
+
+
+class TestSchemaCache(unittest.TestCase):
+  """Test cases for sharing broker system infos between clients."""
+
+  def setUp(self):
+    self.broker = FakeBroker().start()
+    self.cache = SchemaCache()
+    self.cache_dir = None
+
+  def tearDown(self):
+    self.cache.close()
+    if self.cache_dir:
+      shutil.rmtree(self.cache_dir)
+    get_connection_pool(self.broker.host, self.broker.port).close()
+    self.broker.stop()
+
+  def make_client(self, cache=None):
+    return SenseiClient(self.broker.host, self.broker.port, schema_cache=cache or self.cache)
+
+  def num_sysinfo_requests(self):
+    return len([req for req in self.broker.requests if req[1].endswith("/sysinfo")])
+
+  def testShared(self):
+    client1 = self.make_client()
+    client2 = self.make_client()
+    self.assertEqual(self.num_sysinfo_requests(), 1)
+    self.assertTrue(client1.get_sysinfo() is client2.get_sysinfo())
+    self.assertEqual(self.cache.get_stats()["hits"], 3)
+
+  def testTtl(self):
+    self.cache.ttl = 0.05
+    client = self.make_client()
+    client.get_sysinfo()
+    self.assertEqual(self.num_sysinfo_requests(), 1)
+    time.sleep(0.1)
+    client.get_sysinfo()
+    self.assertEqual(self.num_sysinfo_requests(), 2)
+    client.get_sysinfo(refresh=True)
+    self.assertEqual(self.num_sysinfo_requests(), 3)
+
+  def testRebuildOnlyOnChange(self):
+    client = self.make_client()
+    parser = client.parser
+    client.compile("select * from cars where color = 'red'")
+    self.broker.sysinfo = dict(CARS_SYSINFO, lastmodified=1000)
+    self.assertEqual(client.get_sysinfo(refresh=True).get_last_modified(), 1000)
+    self.assertTrue(client.parser is parser)
+    self.assertEqual(len(client.stmt_cache), 1)
+
+    self.broker.sysinfo = with_facet(CARS_SYSINFO, "city")
+    client.get_sysinfo(refresh=True)
+    self.assertTrue(client.parser is not parser)
+    self.assertTrue("city" in client.get_facet_map())
+    self.assertEqual(len(client.stmt_cache), 0)
+
+  def testCacheDir(self):
+    self.cache_dir = tempfile.mkdtemp()
+    self.make_client(SchemaCache(cache_dir=self.cache_dir))
+    client = self.make_client(SchemaCache(cache_dir=self.cache_dir))
+    self.assertEqual(self.num_sysinfo_requests(), 1)
+    self.assertTrue("color" in client.get_facet_map())
+
+  def testBackgroundRefresh(self):
+    self.cache = SchemaCache(refresh_interval=0.05)
+    client = self.make_client()
+    self.broker.sysinfo = with_facet(CARS_SYSINFO, "city")
+    deadline = time.time() + 5
+    while '"city"' not in self.cache.peek(client.url).signature and time.time() < deadline:
+      time.sleep(0.01)
+    # Picked up by the next compile, without a request
+    num_requests = len(self.broker.requests)
+    client.compile("select * from cars where city = 'paris'")
+    self.assertEqual(len(self.broker.requests), num_requests)
+    self.assertTrue("city" in client.get_facet_map())
+
+  def testRefreshError(self):
+    client = self.make_client()
+    entry = self.cache.peek(client.url)
+    self.broker.sysinfo = object()
+    self.assertRaises(Exception, self.cache.refresh, client.url)
+    self.assertTrue(self.cache.peek(client.url) is entry)
+    self.assertTrue("color" in client.get_facet_map())
+
+
+
+class TestLazyClient(unittest.TestCase):
+  """Test cases for clients that load the schema on first use."""
+
+  def setUp(self):
+    self.broker = FakeBroker().start()
+
+  def tearDown(self):
+    get_connection_pool(self.broker.host, self.broker.port).close()
+    self.broker.stop()
+
+  def testNoRequestUntilCompile(self):
+    client = SenseiClient(self.broker.host, self.broker.port, schema_cache=SchemaCache(),
+                          lazy=True)
+    self.assertEqual(self.broker.requests, [])
+    res = client.doQuery("select * from cars")
+    self.assertEqual(res.numHits, 100)
+    self.assertEqual([req[1] for req in self.broker.requests], ["/sensei"])
+    self.assertTrue(client.parser is None)
+
+    client.compile("select * from cars where color = 'red'")
+    client.compile("select * from cars where color = 'blue'")
+    self.assertEqual([req[1] for req in self.broker.requests], ["/sensei", "/sensei/sysinfo"])
+    self.assertTrue("color" in client.get_facet_map())
+
+  def testGivenSysinfo(self):
+    client = SenseiClient(sysinfo=CARS_SYSINFO, lazy=True)
+    self.assertTrue(client.parser is None)
+    self.assertTrue("year" in client.get_facet_map())
+    self.assertTrue(client.get_parser() is client.parser)
+
+
+if __name__ == "__main__":
+  unittest.main()
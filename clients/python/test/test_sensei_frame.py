@@ -0,0 +1,86 @@
+import sys
+import unittest
+from os.path import dirname
+
+sys.path.insert(0, dirname(__file__) + "/../sensei")
+sys.path.insert(0, dirname(__file__))
+from sensei_components import SenseiResult, SenseiSystemInfo
+from fake_broker import CARS_SYSINFO, make_cars
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+
+def make_facet_map(sysinfo):
+  return dict((info.get_name(), info)
+              for info in SenseiSystemInfo(sysinfo).get_facet_infos())
+
+
+@unittest.skipIf(numpy is None, "NumPy is not installed")
+class TestSenseiFrame(unittest.TestCase):
+  """Test cases for columnar results."""
+
+  def setUp(self):
+    self.facet_map = make_facet_map(CARS_SYSINFO)
+
+  def testTypedColumns(self):
+    hits = make_cars(10)
+    hits[0]["tags"] = ["cool", "fast"]
+    res = SenseiResult({"numhits": 10, "hits": hits})
+    frame = res.to_columns(["uid", "score", "year", "price", "color", "tags"], self.facet_map)
+    self.assertEqual(len(frame), 10)
+    self.assertEqual(frame["uid"].dtype, numpy.int64)
+    self.assertEqual(frame["year"].dtype, numpy.int64)
+    self.assertEqual(frame["year"].tolist()[:3], [1993, 1994, 1995])
+    self.assertEqual(frame["price"].dtype, numpy.float64)
+    self.assertEqual(frame["price"].sum(), sum(5000.0 + 100 * i for i in xrange(10)))
+    self.assertEqual(frame["score"].tolist(), [1.0] * 10)
+    self.assertEqual(frame["tags"][0], ["cool", "fast"])
+    self.assertEqual(frame["tags"][1], [])
+
+  def testDictColumn(self):
+    res = SenseiResult({"numhits": 10, "hits": make_cars(10)})
+    colors = res.to_columns(["color"], self.facet_map)["color"]
+    self.assertEqual(colors.values, ["red", "blue", "white", "black", "silver"])
+    self.assertEqual(colors.codes.tolist(), [0, 1, 2, 3, 4] * 2)
+    self.assertEqual(colors[6], "blue")
+    self.assertEqual(colors.value_counts()["white"], 2)
+    self.assertEqual(colors.equals("red").sum(), 2)
+    self.assertEqual(colors.equals("green").sum(), 0)
+
+  def testMissingValues(self):
+    hits = make_cars(3)
+    del hits[1]["year"]
+    del hits[2]["color"]
+    frame = SenseiResult({"hits": hits}).to_columns(["year", "color"], self.facet_map)
+    self.assertEqual(frame["year"].dtype, numpy.float64)
+    self.assertTrue(numpy.isnan(frame["year"][1]))
+    self.assertEqual(frame["color"].decode(), ["red", "blue", None])
+
+  def testGroupHits(self):
+    cars = make_cars(6)
+    hits = [{"groupvalue": "red", "grouphits": cars[:2]},
+            {"groupvalue": "blue", "grouphits": cars[2:5]}]
+    frame = SenseiResult({"hits": hits}).to_columns(["groupvalue", "uid"], self.facet_map)
+    self.assertEqual(len(frame), 5)
+    self.assertEqual(frame["groupvalue"].decode(), ["red"] * 2 + ["blue"] * 3)
+    self.assertEqual(frame["uid"].tolist(), range(5))
+
+  def testDefaultColumns(self):
+    res = SenseiResult({"hits": make_cars(2)})
+    frame = res.to_columns(facet_map=self.facet_map)
+    self.assertEqual(frame.get_columns(), ["color", "docid", "price", "score", "uid", "year"])
+    self.assertEqual(len(SenseiResult({"hits": []}).to_columns()), 0)
+
+  def testInferredTypes(self):
+    hits = [{"a": 1, "b": 1.5, "c": "x"}, {"a": 2, "b": 2, "c": None}]
+    frame = SenseiResult({"hits": hits}).to_columns(["a", "b", "c"])
+    self.assertEqual(frame["a"].dtype, numpy.int64)
+    self.assertEqual(frame["b"].dtype, numpy.float64)
+    self.assertEqual(frame["c"].decode(), ["x", None])
+
+
+if __name__ == "__main__":
+  unittest.main()
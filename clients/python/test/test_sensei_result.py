@@ -0,0 +1,77 @@
+import sys
+import json
+import unittest
+from os.path import dirname
+from StringIO import StringIO
+
+sys.path.insert(0, dirname(__file__) + "/../sensei")
+sys.path.insert(0, dirname(__file__))
+from sensei_components import SenseiHit, SenseiResult
+from fake_broker import make_cars
+
+
+class TestSenseiHit(unittest.TestCase):
+  """Test cases for lazy hit views."""
+
+  def testFields(self):
+    hit = SenseiHit(make_cars(3)[2])
+    self.assertEqual((hit.uid, hit.docid, hit.score), ("2", "2", 1.0))
+    self.assertEqual(hit.get("color"), ["white"])
+    self.assertEqual(hit.srcData, {"id": 2, "color": "white", "year": 1995, "price": 5200.0})
+    self.assertEqual(hit.stored, None)
+    self.assertEqual(SenseiHit({}).srcData, None)
+    self.assertEqual(SenseiHit().srcData, {})
+
+  def testLazySrcData(self):
+    hit = SenseiHit({"uid": "1", "score": 0.5, "srcdata": "{not json"})
+    self.assertEqual((hit.uid, hit.score), ("1", 0.5))
+    self.assertRaises(ValueError, getattr, hit, "srcData")
+
+  def testDecodedOnce(self):
+    hit = SenseiHit({"uid": "1", "_srcdata": '{"a": [1, 2]}'})
+    self.assertTrue(hit.srcData is hit.srcData)
+    self.assertEqual(hit.srcData, {"a": [1, 2]})
+
+  def testSetAttributes(self):
+    json_hit = {"uid": "1"}
+    hit = SenseiHit(json_hit)
+    hit.uid = "2"
+    hit.score = 0.5
+    self.assertEqual((hit.uid, hit.score), ("2", 0.5))
+    self.assertEqual(json_hit, {"uid": "2", "score": 0.5})
+    hit.color = "red"
+    self.assertEqual(hit.color, "red")
+    hit = SenseiHit()
+    hit.srcData = {"a": 1}
+    self.assertEqual(hit.srcData, {"a": 1})
+
+
+class TestSenseiResult(unittest.TestCase):
+  """Test cases for the hits of a result."""
+
+  def setUp(self):
+    hits = make_cars(3)
+    for hit in hits:
+      hit["_srcdata"] = hit.pop("srcdata")
+    self.result = SenseiResult({"numhits": 3, "totaldocs": 3, "hits": hits, "facets": {}})
+
+  def testGetHits(self):
+    hits = self.result.get_hits()
+    self.assertTrue(hits is self.result.get_hits())
+    self.assertEqual([hit.uid for hit in hits], ["0", "1", "2"])
+    self.assertTrue(hits[1].get_json() is self.result.hits[1])
+
+  def testDisplaySrcData(self):
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    try:
+      self.result.display(columns=["uid", "_srcdata.color"])
+      output = sys.stdout.getvalue()
+    finally:
+      sys.stdout = stdout
+    self.assertTrue("| blue " in output)
+    self.assertEqual(self.result.get_hits()[1].srcData["color"], "blue")
+
+
+if __name__ == "__main__":
+  unittest.main()
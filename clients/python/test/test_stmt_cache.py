@@ -0,0 +1,89 @@
+import sys
+import unittest
+from os.path import dirname
+
+sys.path.insert(0, dirname(__file__) + "/../sensei")
+sys.path.insert(0, dirname(__file__))
+from bql_parser import normalize_bql, is_time_relative
+from sensei_cache import LRUCache
+from sensei_client import SenseiClient
+from fake_broker import CARS_SYSINFO
+
+
+class TestLRUCache(unittest.TestCase):
+  """Test cases for the LRU cache."""
+
+  def testEviction(self):
+    cache = LRUCache(2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    self.assertEqual(cache.get("a"), 1)
+    cache.put("c", 3)
+    self.assertEqual(cache.get("b"), None)
+    self.assertEqual(cache.get("a"), 1)
+    self.assertEqual(cache.get("c"), 3)
+    self.assertEqual(cache.get_stats(),
+                     {"hits": 3, "misses": 1, "evictions": 1, "size": 2, "max_size": 2})
+
+
+class TestStatementCache(unittest.TestCase):
+  """Test cases for the compiled statement cache of SenseiClient."""
+
+  def setUp(self):
+    self.client = SenseiClient(sysinfo=CARS_SYSINFO, stmt_cache_size=2)
+
+  def testNormalize(self):
+    self.assertEqual(normalize_bql("  SELECT *\n  FROM cars -- all cars\n WHERE color = 'a  b' ; "),
+                     "SELECT * FROM cars WHERE color = 'a  b'")
+    self.assertEqual(normalize_bql("select * from cars"),
+                     normalize_bql("select  *  from\tcars;"))
+    self.assertNotEqual(normalize_bql("select * from cars where color = 'red'"),
+                        normalize_bql("select * from cars where color = 'RED'"))
+
+  def testIsTimeRelative(self):
+    self.assertTrue(is_time_relative("select * from cars where time in last 2 days"))
+    self.assertTrue(is_time_relative("select * from cars where time > 2 days AGO"))
+    self.assertTrue(is_time_relative("select * from cars where time < now"))
+    self.assertFalse(is_time_relative("select * from cars where color = 'now'"))
+    self.assertFalse(is_time_relative("select * from cars where last_seen > 10"))
+
+  def testHitAndMiss(self):
+    req1 = self.client.compile("select * from cars where color = 'red'")
+    req2 = self.client.compile("select *  from cars\nwhere color = 'red';")
+    self.assertEqual(self.client.buildJsonString(req1), self.client.buildJsonString(req2))
+    stats = self.client.get_stmt_cache_stats()
+    self.assertEqual(stats["hits"], 1)
+    self.assertEqual(stats["misses"], 1)
+
+  def testEviction(self):
+    for color in ["red", "blue", "white", "red"]:
+      self.client.compile("select * from cars where color = '%s'" % color)
+    stats = self.client.get_stmt_cache_stats()
+    self.assertEqual(stats["evictions"], 2)
+    self.assertEqual(stats["hits"], 0)
+    self.assertEqual(stats["size"], 2)
+
+  def testMutationIsolation(self):
+    req = self.client.compile("select color, year from cars limit 5")
+    req.count = 100
+    req.columns.append("price")
+    req = self.client.compile("select color, year from cars limit 5")
+    self.assertEqual(req.count, 5)
+    self.assertEqual(req.columns, ["color", "year"])
+
+  def testTimeRelativeBypass(self):
+    stmt = "select * from cars where time in last 2 days"
+    self.client.compile(stmt)
+    self.client.compile(stmt)
+    stats = self.client.get_stmt_cache_stats()
+    self.assertEqual(stats["hits"], 0)
+    self.assertEqual(stats["size"], 0)
+
+  def testDisabled(self):
+    client = SenseiClient(sysinfo=CARS_SYSINFO, stmt_cache_size=0)
+    self.assertTrue(client.compile("select * from cars") is not None)
+    self.assertEqual(client.get_stmt_cache_stats(), None)
+
+
+if __name__ == "__main__":
+  unittest.main()
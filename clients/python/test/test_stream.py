@@ -0,0 +1,148 @@
+import sys
+import json
+import unittest
+from os.path import dirname
+
+sys.path.insert(0, dirname(__file__) + "/../sensei")
+sys.path.insert(0, dirname(__file__))
+from sensei_stream import JsonScanner, SenseiResultStream
+from sensei_client import SenseiClient
+from sensei_transport import get_connection_pool
+from fake_broker import FakeBroker, CARS_SYSINFO, make_cars, make_hit
+
+
+class ChunkedResponse:
+  """A response whose body is made up on demand, piece by piece."""
+
+  def __init__(self, pieces):
+    self.pieces = iter(pieces)
+    self.buf = ""
+    self.closed = False
+
+  def read(self, amt):
+    while len(self.buf) < amt:
+      try:
+        self.buf += self.pieces.next()
+      except StopIteration:
+        break
+    data, self.buf = self.buf[:amt], self.buf[amt:]
+    return data
+
+  def close(self):
+    self.closed = True
+
+
+def stream_of(text, chunk_size):
+  return SenseiResultStream(ChunkedResponse([text]), chunk_size=chunk_size)
+
+def make_response(num_hits, **fields):
+  return json.dumps(dict(fields, numhits=num_hits, hits=make_cars(num_hits)))
+
+
+class TestJsonScanner(unittest.TestCase):
+  """Test cases for finding values in JSON text."""
+
+  def scan(self, text, chunk_size):
+    scanner = JsonScanner(ChunkedResponse([text]).read, chunk_size)
+    values = [scanner.scan_value()]
+    while scanner.expect(",]") == ",":
+      values.append(scanner.scan_value())
+    return values
+
+  def testValues(self):
+    values = ['{"a": [1, {"b": "}]"}]}', '"x\\"y\\\\"', '-1.5e3', 'true', 'null',
+              '[]', '"caf\\u00e9 [{"', '[[["\\\\"]]]']
+    text = " %s ]" % ", ".join(values)
+    for chunk_size in [1, 2, 3, 7, 4096]:
+      self.assertEqual(self.scan(text, chunk_size), values)
+
+  def testTruncated(self):
+    self.assertRaises(ValueError, self.scan, '{"a": "b', 4)
+    self.assertRaises(ValueError, self.scan, '[1, 2', 4)
+
+
+class TestResultStream(unittest.TestCase):
+  """Test cases for parsing results while they are read."""
+
+  def testSameAsJson(self):
+    text = make_response(20, time=3, facets={"color": [{"value": "red", "count": 4}]},
+                         totaldocs=100)
+    expected = json.loads(text)
+    for chunk_size in [1, 5, 64, 1 << 20]:
+      stream = stream_of(text, chunk_size)
+      hits = [hit.get_json() for hit in stream]
+      self.assertEqual(hits, expected["hits"])
+      self.assertEqual(stream.get_num_hits(), 20)
+      self.assertEqual(stream.get_total_docs(), 100)
+      self.assertEqual(stream.get_facets(), expected["facets"])
+      self.assertTrue(stream.response.closed)
+
+  def testFieldsBeforeHits(self):
+    text = '{"numhits": 2, "time": 5, "hits": [{"uid": "1"}, {"uid": "2"}], "facets": {}}'
+    stream = stream_of(text, 8)
+    hits = iter(stream)
+    self.assertEqual(hits.next().uid, "1")
+    self.assertEqual((stream.get_num_hits(), stream.get_time()), (2, 5))
+    self.assertTrue("facets" not in stream.fields)
+    self.assertEqual(hits.next().uid, "2")
+
+  def testFieldAfterHits(self):
+    text = '{"hits": [{"uid": "1"}, {"uid": "2"}], "numhits": 2}'
+    stream = stream_of(text, 8)
+    self.assertEqual(stream.get_num_hits(), 2)
+    self.assertEqual([hit.uid for hit in stream], ["1", "2"])
+
+  def testEmpty(self):
+    self.assertEqual(list(stream_of('{}', 4)), [])
+    stream = stream_of('{"hits": [], "numhits": 0, "errors": [{"message": "x"}]}', 4)
+    self.assertEqual(list(stream), [])
+    self.assertEqual(stream.get_errors(), [{"message": "x"}])
+
+  def testBadJson(self):
+    stream = stream_of('{"hits": [{"uid": "1"} {"uid": "2"}]}', 4)
+    self.assertRaises(ValueError, list, stream)
+    self.assertTrue(stream.response.closed)
+
+  def testFlatMemory(self):
+    def pieces():
+      yield '{"numhits": 20000, "hits": ['
+      for i in xrange(20000):
+        yield (i and ", " or "") + json.dumps(make_hit(i, color="red", text="x" * 200))
+      yield '], "time": 1}'
+    response = ChunkedResponse(pieces())
+    stream = SenseiResultStream(response, chunk_size=4096)
+    scanner = stream.scanner
+    max_buf = 0
+    count = 0
+    for hit in stream:
+      count += 1
+      max_buf = max(max_buf, len(scanner.buf))
+    self.assertEqual(count, 20000)
+    self.assertEqual(stream.get_time(), 1)
+    # One chunk plus at most one hit
+    self.assertTrue(max_buf < 2 * 4096, max_buf)
+
+
+class TestClientStream(unittest.TestCase):
+  """Test cases for streaming results from a broker."""
+
+  def setUp(self):
+    self.broker = FakeBroker(hits=make_cars(500)).start()
+    self.client = SenseiClient(self.broker.host, self.broker.port, sysinfo=CARS_SYSINFO)
+
+  def tearDown(self):
+    get_connection_pool(self.broker.host, self.broker.port).close()
+    self.broker.stop()
+
+  def testDoQueryStream(self):
+    req = self.client.compile("select * from cars limit 300")
+    for i in xrange(2):
+      stream = self.client.doQueryStream(req, chunk_size=1000)
+      self.assertEqual([hit.uid for hit in stream], [str(i) for i in xrange(300)])
+      self.assertEqual(stream.get_num_hits(), 500)
+    # The connection was reused after the first response
+    self.assertEqual(self.client.get_pool_stats()["hits"], 1)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,175 @@
+import sys
+import json
+import threading
+import time
+import unittest
+import urllib2
+from os.path import dirname
+
+sys.path.insert(0, dirname(__file__) + "/../sensei")
+sys.path.insert(0, dirname(__file__))
+from sensei_transport import SenseiConnectionPool, get_connection_pool
+from sensei_client import SenseiClient
+from fake_broker import FakeBroker
+
+
+class TestConnectionPool(unittest.TestCase):
+  """Test cases for the keep-alive connection pool."""
+
+  def setUp(self):
+    self.broker = FakeBroker().start()
+    self.pool = SenseiConnectionPool(self.broker.host, self.broker.port, max_size=2)
+
+  def tearDown(self):
+    self.pool.close()
+    self.broker.stop()
+
+  def testKeepAlive(self):
+    for i in xrange(5):
+      res = json.loads(self.pool.request("/sensei", '{"size": 3}'))
+      self.assertEqual(len(res["hits"]), 3)
+    self.assertEqual(self.broker.num_connections, 1)
+    stats = self.pool.get_stats()
+    self.assertEqual(stats["misses"], 1)
+    self.assertEqual(stats["hits"], 4)
+    self.assertEqual(stats["idle"], 1)
+
+  def testBounded(self):
+    max_open = [0]
+    def query():
+      for i in xrange(10):
+        self.pool.request("/sensei", '{"size": 1}')
+        max_open[0] = max(max_open[0], self.pool.get_stats()["open"])
+    threads = [threading.Thread(target=query) for i in xrange(8)]
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+    self.assertTrue(max_open[0] <= 2)
+    self.assertTrue(self.broker.num_connections <= 2)
+    stats = self.pool.get_stats()
+    self.assertEqual(stats["hits"] + stats["misses"], 80)
+
+  def testIdleEviction(self):
+    self.pool.idle_timeout = 0.05
+    self.pool.request("/sensei/sysinfo")
+    time.sleep(0.1)
+    self.pool.request("/sensei/sysinfo")
+    stats = self.pool.get_stats()
+    self.assertEqual(stats["evictions"], 1)
+    self.assertEqual(stats["misses"], 2)
+
+  def testDroppedConnection(self):
+    self.pool.request("/sensei/sysinfo")
+    conn, _ = self.pool._idle[0]
+    conn.sock.close()
+    self.assertTrue(SenseiConnectionPool.is_connection_dropped(conn))
+    self.pool.request("/sensei/sysinfo")
+    self.assertEqual(self.pool.get_stats()["evictions"], 1)
+
+  def testHttpError(self):
+    self.broker.search_handler = lambda body: (500, "Internal error")
+    try:
+      self.pool.request("/sensei", "{}")
+      self.fail("HTTPError expected")
+    except urllib2.HTTPError as err:
+      self.assertEqual(err.code, 500)
+      self.assertEqual(err.read(), "Internal error")
+    # The error body was drained, so the connection is still reusable
+    self.pool.request("/sensei/sysinfo")
+    self.assertEqual(self.pool.get_stats()["hits"], 1)
+
+  def testConnectionRefused(self):
+    self.broker.stop()
+    self.assertRaises(urllib2.URLError, self.pool.request, "/sensei/sysinfo")
+    self.assertEqual(self.pool.get_stats()["open"], 0)
+
+
+class TestClientTransport(unittest.TestCase):
+  """Test cases for SenseiClient on top of the connection pool."""
+
+  def setUp(self):
+    self.broker = FakeBroker().start()
+
+  def tearDown(self):
+    get_connection_pool(self.broker.host, self.broker.port).close()
+    self.broker.stop()
+
+  def testClientReusesConnection(self):
+    client = SenseiClient(self.broker.host, self.broker.port)
+    self.assertTrue("color" in client.get_facet_map())
+    res = client.doQuery("select * from cars")
+    self.assertEqual(res.numHits, 100)
+    client.get_sysinfo(refresh=True)
+    self.assertEqual(self.broker.num_connections, 1)
+    self.assertEqual(client.get_pool_stats()["hits"], 2)
+
+
+class TestCompression(unittest.TestCase):
+  """Test cases for compressed requests and responses."""
+
+  def setUp(self):
+    self.broker = FakeBroker().start()
+    self.pool = SenseiConnectionPool(self.broker.host, self.broker.port)
+    self.expected = self.pool.request("/sensei", '{"size": 50}')
+
+  def tearDown(self):
+    self.pool.close()
+    self.broker.stop()
+
+  def testEncodings(self):
+    for encoding in ["gzip", "deflate", "raw-deflate"]:
+      self.broker.encoding = encoding
+      self.pool = SenseiConnectionPool(self.broker.host, self.broker.port)
+      self.assertEqual(self.pool.request("/sensei", '{"size": 50}', compression=True),
+                       self.expected)
+      stats = self.pool.get_stats()
+      self.assertEqual(stats["bytes_received"], len(self.expected))
+      self.assertTrue(stats["wire_bytes_received"] < len(self.expected) / 2)
+
+  def testNotRequested(self):
+    self.broker.encoding = "gzip"
+    self.assertEqual(self.pool.request("/sensei", '{"size": 50}'), self.expected)
+    self.assertEqual(self.broker.requests[-1][3]["accept-encoding"], "identity")
+    stats = self.pool.get_stats()
+    self.assertEqual(stats["wire_bytes_received"], stats["bytes_received"])
+
+  def testStreamingReads(self):
+    self.broker.encoding = "gzip"
+    for i in xrange(2):
+      res = self.pool.urlopen("/sensei", '{"size": 50}', compression=True)
+      chunks = []
+      while True:
+        chunk = res.read(100)
+        if not chunk:
+          break
+        self.assertTrue(len(chunk) <= 100)
+        chunks.append(chunk)
+      self.assertEqual("".join(chunks), self.expected)
+    # The connection was kept alive
+    self.assertEqual(self.broker.num_connections, 1)
+
+  def testCompressedRequests(self):
+    large = json.dumps({"size": 1, "bql": "select * from cars where " + "x" * 5000})
+    self.pool.request("/sensei", large, compress_request=True)
+    self.assertEqual(self.broker.requests[-1][2], large)
+    self.assertEqual(self.broker.requests[-1][3]["content-encoding"], "gzip")
+    self.pool.request("/sensei", '{"size": 1}', compress_request=True)
+    self.assertTrue("content-encoding" not in self.broker.requests[-1][3])
+    stats = self.pool.get_stats()
+    self.assertEqual(stats["bytes_sent"], len('{"size": 50}') + len(large) + len('{"size": 1}'))
+    self.assertTrue(stats["wire_bytes_sent"] < stats["bytes_sent"] / 2)
+
+  def testClient(self):
+    self.broker.encoding = "gzip"
+    client = SenseiClient(self.broker.host, self.broker.port, compression=True)
+    self.assertTrue("color" in client.get_facet_map())
+    req = client.compile("select * from cars limit 40")
+    self.assertEqual(len(client.doQuery(req).hits), 40)
+    self.assertEqual(len(list(client.doQueryStream(req, chunk_size=256))), 40)
+    stats = client.get_pool_stats()
+    self.assertTrue(stats["wire_bytes_received"] < stats["bytes_received"])
+
+
+if __name__ == "__main__":
+  unittest.main()